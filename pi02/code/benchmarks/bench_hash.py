@@ -0,0 +1,75 @@
+#######################################################
+#
+# bench_hash.py
+# reports the time taken to hash a password with each
+# key derivation function at a range of costs, to
+# choose the cost set in picode/passwords.py
+#
+#######################################################
+
+# usage, from the pi02/code directory, run on the target hardware
+#
+#   python3 benchmarks/bench_hash.py --target 250
+#
+# A login waits for one hash, so choose the highest cost whose time is acceptable,
+# --target marks the highest cost of each scheme within that many milliseconds
+
+
+import os, sys, json, time, hashlib, statistics, argparse, platform
+
+from bench_wsgi import CODE_DIR
+
+if CODE_DIR not in sys.path:
+    sys.path.insert(0, CODE_DIR)
+
+from picode import passwords
+
+
+# scheme : list of cost dictionaries, in increasing cost
+COSTS = {'pbkdf2_sha256': [{'iterations':iterations} for iterations in (10000, 25000, 50000, 100000, 200000, 400000)],
+         'scrypt': [{'n':n, 'r':8, 'p':1} for n in (1024, 2048, 4096, 8192, 16384, 32768)]}
+
+
+def time_kdf(kdf, runs):
+    "Returns the median and maximum milliseconds taken to derive a key"
+    times = []
+    for run in range(runs):
+        start = time.perf_counter()
+        passwords.derive('correct horse battery staple', 'a' * 32, kdf)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times), max(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time password hashing at each cost")
+    parser.add_argument('--runs', type=int, default=5, help="hashes timed at each cost")
+    parser.add_argument('--target', type=float, default=250, help="acceptable login delay in milliseconds")
+    parser.add_argument('--json', help="write results to this file")
+    args = parser.parse_args()
+
+    results = {'python':platform.python_version(), 'machine':platform.machine(), 'current':passwords.current_kdf(), 'kdfs':{}}
+    print("%-40s %12s %12s" % ('kdf', 'median ms', 'max ms'))
+    for scheme, costs in COSTS.items():
+        if scheme == 'scrypt' and not hasattr(hashlib, 'scrypt'):
+            print("scrypt is not available in this python")
+            continue
+        best = None
+        for cost in costs:
+            kdf = passwords.format_kdf(scheme, cost)
+            median, maximum = time_kdf(kdf, args.runs)
+            results['kdfs'][kdf] = {'median_ms':round(median, 3), 'max_ms':round(maximum, 3)}
+            if median <= args.target:
+                best = kdf
+            print("%-40s %12.1f %12.1f%s" % (kdf, median, maximum, '  (current)' if kdf == results['current'] else ''))
+            if median > 4 * args.target:
+                # higher costs would only take longer
+                break
+        if best:
+            print("highest %s cost within %s ms: %s\n" % (scheme, args.target, best))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
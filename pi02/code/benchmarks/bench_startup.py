@@ -0,0 +1,95 @@
+#######################################################
+#
+# bench_startup.py
+# starts pi02 in fresh interpreters, and reports the
+# median duration of each startup phase, and the time
+# until the outputs are driven and requests served
+#
+#######################################################
+
+# usage, from the pi02/code directory
+#
+#   python3 benchmarks/bench_startup.py --runs 10 --json startup.json
+#   python3 benchmarks/bench_startup.py --compare startup.json
+#
+# The project is copied to a temporary projectfiles directory, beside a link to the skis
+# project, and each run imports pi02 in a new process with the simulated GPIO backend.
+# The first run creates setup.db, and is not measured, so the others measure the startup
+# of an existing database, as after a power cut.
+
+
+import os, sys, json, shutil, statistics, subprocess, tempfile, argparse, platform
+
+from bench_wsgi import CODE_DIR, SKIS_DIR, check_skis, git_revision, compare
+
+
+PROJECT_DIR = os.path.dirname(CODE_DIR)
+
+# run in each child process, waits for the deferred startup work, which writes the timeline
+_CHILD = """
+import pi02
+pi02.startup.timeline.finished.wait(30)
+"""
+
+
+def make_projectfiles(projectfiles):
+    "Copies the project, without its database, and links the skis project beside it"
+    shutil.copytree(PROJECT_DIR, os.path.join(projectfiles, 'pi02'),
+                    ignore=shutil.ignore_patterns('setup', '__pycache__'))
+    os.symlink(SKIS_DIR, os.path.join(projectfiles, 'skis'))
+
+
+def run_once(projectfiles, report):
+    env = dict(os.environ, PI02_GPIO='simulated', PI02_STARTUP_REPORT=report)
+    subprocess.run([sys.executable, '-c', _CHILD], cwd=os.path.join(projectfiles, 'pi02', 'code'),
+                   env=env, check=True)
+    with open(report) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the pi02 startup timeline")
+    parser.add_argument('--runs', type=int, default=10, help="processes started, after one to create the database")
+    parser.add_argument('--json', help="write results to this file")
+    parser.add_argument('--compare', help="compare with results previously written by --json")
+    args = parser.parse_args()
+    check_skis(parser)
+
+    with tempfile.TemporaryDirectory() as projectfiles:
+        make_projectfiles(projectfiles)
+        report = os.path.join(projectfiles, 'startup.json')
+        # creates the database, which is not measured
+        run_once(projectfiles, report)
+        # phase name : list of durations in ms
+        durations = {}
+        ready = []
+        for run in range(args.runs):
+            timeline = run_once(projectfiles, report)
+            ready.append(timeline['ready_ms'])
+            for phase in timeline['phases']:
+                name = phase['name'] + (' (deferred)' if phase['deferred'] else '')
+                durations.setdefault(name, []).append(phase['duration_ms'])
+                if phase['name'] == 'outputs':
+                    # the time at which the outputs are set to their power up values
+                    durations.setdefault('outputs driven at', []).append(phase['start_ms'] + phase['duration_ms'])
+
+    phases = {name:{'median_ms':round(statistics.median(values), 3), 'max_ms':round(max(values), 3)}
+              for name, values in durations.items()}
+    phases['ready'] = {'median_ms':round(statistics.median(ready), 3), 'max_ms':round(max(ready), 3)}
+    for name, result in phases.items():
+        print("%-32s %10.1f ms median %10.1f ms max" % (name, result['median_ms'], result['max_ms']))
+
+    results = {'revision':git_revision(),
+               'python':platform.python_version(),
+               'machine':platform.machine(),
+               'scenarios':phases}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
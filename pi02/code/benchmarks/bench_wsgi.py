@@ -0,0 +1,252 @@
+#######################################################
+#
+# bench_wsgi.py
+# drives pi02.application in-process through realistic
+# request mixes, and reports throughput, latency, SQL
+# statements, commits and memory per request
+#
+#######################################################
+
+# usage, from the pi02/code directory
+#
+#   python3 benchmarks/bench_wsgi.py --requests 2000 --json results.json
+#   python3 benchmarks/bench_wsgi.py --compare results.json
+#
+# A temporary setup.db is used, and the simulated GPIO backend, so this runs on any
+# Linux box with skipole installed, and the skis project beside the pi02 project
+# as is required to serve pi02. pi02 imports skis from projectfiles/skis/code, the
+# projectfiles directory being the one holding this pi02 project, so run the benchmarks
+# from a projectfiles tree, as made by skipole, not from a checkout of pi02 alone.
+
+
+import os, sys, io, json, time, random, tempfile, tracemalloc, argparse, platform, subprocess
+
+from urllib.parse import urlencode
+from wsgiref.util import setup_testing_defaults
+
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# the skis project, imported by pi02, is expected beside the pi02 project
+SKIS_DIR = os.path.join(os.path.dirname(os.path.dirname(CODE_DIR)), 'skis')
+
+SCENARIOS = ('login', 'sensors', 'control', 'toggle', 'mixed')
+
+# weights of the requests making up the 'mixed' scenario
+MIX = (('sensors', 6), ('control', 3), ('toggle', 1))
+
+
+class StatementCounter(object):
+    "Trace callback counting SQL statements and commits"
+
+    def __init__(self):
+        self.statements = 0
+        self.commits = 0
+
+    def __call__(self, statement):
+        self.statements += 1
+        if statement.startswith('COMMIT'):
+            self.commits += 1
+
+
+class Client(object):
+    "Calls the WSGI application directly, holding the login cookie"
+
+    def __init__(self, application, project, flush):
+        self.application = application
+        self.project = project
+        self.flush = flush
+        self.cookie = None
+        self.toggle = False
+
+    def call(self, path, fields=None):
+        environ = {}
+        setup_testing_defaults(environ)
+        environ['PATH_INFO'] = path
+        if self.cookie:
+            environ['HTTP_COOKIE'] = self.cookie
+        if fields is not None:
+            body = urlencode(fields).encode('utf-8')
+            environ['REQUEST_METHOD'] = 'POST'
+            environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+            environ['CONTENT_LENGTH'] = str(len(body))
+            environ['wsgi.input'] = io.BytesIO(body)
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+
+        body = b''.join(self.application(environ, start_response))
+        return response['status'], response['headers'], body
+
+    def login(self):
+        "Submits the password, which calls login.request_login to set the cookie"
+        status, headers, body = self.call('/submit_login', {'loginpassword:input_text':'password',
+                                                            'ident':self.project + '_2004'})
+        for key, value in headers:
+            if key.lower() == 'set-cookie' and value.startswith(self.project + '2='):
+                self.cookie = value.split(';')[0]
+                return
+        raise RuntimeError("Login failed")
+
+    def logout(self):
+        self.call('/logout')
+        self.cookie = None
+
+    def request(self, kind):
+        if kind == 'login':
+            self.login()
+            self.logout()
+        elif kind == 'sensors':
+            self.call('/sensors_refresh')
+        elif kind == 'control':
+            self.call('/control_refresh')
+        elif kind == 'toggle':
+            self.toggle = not self.toggle
+            self.call('/outputs/set_output01_json', {'output01:radio_checked':str(self.toggle),
+                                                     'ident':self.project + '_2003'})
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_scenario(client, counter, scenario, requests, rng):
+    "Returns a dictionary of results for the scenario"
+    if scenario == 'mixed':
+        kinds = [kind for kind, weight in MIX for n in range(weight)]
+        plan = [rng.choice(kinds) for n in range(requests)]
+    else:
+        plan = [scenario] * requests
+    if scenario != 'login' and client.cookie is None:
+        client.login()
+    # warm up, so first-call costs are not measured
+    for kind in plan[:max(1, requests//20)]:
+        client.request(kind)
+    latencies = []
+    counter.statements = counter.commits = 0
+    start = time.perf_counter()
+    for kind in plan:
+        t = time.perf_counter()
+        client.request(kind)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    # count the commit of any output values still queued by the write-behind
+    client.flush()
+    statements, commits = counter.statements, counter.commits
+    # a second, shorter pass under tracemalloc, which slows every allocation
+    sample = plan[:max(1, requests//10)]
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    peaks = []
+    for kind in sample:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        client.request(kind)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    net_blocks = sys.getallocatedblocks() - blocks
+    tracemalloc.stop()
+    latencies.sort()
+    return {'requests':requests,
+            'seconds':round(elapsed, 4),
+            'requests_per_second':round(requests / elapsed, 1),
+            'p50_ms':round(percentile(latencies, 0.50) * 1000, 3),
+            'p95_ms':round(percentile(latencies, 0.95) * 1000, 3),
+            'p99_ms':round(percentile(latencies, 0.99) * 1000, 3),
+            'statements_per_request':round(statements / requests, 3),
+            'commits_per_request':round(commits / requests, 3),
+            'peak_kib_per_request':round(sum(peaks) / len(peaks) / 1024, 2),
+            'net_blocks_per_request':round(net_blocks / len(sample), 2)}
+
+
+def check_skis(parser):
+    "Exits with a usage error if the skis project is not beside the pi02 project"
+    skis_code = os.path.join(SKIS_DIR, 'code')
+    if not (os.path.isfile(os.path.join(skis_code, 'skis.py')) or os.path.isdir(os.path.join(skis_code, 'skis'))):
+        parser.error("The skis project was not found at %s, pi02 cannot be served without it. "
+                     "Run the benchmarks from a skipole projectfiles directory holding both pi02 and skis." % (SKIS_DIR,))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=CODE_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return ''
+
+
+def compare(results, previous):
+    "Prints each result beside the previous one"
+    print("\n%-10s %-24s %12s %12s %8s" % ('scenario', 'measure', 'previous', 'current', 'change'))
+    for scenario, current in results['scenarios'].items():
+        before = previous.get('scenarios', {}).get(scenario)
+        if not before:
+            continue
+        for measure, value in current.items():
+            if measure in ('requests', 'seconds') or measure not in before:
+                continue
+            old = before[measure]
+            change = ((value - old) / old * 100) if old else 0.0
+            print("%-10s %-24s %12s %12s %+7.1f%%" % (scenario, measure, old, value, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pi02 WSGI request path in-process")
+    parser.add_argument('--requests', type=int, default=1000, help="requests per scenario")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="comma separated, from %s" % (', '.join(SCENARIOS),))
+    parser.add_argument('--json', help="write results to this file")
+    parser.add_argument('--compare', help="compare with results previously written by --json")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error("Unknown scenario %s" % (name,))
+    check_skis(parser)
+
+    # the simulated backend is selected when picode.hardware is imported
+    os.environ['PI02_GPIO'] = 'simulated'
+    if CODE_DIR not in sys.path:
+        sys.path.insert(0, CODE_DIR)
+
+    with tempfile.TemporaryDirectory() as projectfiles:
+        from picode import database_ops
+        # opening the database here, in the temporary directory, makes the
+        # start_database call made by pi02 on import do nothing
+        database_ops.start_database('pi02', projectfiles)
+        import pi02
+        counter = StatementCounter()
+        database_ops.set_trace_callback(counter)
+        client = Client(pi02.application, pi02.PROJECT, database_ops.flush_outputs)
+        rng = random.Random(args.seed)
+        results = {'revision':git_revision(),
+                   'python':platform.python_version(),
+                   'machine':platform.machine(),
+                   'scenarios':{}}
+        for scenario in scenarios:
+            result = run_scenario(client, counter, scenario, args.requests, rng)
+            results['scenarios'][scenario] = result
+            print("%-8s %8.1f req/s  p50 %7.3f ms  p95 %7.3f ms  p99 %7.3f ms  %5.2f stmts  %5.2f commits  %7.2f KiB" % (
+                  scenario, result['requests_per_second'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                  result['statements_per_request'], result['commits_per_request'], result['peak_kib_per_request']))
+        database_ops.set_trace_callback(None)
+        # shut down before the temporary directory is removed
+        pi02.sessions.flush()
+        pi02.history.stop()
+        database_ops.stop_database()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
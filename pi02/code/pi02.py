@@ -1,7 +1,10 @@
+import os, sys, time, atexit
 
-import os, sys
+# the startup timeline starts here, so the time taken by imports is recorded
+from picode import startup
 
-from skipole import WSGIApplication, FailPage, GoTo, ValidateError, ServerError, set_debug, use_submit_list
+with startup.timeline.phase('import skipole'):
+    from skipole import WSGIApplication, FailPage, GoTo, ValidateError, ServerError, set_debug, use_submit_list
 
 
 # the framework needs to know the location of the projectfiles directory holding this and
@@ -13,43 +16,89 @@ PROJECTFILES = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(
 PROJECT = 'pi02'
 
 
-from picode import control, login, database_ops, hardware
+with startup.timeline.phase('import picode'):
+    from picode import control, login, database_ops, hardware, sessions, events, routes, history, scheduler, rules, timing, metrics
 
 # These pages do not require authentication, any others do
 _PUBLIC_PAGES = [1,  # index
                 10,  # submit_login
                540,  # no_javascript
-              1004   # css
+              1004,  # css
+              1011   # event stream javascript
                ]
 
 # login page 4 is unique - login status is checked, but access is allowed
 
-try:
-    # checks database exists, if not create it
-    database_ops.start_database(PROJECT, PROJECTFILES)
-except:
-    print("Invalid read of database, delete setup directory to revert to defaults")
-    sys.exit(1)
+# the refresh intervals, in seconds, set on the sensors and control pages
+_SENSORS_REFRESH_INTERVAL = 30
+_CONTROL_REFRESH_INTERVAL = 60
 
-# setup hardware
-hardware.initial_setup_outputs()
+# time from start_call to end_call, by the ident of the called responder or page
+_RESPONDER_SECONDS = metrics.Histogram('pi02_responder_seconds', 'Time from start_call to end_call', ('ident',))
 
-# get dictionary of initial start-up output values from database
-output_dict = database_ops.power_up_values()
-if not output_dict:
-    print("Invalid read of database, delete setup directory to revert to defaults")
+try:
+    # checks database exists, if not create it, an existing database is migrated to the current schema
+    with startup.timeline.phase('database'):
+        database_ops.start_database(PROJECT, PROJECTFILES)
+except ServerError as e:
+    print(e.message)
+    sys.exit(1)
+except Exception as e:
+    print("Invalid read of database: %s" % (e,))
     sys.exit(1)
 
-# set the initial start-up values
-control.set_multi_outputs(output_dict)
-
-database_ops.set_message("Service started")
+# the outputs are driven to their power up values before anything else, as until then
+# their state is undefined, the values are read with one query, and stored in one transaction.
+# If the pins are owned by the hardware broker process, it has done this, and this is one
+# of several web worker processes
+with startup.timeline.phase('outputs'):
+    if not hardware.gpio_is_remote():
+        hardware.initial_setup_outputs()
+        output_dict = database_ops.power_up_values()
+        if not output_dict:
+            print("Invalid read of database, no output values found")
+            sys.exit(1)
+        control.set_multi_outputs(output_dict)
+
+with startup.timeline.phase('inputs'):
+    # start the input sampler, which holds a snapshot of input values for page requests
+    hardware.start_sampler()
+    # push input changes to subscribed browsers
+    events.start()
+
+# not needed to serve the first request, these are run in the background once the application is built
+
+if not hardware.gpio_is_remote():
+    # record input readings, with rollups, in the history database
+    startup.timeline.defer('history', history.start, database_ops.database_directory())
+    # run the timed actions held in the database, a hardware broker runs these for all workers
+    startup.timeline.defer('scheduler', scheduler.start)
+    # run the automation rules held in the database on each input change
+    startup.timeline.defer('rules', rules.start)
+# write session last seen times in batches, and remove expired sessions
+startup.timeline.defer('sessions', sessions.start)
+startup.timeline.defer('log message', database_ops.set_message, "Service started", category='system')
+
+# close pooled database connections when the interpreter exits
+atexit.register(database_ops.stop_database)
+# atexit runs functions in the reverse order of registration, so this runs just before
+# stop_database, writing held session last seen times before the pool closes
+atexit.register(sessions.stop)
+atexit.register(history.stop)
+# outputs running a pulse or PWM are left at their power up values, after the scheduler
+# and rules, which may start them, have stopped
+atexit.register(timing.stop)
+# stops timed actions before anything they use is closed
+atexit.register(scheduler.stop)
+atexit.register(rules.stop)
 
 
 def start_call(called_ident, skicall):
     "When a call is initially received this function is called."
     if not called_ident:
         return
+    if metrics.enabled:
+        skicall.call_data['metrics_start'] = (time.perf_counter(), called_ident[1])
     if skicall.environ.get('HTTP_HOST'):
         # This is used in the information page to insert the host into a displayed url
         skicall.call_data['HTTP_HOST'] = skicall.environ['HTTP_HOST']
@@ -64,24 +113,13 @@ def start_call(called_ident, skicall):
         cookie_name = skicall.project + '2'
         if cookie_name in skicall.received_cookies:
             cookie_string = skicall.received_cookies[cookie_name]
-            if cookie_string and (cookie_string != "000"):
-                # so a recognised cookie has arrived, check database_ops to see if the user has logged in
-                con = None
-                try:
-                    access_user = database_ops.get_access_user()
-                    con = database_ops.open_database()
-                    stored_cookie = database_ops.get_cookie(access_user, con)
-                    if stored_cookie == cookie_string:
-                        logged_in = True
-                        # this user is logged in, so update last connect time
-                        database_ops.update_last_connect(access_user, con)
-                except:
-                    pass
-                    # Any exception causes logged_in to remain False
-                finally:
-                    if con:
-                        con.close()
-    skicall.call_data['logged_in'] = logged_in                   
+            # so a recognised cookie has arrived, look up its session by token hash to see if the user
+            # has logged in, this also records the last seen time, without a database write on every request
+            user = sessions.check_token(cookie_string)
+            if user is not None:
+                logged_in = True
+                skicall.call_data['user'] = user
+    skicall.call_data['logged_in'] = logged_in
     if logged_in or called_ident[1] == 4:
         return called_ident
     # not logged in, not page 4, go to home, unless page 4
@@ -98,12 +136,15 @@ def submit_data(skicall):
 
 def end_call(page_ident, page_type, skicall):
     """This function is called at the end of a call prior to filling the returned page with page_data."""
-    # in this example, status is the value on input02
-    status = hardware.get_text_input('input02')
+    # in this example, status is the value on input02, read from the latest input snapshot
+    status = hardware.get_snapshot().values.get('input02')
     if status:
         skicall.page_data['topnav','status', 'para_text'] = status
     else:
         skicall.page_data['topnav','status', 'para_text'] = "Status: input02 unavailable"
+    if 'metrics_start' in skicall.call_data:
+        start, ident = skicall.call_data['metrics_start']
+        _RESPONDER_SECONDS.observe(time.perf_counter() - start, ident)
     return
 
 
@@ -116,13 +157,14 @@ def end_call(page_ident, page_type, skicall):
 
 
 # create the wsgi application
-application = WSGIApplication(project=PROJECT,
-                              projectfiles=PROJECTFILES,
-                              proj_data={},
-                              start_call=start_call,
-                              submit_data=submit_data,
-                              end_call=end_call,
-                              url="/")
+with startup.timeline.phase('skipole application'):
+    application = WSGIApplication(project=PROJECT,
+                                  projectfiles=PROJECTFILES,
+                                  proj_data={},
+                                  start_call=start_call,
+                                  submit_data=submit_data,
+                                  end_call=end_call,
+                                  url="/")
 
 # This creates a WSGI application object. On being created the object uses the projectfiles location to find
 # and load json files which define the project, and also uses the functions :
@@ -135,12 +177,40 @@ application = WSGIApplication(project=PROJECT,
 # The skis application must always be added, without skis you're going nowhere!
 # The skis sub project serves javascript files required by the framework widgets.
 
-skis_code = os.path.join(PROJECTFILES, 'skis', 'code')
-if skis_code not in sys.path:
-    sys.path.append(skis_code)
-import skis
-skis_application = skis.makeapp(PROJECTFILES)
-application.add_project(skis_application, url='/lib')
+with startup.timeline.phase('skis'):
+    skis_code = os.path.join(PROJECTFILES, 'skis', 'code')
+    if skis_code not in sys.path:
+        sys.path.append(skis_code)
+    import skis
+    skis_application = skis.makeapp(PROJECTFILES)
+    application.add_project(skis_application, url='/lib')
+
+# The push event stream, and any other endpoint served outside the skipole framework, is
+# handled by a dispatcher, which passes every other request on to the skipole application
+
+application = routes.Dispatcher(application, PROJECT)
+application.add_route('/api/events', events.event_stream)
+application.add_route('/api/history', history.history_json)
+application.add_route('/api/schedules', scheduler.schedules_json)
+application.add_route('/api/rules', rules.rules_json)
+application.add_route('/api/outputs', control.outputs_json)
+application.add_route('/api/state', control.state_json)
+application.add_route('/api/timing', control.timing_json)
+# the refresh responders are answered 304 Not Modified while the values they show are unchanged,
+# both show the server time, which is not versioned, so their tags also change at the page refresh interval
+application.add_conditional('/sensors_refresh', events.input_version, _SENSORS_REFRESH_INTERVAL)
+application.add_conditional('/control_refresh', events.output_version, _CONTROL_REFRESH_INTERVAL)
+application.add_route('/api/startup', startup.startup_json)
+# automation clients log in and out with JSON, each login is a separate session
+application.add_route('/api/login', login.login_json, protected=False)
+application.add_route('/api/logout', login.logout_json, protected=False)
+# counters and latency histograms, the Prometheus text holds no user data, so may be scraped without a login
+application.add_route('/api/metrics', metrics.metrics_text, protected=False)
+application.add_route('/api/metrics/recent', metrics.metrics_recent)
+
+# the application can now serve requests, and the deferred startup work is started
+startup.timeline.mark_ready()
+startup.timeline.run_deferred()
 
 # The add_project method of application, enables the added sub application
 # to be served at a URL which should extend the URL of the main 'root' application.
@@ -176,13 +246,18 @@ if __name__ == "__main__":
                                                                                   #
     ###############################################################################
 
-    from wsgiref.simple_server import make_server
+    from socketserver import ThreadingMixIn
+    from wsgiref.simple_server import make_server, WSGIServer
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        "A thread per request, so a long lived event stream does not block other requests"
+        daemon_threads = True
 
     # serve the application
     host = "127.0.0.1"
     port = 8000
 
-    httpd = make_server(host, port, application)
+    httpd = make_server(host, port, application, server_class=ThreadingWSGIServer)
     print("Serving %s on port %s. Call http://localhost:%s/skiadmin to edit." % (PROJECT, port, port))
     httpd.serve_forever()
 
@@ -0,0 +1,70 @@
+#######################################################
+#
+# pi02_asgi.py
+# serves pi02 with asyncio, the skipole WSGI application
+# runs on a pool of worker threads, and the event stream
+# on the event loop
+#
+#######################################################
+
+# usage, from the pi02/code directory
+#
+#   python3 pi02_asgi.py --host 0.0.0.0 --port 8000 --workers 8
+#
+# or with any ASGI server, for example
+#
+#   uvicorn pi02_asgi:app
+#
+# The number of worker threads may also be set with the environment variable PI02_WORKERS
+
+
+import os, argparse
+
+import pi02
+
+from picode import asgi, database_ops, events, sessions, history, scheduler, rules, timing
+
+
+def _flush():
+    "Writes pending data, in the order of the atexit functions of pi02, before they close the database"
+    rules.stop()
+    scheduler.stop()
+    # outputs running a pulse or PWM are left at their power up values
+    timing.stop()
+    history.stop()
+    sessions.stop()
+    database_ops.flush_outputs()
+    database_ops.flush_messages()
+
+
+def make_app(workers=None):
+    """Returns the ASGI application, with workers threads running WSGI calls, by default the
+       PI02_WORKERS environment variable, or asgi._WORKERS"""
+    if not workers:
+        workers = _default_workers()
+    asgi_app = asgi.ASGIApplication(pi02.application, workers=workers, logged_in=pi02.application.logged_in)
+    asgi_app.add_route('/api/events', asgi.event_stream_asgi)
+    asgi_app.add_shutdown(_flush)
+    return asgi_app
+
+
+def _default_workers():
+    return int(os.environ.get('PI02_WORKERS', asgi._WORKERS))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serve pi02 with asyncio")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, help="threads running requests, default %s" % (_default_workers(),))
+    args = parser.parse_args()
+    # made once, with the number of workers given
+    app = make_app(args.workers)
+
+    # on shutdown, open event streams are closed, so requests in progress can finish
+    asgi.serve(app, args.host, args.port, on_stop=events.broker.close_all)
+
+else:
+    # the application for an ASGI server
+    app = make_app()
@@ -0,0 +1,105 @@
+#######################################################
+#
+# pi02_broker.py
+# the hardware broker process, which alone owns the GPIO
+# pins, drives the outputs at power up, runs the timed
+# actions and rules and records input history, and serves the
+# pins to pi02 web worker processes over a unix socket
+#
+#######################################################
+
+# usage, from the pi02/code directory, start the broker before the web workers
+#
+#   python3 pi02_broker.py --socket /run/pi02/broker.sock
+#
+# then run any number of web worker processes with the environment variables PI02_GPIO=broker
+# and PI02_BROKER_SOCKET set to the same path, for example
+#
+#   PI02_GPIO=broker PI02_BROKER_SOCKET=/run/pi02/broker.sock gunicorn --workers 4 pi02:application
+#
+# The broker uses RPi.GPIO if installed, or the backend given by --gpio
+
+
+import os, sys, signal, argparse, threading
+
+
+PROJECTFILES = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+PROJECT = 'pi02'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Own the pi02 GPIO pins, and serve them to web workers")
+    parser.add_argument('--socket', help="unix socket path, default PI02_BROKER_SOCKET or /tmp/pi02_broker.sock")
+    parser.add_argument('--gpio', choices=('rpi', 'simulated'), help="GPIO backend, default PI02_GPIO or rpi")
+    args = parser.parse_args()
+
+    # the backend is selected when hardware is imported
+    if args.gpio:
+        os.environ['PI02_GPIO'] = args.gpio
+    if os.environ.get('PI02_GPIO') in ('broker', 'none'):
+        print("The broker needs a GPIO backend, set --gpio")
+        sys.exit(1)
+    if args.socket:
+        os.environ['PI02_BROKER_SOCKET'] = args.socket
+
+    from skipole import ServerError
+    from picode import database_ops, hardware, control, history, scheduler, rules, timing, broker, events
+
+    if hardware.get_backend() is None:
+        print("RPi.GPIO is not installed, set --gpio simulated to run without GPIO pins")
+        sys.exit(1)
+
+    try:
+        database_ops.start_database(PROJECT, PROJECTFILES)
+    except ServerError as e:
+        print(e.message)
+        sys.exit(1)
+
+    # the outputs are driven to their power up values before the web workers connect
+    hardware.initial_setup_outputs()
+    output_dict = database_ops.power_up_values()
+    if not output_dict:
+        print("Invalid read of database, no output values found")
+        sys.exit(1)
+    control.set_multi_outputs(output_dict)
+    # history records the input snapshots read here
+    hardware.start_sampler()
+
+    server = broker.BrokerServer(hardware.get_backend())
+    server.add_pins('output', [oput.BCM for oput in hardware.get_outputs().values() if oput.BCM is not None])
+    server.add_pins('input', [iput.BCM for iput in hardware.get_inputs().values() if iput.BCM is not None])
+    # outputs set by any web worker, or here, are sent to every web worker
+    server.on_publish = events.broker.publish
+    events.broker.add_listener(lambda event: server.notify(event.kind, event.name, event.value))
+    try:
+        server.start()
+    except OSError as e:
+        print(e)
+        sys.exit(1)
+
+    history.start(database_ops.database_directory())
+    scheduler.start()
+    rules.start()
+    database_ops.set_message("Hardware broker started", category='system')
+    print("Hardware broker serving %s" % (server.path,))
+
+    stop_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stop_event.set())
+    while not stop_event.wait(1):
+        pass
+
+    # stop taking requests, then write pending data and release the pins
+    server.stop()
+    rules.stop()
+    scheduler.stop()
+    timing.stop()
+    history.stop()
+    hardware.stop_sampler()
+    database_ops.set_message("Hardware broker stopped", category='system')
+    database_ops.stop_database()
+    hardware.get_backend().cleanup()
+
+
+if __name__ == "__main__":
+    main()
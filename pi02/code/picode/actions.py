@@ -0,0 +1,50 @@
+#######################################################
+#
+# actions.py
+# the actions run by schedules and automation rules,
+# one table shared by the scheduler and the rules
+# engine
+#
+#######################################################
+
+
+from . import database_ops, control
+
+
+# action name : (function, with_category)
+_ACTIONS = {}
+
+
+def register_action(name, function, with_category=False):
+    """Makes function available to schedules and rules as action name, it is called as function(*args).
+       If with_category is True, it is called as function(*args, category=category), category being
+       the log message category of the engine running it, 'scheduler' or 'rules'"""
+    _ACTIONS[name] = (function, with_category)
+
+
+def is_registered(name):
+    return name in _ACTIONS
+
+
+def run(name, args, category):
+    "Calls the action name with args, for the engine with log message category, raises KeyError if unknown"
+    function, with_category = _ACTIONS[name]
+    if with_category:
+        return function(*args, category=category)
+    return function(*args)
+
+
+def _toggle_output(name):
+    "Inverts a boolean output"
+    control._set_output(name, not control._get_output(name))
+
+
+def _message(message, level=database_ops.INFO, category='general'):
+    "Logs a message"
+    database_ops.set_message(message, level=level, category=category)
+
+
+register_action('set_output', control._set_output)
+register_action('toggle_output', _toggle_output)
+register_action('pulse_output', control.pulse_output)
+register_action('message', _message, with_category=True)
@@ -0,0 +1,516 @@
+#######################################################
+#
+# asgi.py
+# an asyncio ASGI front end, running the WSGI
+# application on a pool of worker threads, and long
+# lived endpoints such as the event stream on the
+# event loop, with a small HTTP/1.1 server to run it
+#
+#######################################################
+
+
+import asyncio, io, sys, time, concurrent.futures
+
+from urllib.parse import unquote
+
+from . import events
+
+
+# threads running WSGI calls
+_WORKERS = 8
+
+# the largest request body accepted, in bytes
+_MAX_BODY = 1048576
+
+# the largest request line or header line accepted, in bytes, and the most header lines
+_MAX_LINE = 8192
+_MAX_HEADERS = 100
+
+# seconds an idle keep-alive connection is held open
+_KEEPALIVE_TIMEOUT = 15
+
+# seconds allowed for requests in progress to finish on shutdown
+_SHUTDOWN_TIMEOUT = 10
+
+_REASONS = {200:'OK', 204:'No Content', 304:'Not Modified', 400:'Bad Request', 403:'Forbidden',
+            404:'Not Found', 405:'Method Not Allowed', 411:'Length Required', 413:'Payload Too Large',
+            415:'Unsupported Media Type', 431:'Request Header Fields Too Large',
+            500:'Internal Server Error', 503:'Service Unavailable'}
+
+
+class ASGIApplication(object):
+    """Wraps a WSGI application as an ASGI application. Each WSGI call runs on a bounded
+       thread pool, so a slow call occupies one worker rather than the server. Routes added
+       with add_route are ASGI handlers run on the event loop, for streams held open.
+
+       Functions added with add_shutdown are called, on a worker thread, when the
+       ASGI lifespan shuts down, or when shutdown is called"""
+
+    def __init__(self, wsgi_application, workers=_WORKERS, logged_in=None):
+        self.wsgi_application = wsgi_application
+        self.workers = workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="WSGIWorker")
+        # logged_in(environ) returns True if the request is from a logged in user
+        self.logged_in = logged_in
+        # path : (handler, protected)
+        self._routes = {}
+        self._shutdown_functions = []
+        self._shut_down = False
+        self.wsgi_calls = 0
+
+    def add_route(self, path, handler, protected=True):
+        "handler is an ASGI callable handler(scope, receive, send) called for requests to this exact path"
+        self._routes[path] = (handler, protected)
+
+    def add_shutdown(self, function):
+        self._shutdown_functions.append(function)
+
+    def shutdown(self):
+        "Calls the shutdown functions once, in the order added, and stops the worker threads"
+        if self._shut_down:
+            return
+        self._shut_down = True
+        for function in self._shutdown_functions:
+            try:
+                function()
+            except Exception as e:
+                print("Shutdown function %s failed: %s" % (getattr(function, '__name__', function), e), file=sys.stderr)
+        self.executor.shutdown()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        route = self._routes.get(scope['path'])
+        if route is None:
+            await self._wsgi(scope, receive, send)
+            return
+        handler, protected = route
+        if protected and ((self.logged_in is None) or (not self.logged_in(_cookie_environ(scope)))):
+            await _send_simple(send, 403, b'{"error": "Not logged in"}', b'application/json')
+            return
+        await handler(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type':'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.get_running_loop().run_in_executor(None, self.shutdown)
+                await send({'type':'lifespan.shutdown.complete'})
+                return
+
+    async def _wsgi(self, scope, receive, send):
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > _MAX_BODY:
+                await _send_simple(send, 413, b'Request body too large')
+                return
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                break
+        environ = wsgi_environ(scope, b''.join(chunks))
+        loop = asyncio.get_running_loop()
+        try:
+            status, headers, body = await loop.run_in_executor(self.executor, self._call_wsgi, environ)
+        except RuntimeError:
+            # the executor has been shut down
+            await _send_simple(send, 503, b'Service shutting down')
+            return
+        await send({'type':'http.response.start',
+                    'status':int(status.split(' ', 1)[0]),
+                    'headers':[(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers]})
+        await send({'type':'http.response.body', 'body':body})
+
+    def _call_wsgi(self, environ):
+        "Runs on a worker thread, returns (status, headers, body bytes)"
+        self.wsgi_calls += 1
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [status, headers]
+
+        result = self.wsgi_application(environ, start_response)
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response[0], response[1], body
+
+
+def wsgi_environ(scope, body):
+    "Returns a WSGI environ for the ASGI http scope, and the request body"
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    # WSGI strings are bytes decoded as latin-1, the ASGI path is already decoded from percent escapes
+    path = scope.get('root_path', '') + scope['path']
+    environ = {'REQUEST_METHOD':scope['method'],
+               'SCRIPT_NAME':'',
+               'PATH_INFO':path.encode('utf-8').decode('latin-1'),
+               'QUERY_STRING':scope.get('query_string', b'').decode('latin-1'),
+               'SERVER_NAME':str(server[0]),
+               'SERVER_PORT':str(server[1]),
+               'SERVER_PROTOCOL':'HTTP/%s' % (scope.get('http_version', '1.1'),),
+               'REMOTE_ADDR':str(client[0]),
+               'REMOTE_PORT':str(client[1]),
+               'wsgi.version':(1, 0),
+               'wsgi.url_scheme':scope.get('scheme', 'http'),
+               'wsgi.input':io.BytesIO(body),
+               'wsgi.errors':sys.stderr,
+               'wsgi.multithread':True,
+               'wsgi.multiprocess':False,
+               'wsgi.run_once':False}
+    for key, value in scope.get('headers', []):
+        key = key.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if key == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif key == 'CONTENT_LENGTH':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = 'HTTP_' + key
+            if key in environ:
+                # repeated headers are joined, as a comma separated list
+                environ[key] += ',' + value
+            else:
+                environ[key] = value
+    if body and ('CONTENT_LENGTH' not in environ):
+        environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+def _cookie_environ(scope):
+    "Returns a minimal environ, holding the cookie header, for logged in checks"
+    cookies = [value.decode('latin-1') for key, value in scope.get('headers', []) if key == b'cookie']
+    if not cookies:
+        return {}
+    return {'HTTP_COOKIE':'; '.join(cookies)}
+
+
+async def _send_simple(send, status, body, content_type=b'text/plain'):
+    await send({'type':'http.response.start',
+                'status':status,
+                'headers':[(b'content-type', content_type), (b'content-length', str(len(body)).encode())]})
+    await send({'type':'http.response.body', 'body':body})
+
+
+###  the event stream on the event loop ###
+
+class AsyncSubscription(events.Subscription):
+    """A subscription read from an asyncio event loop, events published from other
+       threads are passed to the loop, to be awaited with get"""
+
+    def __init__(self, loop, maxsize=events._QUEUE_SIZE):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+        self.closed = False
+        self.last_sent = time.monotonic()
+
+    def put(self, event):
+        "Called by the publishing thread, returns False if the queue is full"
+        if self.queue.full():
+            return False
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # the loop is closed
+            return False
+        return True
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.closed = True
+
+    async def get(self, timeout):
+        "Returns the next event, or None if none arrives within timeout seconds"
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return
+
+
+async def event_stream_asgi(scope, receive, send):
+    """ASGI handler streaming events to a browser on the event loop, as events.event_stream
+       does with a thread for each client"""
+    subscription = events.broker.subscribe(AsyncSubscription(asyncio.get_running_loop()))
+
+    async def wait_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        subscription.closed = True
+
+    watcher = asyncio.ensure_future(wait_disconnect())
+    try:
+        await send({'type':'http.response.start',
+                    'status':200,
+                    'headers':[(b'content-type', b'text/event-stream'),
+                               (b'cache-control', b'no-cache'),
+                               (b'x-accel-buffering', b'no')]})
+        for chunk in events._initial_events():
+            await send({'type':'http.response.body', 'body':chunk, 'more_body':True})
+        while not subscription.closed:
+            # a short wait, so a disconnect or shutdown is noticed within a second
+            event = await subscription.get(1)
+            if subscription.closed:
+                break
+            if event is None:
+                if time.monotonic() - subscription.last_sent < events._KEEPALIVE:
+                    continue
+                chunk = b": keepalive\n\n"
+            else:
+                chunk = events.format_event(event)
+            await send({'type':'http.response.body', 'body':chunk, 'more_body':True})
+            subscription.last_sent = time.monotonic()
+        await send({'type':'http.response.body', 'body':b'', 'more_body':False})
+    except OSError:
+        # the client has gone
+        pass
+    finally:
+        watcher.cancel()
+        events.broker.unsubscribe(subscription)
+
+
+###  a small HTTP/1.1 server for the ASGI application ###
+
+class _BadRequest(Exception):
+
+    def __init__(self, status):
+        self.status = status
+
+
+class HTTPServer(object):
+    """Serves an ASGI application over HTTP/1.1 with asyncio, with keep-alive, and chunked
+       responses for streams. Request bodies must have a Content-Length"""
+
+    def __init__(self, app, host='127.0.0.1', port=8000):
+        self.app = app
+        self.host = host
+        self.port = port
+        self._server = None
+        self._connections = set()
+        self._requests = 0
+        self._idle = None
+        self._stopping = False
+        self.served = 0
+
+    async def start(self):
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._server = await asyncio.start_server(self._connection, self.host, self.port, limit=_MAX_LINE)
+
+    async def stop(self, timeout=_SHUTDOWN_TIMEOUT):
+        "Stops accepting connections, and waits up to timeout seconds for requests in progress"
+        self._stopping = True
+        self._server.close()
+        await self._server.wait_closed()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        for writer in list(self._connections):
+            writer.close()
+
+    def _begin(self):
+        self._requests += 1
+        self._idle.clear()
+
+    def _end(self):
+        self._requests -= 1
+        if not self._requests:
+            self._idle.set()
+
+    async def _read_head(self, reader):
+        "Returns (method, target, version, headers) or None at the end of the connection"
+        try:
+            line = await asyncio.wait_for(reader.readline(), _KEEPALIVE_TIMEOUT)
+        except (asyncio.TimeoutError, ValueError, ConnectionError):
+            return
+        if not line:
+            return
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+            raise _BadRequest(400)
+        headers = []
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                raise _BadRequest(431)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= _MAX_HEADERS:
+                raise _BadRequest(431)
+            key, sep, value = line.partition(b':')
+            if not sep:
+                raise _BadRequest(400)
+            headers.append((key.strip().lower(), value.strip()))
+        return parts[0], parts[1], parts[2][5:], headers
+
+    async def _connection(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            while not self._stopping:
+                try:
+                    head = await self._read_head(reader)
+                except _BadRequest as e:
+                    await self._error(writer, e.status)
+                    return
+                if head is None:
+                    return
+                self._begin()
+                try:
+                    keep_alive = await self._request(reader, writer, head)
+                finally:
+                    self._end()
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _error(self, writer, status):
+        body = _REASONS.get(status, '').encode()
+        writer.write(b"HTTP/1.1 %d %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s" % (
+                     status, _REASONS.get(status, '').encode(), len(body), body))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _request(self, reader, writer, head):
+        "Runs one request, returns True if the connection can be kept open"
+        method, target, version, headers = head
+        header_dict = dict(headers)
+        if b'transfer-encoding' in header_dict:
+            await self._error(writer, 411)
+            return False
+        try:
+            length = int(header_dict.get(b'content-length', b'0'))
+        except ValueError:
+            await self._error(writer, 400)
+            return False
+        if length > _MAX_BODY:
+            await self._error(writer, 413)
+            return False
+        body = await reader.readexactly(length) if length else b''
+        connection = header_dict.get(b'connection', b'').lower()
+        keep_alive = (connection != b'close') if version == '1.1' else (connection == b'keep-alive')
+        path, _, query = target.partition('?')
+        peer = writer.get_extra_info('peername') or ('', 0)
+        scope = {'type':'http',
+                 'asgi':{'version':'3.0', 'spec_version':'2.3'},
+                 'http_version':version,
+                 'method':method,
+                 'scheme':'http',
+                 'path':unquote(path),
+                 'raw_path':path.encode('latin-1'),
+                 'query_string':query.encode('latin-1'),
+                 'root_path':'',
+                 'headers':headers,
+                 'client':peer[:2],
+                 'server':(self.host, self.port)}
+        disconnected = asyncio.Event()
+        body_sent = False
+
+        async def receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {'type':'http.request', 'body':body, 'more_body':False}
+            # the request body has been read, so anything more is the client closing,
+            # or the start of a pipelined request, which is not supported
+            if not disconnected.is_set():
+                try:
+                    await reader.read(1)
+                except ConnectionError:
+                    pass
+                disconnected.set()
+            return {'type':'http.disconnect'}
+
+        state = {'started':False, 'chunked':False, 'finished':False}
+
+        async def send(message):
+            if writer.is_closing():
+                raise ConnectionResetError("Client disconnected")
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                response_headers = list(message.get('headers', []))
+                names = {key.lower() for key, value in response_headers}
+                if (b'content-length' not in names) and (status not in (204, 304)) and (method != 'HEAD'):
+                    if version == '1.1':
+                        state['chunked'] = True
+                        response_headers.append((b'transfer-encoding', b'chunked'))
+                    else:
+                        state['close'] = True
+                if not keep_alive or state.get('close'):
+                    response_headers.append((b'connection', b'close'))
+                lines = [b"HTTP/1.1 %d %s" % (status, _REASONS.get(status, '').encode())]
+                lines.extend(key + b": " + value for key, value in response_headers)
+                writer.write(b"\r\n".join(lines) + b"\r\n\r\n")
+                state['started'] = True
+            elif message['type'] == 'http.response.body':
+                chunk = message.get('body', b'')
+                more = message.get('more_body', False)
+                if state['chunked']:
+                    if chunk:
+                        writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    if not more:
+                        writer.write(b"0\r\n\r\n")
+                elif chunk and method != 'HEAD':
+                    writer.write(chunk)
+                if not more:
+                    state['finished'] = True
+                await writer.drain()
+
+        try:
+            await self.app(scope, receive, send)
+        except ConnectionError:
+            return False
+        except Exception as e:
+            print("Request %s %s failed: %s" % (method, target, e), file=sys.stderr)
+            if not state['started']:
+                await self._error(writer, 500)
+            return False
+        self.served += 1
+        if not state['finished']:
+            return False
+        return keep_alive and not state.get('close') and not disconnected.is_set()
+
+
+def serve(app, host='127.0.0.1', port=8000, on_stop=None):
+    """Runs the ASGI application until SIGINT or SIGTERM, then stops accepting connections,
+       calls on_stop, which should end any open streams, waits for requests in progress,
+       and shuts the application down"""
+    import signal
+
+    async def main():
+        server = HTTPServer(app, host, port)
+        await server.start()
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop_event.set)
+        print("Serving on http://%s:%s with %s worker threads" % (host, port, app.workers))
+        await stop_event.wait()
+        if on_stop is not None:
+            on_stop()
+        await server.stop()
+        await loop.run_in_executor(None, app.shutdown)
+
+    asyncio.run(main())
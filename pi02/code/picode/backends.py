@@ -0,0 +1,231 @@
+#######################################################
+#
+# backends.py
+# GPIO backends used by hardware.py, the real RPi.GPIO
+# module, or a simulation for development and load
+# testing on a machine without GPIO pins
+#
+#######################################################
+
+
+import collections, threading, time
+
+
+# edges to detect
+RISING = 'rising'
+FALLING = 'falling'
+BOTH = 'both'
+
+
+class Backend(object):
+    """The interface of a GPIO backend, pins are given by BCM number, and levels as 1 or 0.
+       Edge callbacks are called as callback(bcm), as RPi.GPIO does"""
+
+    name = ''
+
+    def start(self):
+        "Called by hardware.initial_setup_outputs, before any pin is set up"
+        pass
+
+    def setup_output(self, bcm):
+        raise NotImplementedError
+
+    def setup_input(self, bcm, pull_up):
+        raise NotImplementedError
+
+    def input(self, bcm):
+        raise NotImplementedError
+
+    def read_many(self, bcms):
+        "Returns a list of the levels of the pins bcms"
+        return [self.input(bcm) for bcm in bcms]
+
+    def output(self, bcm, level):
+        raise NotImplementedError
+
+    def add_event_detect(self, bcm, edge, callback, bouncetime=None):
+        "bouncetime is in milliseconds, as RPi.GPIO"
+        raise NotImplementedError
+
+    def remove_event_detect(self, bcm):
+        raise NotImplementedError
+
+    def cleanup(self):
+        pass
+
+
+class RPiBackend(Backend):
+    """Uses the RPi.GPIO module, raises ImportError if it is not installed, or RuntimeError
+       if it is imported other than on a Raspberry Pi, or without access to the GPIO memory"""
+
+    name = 'rpi'
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        self._edges = {RISING:GPIO.RISING, FALLING:GPIO.FALLING, BOTH:GPIO.BOTH}
+
+    def start(self):
+        self.GPIO.setmode(self.GPIO.BCM)             # choose BCM or BOARD
+
+    def setup_output(self, bcm):
+        self.GPIO.setup(bcm, self.GPIO.OUT)
+
+    def setup_input(self, bcm, pull_up):
+        if pull_up:
+            self.GPIO.setup(bcm, self.GPIO.IN, pull_up_down = self.GPIO.PUD_UP)
+        else:
+            self.GPIO.setup(bcm, self.GPIO.IN, pull_up_down = self.GPIO.PUD_DOWN)
+
+    def input(self, bcm):
+        return self.GPIO.input(bcm)
+
+    def output(self, bcm, level):
+        self.GPIO.output(bcm, level)
+
+    def add_event_detect(self, bcm, edge, callback, bouncetime=None):
+        if bouncetime:
+            self.GPIO.add_event_detect(bcm, self._edges[edge], callback=callback, bouncetime=bouncetime)
+        else:
+            self.GPIO.add_event_detect(bcm, self._edges[edge], callback=callback)
+
+    def remove_event_detect(self, bcm):
+        self.GPIO.remove_event_detect(bcm)
+
+    def cleanup(self):
+        self.GPIO.cleanup()
+
+
+class SimulatedBackend(Backend):
+    """Simulates GPIO pins in memory. Input levels are set with set_input, pulse or play,
+       and edge callbacks are called immediately in the calling thread, so edges can be
+       injected at thousands per second. Output changes are recorded in trace, a deque of
+       (time.monotonic(), bcm, level) holding the latest trace_length changes"""
+
+    name = 'simulated'
+
+    def __init__(self, trace_length=100000):
+        self._lock = threading.Lock()
+        # bcm : level
+        self.levels = {}
+        # bcm : [edge, callback, bouncetime in seconds, time of last callback]
+        self._detect = {}
+        self.trace = collections.deque(maxlen=trace_length)
+        self.edges_injected = 0
+        self._players = []
+
+    def setup_output(self, bcm):
+        with self._lock:
+            self.levels.setdefault(bcm, 0)
+
+    def setup_input(self, bcm, pull_up):
+        with self._lock:
+            # an unconnected input rests at its pulled level
+            self.levels[bcm] = 1 if pull_up else 0
+
+    def input(self, bcm):
+        return self.levels.get(bcm, 0)
+
+    def output(self, bcm, level):
+        level = 1 if level else 0
+        self.levels[bcm] = level
+        self.trace.append((time.monotonic(), bcm, level))
+
+    def add_event_detect(self, bcm, edge, callback, bouncetime=None):
+        with self._lock:
+            self._detect[bcm] = [edge, callback, (bouncetime or 0)/1000.0, None]
+
+    def remove_event_detect(self, bcm):
+        with self._lock:
+            self._detect.pop(bcm, None)
+
+    def set_input(self, bcm, level):
+        "Sets the input level, calling any edge callback if the level changes"
+        level = 1 if level else 0
+        with self._lock:
+            previous = self.levels.get(bcm, 0)
+            self.levels[bcm] = level
+            if previous == level:
+                return
+            self.edges_injected += 1
+            detect = self._detect.get(bcm)
+            if detect is None:
+                return
+            edge, callback, bouncetime, last = detect
+            if edge == RISING and not level:
+                return
+            if edge == FALLING and level:
+                return
+            now = time.monotonic()
+            if bouncetime and (last is not None) and (now - last < bouncetime):
+                return
+            detect[3] = now
+        callback(bcm)
+
+    def pulse(self, bcm, width=0.0):
+        "Inverts the input level for width seconds, then restores it"
+        level = self.input(bcm)
+        self.set_input(bcm, not level)
+        if width:
+            time.sleep(width)
+        self.set_input(bcm, level)
+
+    def play(self, bcm, waveform, repeat=1):
+        """Plays a waveform on an input in a background thread. waveform is a sequence of
+           (delay, level) with delay in seconds before the level is set, repeat is the number
+           of times to play it, or 0 to repeat until stop_players is called. Returns the thread"""
+        stop_event = threading.Event()
+
+        def player():
+            count = 0
+            while (not repeat) or (count < repeat):
+                for delay, level in waveform:
+                    if delay and stop_event.wait(delay):
+                        return
+                    if stop_event.is_set():
+                        return
+                    self.set_input(bcm, level)
+                count += 1
+
+        thread = threading.Thread(target=player, name="SimulatedInput%s" % (bcm,), daemon=True)
+        thread.stop_event = stop_event
+        self._players.append(thread)
+        thread.start()
+        return thread
+
+    def square_wave(self, bcm, frequency, cycles=0):
+        "Plays a square wave of the given frequency in Hz, for cycles cycles or until stopped if 0"
+        half = 0.5 / frequency
+        return self.play(bcm, [(half, 1), (half, 0)], repeat=cycles)
+
+    def stop_players(self):
+        "Stops all waveforms being played"
+        for thread in self._players:
+            thread.stop_event.set()
+        for thread in self._players:
+            thread.join()
+        self._players = []
+
+    def clear_trace(self):
+        self.trace.clear()
+
+    def cleanup(self):
+        self.stop_players()
+
+
+# backend names accepted by make_backend, and 'broker', which passes calls to the hardware
+# broker process, see broker.py
+BACKENDS = {'rpi':RPiBackend, 'simulated':SimulatedBackend}
+
+
+def make_backend(name):
+    "Returns a new backend of the given name, 'none' returns None, raises ValueError on an unknown name"
+    if name == 'none':
+        return
+    if name == 'broker':
+        # broker.py imports this module
+        from .broker import BrokerBackend
+        return BrokerBackend()
+    if name not in BACKENDS:
+        raise ValueError("Unknown GPIO backend %s" % (name,))
+    return BACKENDS[name]()
@@ -0,0 +1,550 @@
+#######################################################
+#
+# broker.py
+# a hardware broker, the one process owning the GPIO
+# pins, serving reads, writes, snapshots and edge
+# subscriptions to web worker processes over a unix
+# domain socket, and the backend those workers use
+#
+#######################################################
+
+
+import os, json, socket, struct, threading, time, queue
+
+from . import backends
+
+
+# The socket path, which may be set with the environment variable PI02_BROKER_SOCKET
+_SOCKET_PATH = os.environ.get('PI02_BROKER_SOCKET', '/tmp/pi02_broker.sock')
+
+# seconds a client waits for a reply before failing the call
+_REPLY_TIMEOUT = 2.0
+
+
+# Protocol
+#
+# Each frame is a header of opcode (1 byte), payload length (2 bytes) and request id (4 bytes),
+# in network byte order, followed by the payload. A client may send any number of requests
+# without waiting for replies, each reply carries the id of its request, and replies are sent
+# in the order the requests were received. Edge events are sent to subscribed clients at any
+# time, with request id 0, as are notifications of published changes to watching clients.
+
+_HEADER = struct.Struct('!BHI')
+
+# requests, with their payloads
+OP_SETUP_OUTPUT = 1     # bcm
+OP_SETUP_INPUT = 2      # bcm, pull_up
+OP_READ = 3             # bcm                 reply level
+OP_WRITE = 4            # bcm, level
+OP_SNAPSHOT = 5         # none                reply timestamp, then bcm, level of each set up pin
+OP_SUBSCRIBE = 6        # bcm, edge
+OP_UNSUBSCRIBE = 7      # bcm
+OP_PUBLISH = 8          # utf-8 JSON [kind, name, value] of a changed value
+OP_WATCH = 9            # none, the client is sent a notification of each published change
+
+# sent by the broker
+OP_EVENT = 64           # bcm, level, timestamp
+OP_NOTIFY = 65          # utf-8 JSON [kind, name, value]
+OP_OK = 128             # the reply payload, if any
+OP_ERROR = 129          # utf-8 error message
+
+_PIN = struct.Struct('!B')
+_PIN_VALUE = struct.Struct('!BB')
+_TIMESTAMP = struct.Struct('!d')
+_EVENT = struct.Struct('!BBd')
+
+_EDGE_CODES = {backends.BOTH:0, backends.RISING:1, backends.FALLING:2}
+_EDGE_NAMES = {code:edge for edge, code in _EDGE_CODES.items()}
+
+# the largest frame payload
+_MAX_PAYLOAD = 0xFFFF
+
+
+class BrokerError(OSError):
+    "Raised by BrokerBackend when the broker cannot be reached, or refuses a request"
+
+
+def _frame(opcode, request_id, payload=b''):
+    return _HEADER.pack(opcode, len(payload), request_id) + payload
+
+
+def _read_frame(rfile):
+    "Returns (opcode, request_id, payload), or None at the end of the stream"
+    header = rfile.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return
+    opcode, length, request_id = _HEADER.unpack(header)
+    payload = rfile.read(length) if length else b''
+    if len(payload) < length:
+        return
+    return opcode, request_id, payload
+
+
+###############################
+#
+# The broker server
+#
+###############################
+
+
+class _Client(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        # bcm : edge
+        self.subscriptions = {}
+
+    def send(self, data):
+        with self.lock:
+            self.conn.sendall(data)
+
+
+class BrokerServer(object):
+    """Owns the GPIO backend, and serves it to clients connecting to the unix socket at path.
+       Pins are set up once, however many clients ask, and an edge detected on a pin is sent
+       to every client subscribed to it.
+
+       A change published by a client is passed to on_publish(kind, name, value), if set, and
+       notify sends a change to every watching client, so each web worker learns of outputs
+       set by the others, and by the broker process"""
+
+    def __init__(self, backend, path=_SOCKET_PATH):
+        self.backend = backend
+        self.path = path
+        self._lock = threading.Lock()
+        self._clients = []
+        # bcm : 'output' or 'input'
+        self._pins = {}
+        # bcm : list of subscribed _Client
+        self._subscribers = {}
+        # clients sent notifications of published changes
+        self._watchers = []
+        self.on_publish = None
+        self._socket = None
+        self._stop = False
+        self.requests = 0
+        self.events_sent = 0
+        self.notifications_sent = 0
+
+    def start(self):
+        "Listens on the socket, and accepts clients on a background thread"
+        if os.path.exists(self.path):
+            # left by a previous broker, a running broker would accept this connection
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                os.unlink(self.path)
+            else:
+                probe.close()
+                raise BrokerError("A broker is already serving %s" % (self.path,))
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self.path)
+        # web workers run as the same user or group
+        os.chmod(self.path, 0o660)
+        self._socket.listen(16)
+        thread = threading.Thread(target=self._accept, name="BrokerAccept", daemon=True)
+        thread.start()
+
+    def stop(self):
+        "Closes the socket and every client connection"
+        self._stop = True
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _accept(self):
+        while not self._stop:
+            try:
+                conn, address = self._socket.accept()
+            except OSError:
+                return
+            client = _Client(conn)
+            with self._lock:
+                self._clients.append(client)
+            threading.Thread(target=self._serve, args=(client,), name="BrokerClient", daemon=True).start()
+
+    def _serve(self, client):
+        rfile = client.conn.makefile('rb')
+        try:
+            while True:
+                frame = _read_frame(rfile)
+                if frame is None:
+                    break
+                opcode, request_id, payload = frame
+                self.requests += 1
+                try:
+                    reply = _frame(OP_OK, request_id, self._handle(client, opcode, payload))
+                except Exception as e:
+                    reply = _frame(OP_ERROR, request_id, str(e).encode('utf-8')[:1024])
+                client.send(reply)
+        except OSError:
+            pass
+        finally:
+            for bcm in list(client.subscriptions):
+                self._unsubscribe(client, bcm)
+            with self._lock:
+                if client in self._clients:
+                    self._clients.remove(client)
+                if client in self._watchers:
+                    self._watchers.remove(client)
+            rfile.close()
+            client.conn.close()
+
+    def _handle(self, client, opcode, payload):
+        "Carries out a request, returns the reply payload, raises an exception on failure"
+        if opcode == OP_READ:
+            bcm, = _PIN.unpack(payload)
+            return _PIN.pack(1 if self.backend.input(bcm) else 0)
+        if opcode == OP_WRITE:
+            bcm, level = _PIN_VALUE.unpack(payload)
+            if self._pins.get(bcm) != 'output':
+                raise ValueError("Pin %s is not set up as an output" % (bcm,))
+            self.backend.output(bcm, level)
+            return b''
+        if opcode == OP_SNAPSHOT:
+            with self._lock:
+                pins = sorted(self._pins)
+            levels = self.backend.read_many(pins)
+            return _TIMESTAMP.pack(time.time()) + b''.join(_PIN_VALUE.pack(bcm, 1 if level else 0)
+                                                           for bcm, level in zip(pins, levels))
+        if opcode == OP_SETUP_OUTPUT:
+            bcm, = _PIN.unpack(payload)
+            self._setup(bcm, 'output', self.backend.setup_output, bcm)
+            return b''
+        if opcode == OP_SETUP_INPUT:
+            bcm, pull_up = _PIN_VALUE.unpack(payload)
+            self._setup(bcm, 'input', self.backend.setup_input, bcm, bool(pull_up))
+            return b''
+        if opcode == OP_SUBSCRIBE:
+            bcm, edge = _PIN_VALUE.unpack(payload)
+            self._subscribe(client, bcm, _EDGE_NAMES[edge])
+            return b''
+        if opcode == OP_UNSUBSCRIBE:
+            bcm, = _PIN.unpack(payload)
+            self._unsubscribe(client, bcm)
+            return b''
+        if opcode == OP_PUBLISH:
+            kind, name, value = json.loads(payload.decode('utf-8'))
+            if self.on_publish is not None:
+                self.on_publish(kind, name, value)
+            return b''
+        if opcode == OP_WATCH:
+            with self._lock:
+                if client not in self._watchers:
+                    self._watchers.append(client)
+            return b''
+        raise ValueError("Unknown opcode %s" % (opcode,))
+
+    def add_pins(self, mode, bcms):
+        "Records pins already set up by the owning process, mode is 'output' or 'input'"
+        with self._lock:
+            for bcm in bcms:
+                self._pins[bcm] = mode
+
+    def _setup(self, bcm, mode, function, *args):
+        "Sets up a pin the first time it is requested, a pin cannot change between input and output"
+        with self._lock:
+            current = self._pins.get(bcm)
+            if current == mode:
+                return
+            if current is not None:
+                raise ValueError("Pin %s is already set up as an %s" % (bcm, current))
+            function(*args)
+            self._pins[bcm] = mode
+
+    def _subscribe(self, client, bcm, edge):
+        with self._lock:
+            if self._pins.get(bcm) != 'input':
+                raise ValueError("Pin %s is not set up as an input" % (bcm,))
+            client.subscriptions[bcm] = edge
+            subscribers = self._subscribers.setdefault(bcm, [])
+            if client not in subscribers:
+                subscribers.append(client)
+            if len(subscribers) == 1:
+                # the first subscriber to this pin, the broker detects both edges, and
+                # sends each client the edges it asked for
+                self.backend.add_event_detect(bcm, backends.BOTH, self._edge)
+
+    def _unsubscribe(self, client, bcm):
+        with self._lock:
+            client.subscriptions.pop(bcm, None)
+            subscribers = self._subscribers.get(bcm)
+            if (subscribers is None) or (client not in subscribers):
+                return
+            subscribers.remove(client)
+            if not subscribers:
+                del self._subscribers[bcm]
+                self.backend.remove_event_detect(bcm)
+
+    def _edge(self, bcm):
+        "The backend edge callback, sends the event to each subscribed client"
+        level = 1 if self.backend.input(bcm) else 0
+        data = _frame(OP_EVENT, 0, _EVENT.pack(bcm, level, time.time()))
+        with self._lock:
+            subscribers = list(self._subscribers.get(bcm, ()))
+        for client in subscribers:
+            edge = client.subscriptions.get(bcm)
+            if (edge == backends.RISING and not level) or (edge == backends.FALLING and level):
+                continue
+            try:
+                client.send(data)
+                self.events_sent += 1
+            except OSError:
+                # the client has gone, its serving thread removes it
+                pass
+
+    def notify(self, kind, name, value):
+        "Sends a changed value to every watching client"
+        payload = json.dumps([kind, name, value]).encode('utf-8')
+        if len(payload) > _MAX_PAYLOAD:
+            return
+        data = _frame(OP_NOTIFY, 0, payload)
+        with self._lock:
+            watchers = list(self._watchers)
+        for client in watchers:
+            try:
+                client.send(data)
+                self.notifications_sent += 1
+            except OSError:
+                # the client has gone, its serving thread removes it
+                pass
+
+    def stats(self):
+        "Return a dictionary of broker counters"
+        with self._lock:
+            clients = len(self._clients)
+            subscribed_pins = len(self._subscribers)
+            watchers = len(self._watchers)
+        return {'clients':clients,
+                'requests':self.requests,
+                'events_sent':self.events_sent,
+                'subscribed_pins':subscribed_pins,
+                'watchers':watchers,
+                'notifications_sent':self.notifications_sent}
+
+
+###############################
+#
+# The client backend
+#
+###############################
+
+
+class BrokerBackend(backends.Backend):
+    """A GPIO backend, as used by hardware.py, which passes each call to the broker process.
+       Calls from any thread share one connection, which is made on first use, and made again
+       if the broker restarts, when edge subscriptions are sent again. Edge callbacks, and the
+       watch callback, are called on a thread of this backend, as RPi.GPIO calls them on a thread
+       of its own"""
+
+    name = 'broker'
+
+    def __init__(self, path=_SOCKET_PATH, timeout=_REPLY_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._conn = None
+        self._next_id = 0
+        # request id : [threading.Event, opcode, payload]
+        self._pending = {}
+        # bcm : (edge, callback)
+        self._callbacks = {}
+        # callback(kind, name, value) of changes published to the broker
+        self._watcher = None
+        # (opcode, payload) of events and notifications, in order of arrival
+        self._events = queue.SimpleQueue()
+        self._event_thread = None
+        # while a callback runs, holds the (bcm, level) of its event
+        self._local = threading.local()
+        self.reconnects = 0
+
+    def _connect(self):
+        "Connects to the broker, call with the lock held"
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.path)
+        except OSError as e:
+            conn.close()
+            raise BrokerError("Cannot connect to the hardware broker at %s: %s" % (self.path, e))
+        self._conn = conn
+        self.reconnects += 1
+        threading.Thread(target=self._receive, args=(conn,), name="BrokerReceive", daemon=True).start()
+        if self._event_thread is None:
+            self._event_thread = threading.Thread(target=self._dispatch, name="BrokerEvents", daemon=True)
+            self._event_thread.start()
+        # subscriptions of a previous connection are made again, their replies are not awaited
+        for bcm, (edge, callback) in self._callbacks.items():
+            self._next_id += 1
+            conn.sendall(_frame(OP_SUBSCRIBE, self._next_id, _PIN_VALUE.pack(bcm, _EDGE_CODES[edge])))
+        if self._watcher is not None:
+            self._next_id += 1
+            conn.sendall(_frame(OP_WATCH, self._next_id))
+
+    def _receive(self, conn):
+        "Reads replies and events from the broker"
+        rfile = conn.makefile('rb')
+        try:
+            while True:
+                frame = _read_frame(rfile)
+                if frame is None:
+                    break
+                opcode, request_id, payload = frame
+                if opcode in (OP_EVENT, OP_NOTIFY):
+                    self._events.put((opcode, payload))
+                    continue
+                with self._lock:
+                    waiting = self._pending.pop(request_id, None)
+                if waiting is not None:
+                    waiting[1] = opcode
+                    waiting[2] = payload
+                    waiting[0].set()
+        except OSError:
+            pass
+        finally:
+            rfile.close()
+            with self._lock:
+                if self._conn is conn:
+                    self._conn = None
+                # fail the calls waiting on this connection
+                pending = list(self._pending.values())
+                self._pending.clear()
+            for waiting in pending:
+                waiting[1] = OP_ERROR
+                waiting[2] = b'Connection to the hardware broker lost'
+                waiting[0].set()
+            conn.close()
+
+    def _dispatch(self):
+        "Calls the edge callbacks and the watch callback, in order of arrival"
+        while True:
+            opcode, payload = self._events.get()
+            if opcode == OP_NOTIFY:
+                watcher = self._watcher
+                if watcher is None:
+                    continue
+                try:
+                    watcher(*json.loads(payload.decode('utf-8')))
+                except Exception:
+                    pass
+                continue
+            bcm, level, timestamp = _EVENT.unpack(payload)
+            registered = self._callbacks.get(bcm)
+            if registered is None:
+                continue
+            edge, callback = registered
+            if (edge == backends.RISING and not level) or (edge == backends.FALLING and level):
+                continue
+            # a read of the pin within the callback is given the level sent with the
+            # event, rather than making a further request
+            self._local.event = (bcm, level)
+            try:
+                callback(bcm)
+            except Exception:
+                pass
+            finally:
+                self._local.event = None
+
+    def call_many(self, requests):
+        """Sends every request, as (opcode, payload), without waiting between them, then waits for
+           each reply. Returns the list of reply payloads, raises BrokerError on any failure"""
+        waiting = []
+        frames = []
+        with self._lock:
+            if self._conn is None:
+                self._connect()
+            for opcode, payload in requests:
+                self._next_id = (self._next_id % 0xFFFFFFFF) + 1
+                item = [threading.Event(), None, None]
+                self._pending[self._next_id] = item
+                waiting.append(item)
+                frames.append(_frame(opcode, self._next_id, payload))
+            try:
+                self._conn.sendall(b''.join(frames))
+            except OSError as e:
+                raise BrokerError("Cannot send to the hardware broker: %s" % (e,))
+        replies = []
+        for item in waiting:
+            if not item[0].wait(self.timeout):
+                raise BrokerError("The hardware broker did not reply")
+            if item[1] != OP_OK:
+                raise BrokerError(item[2].decode('utf-8', 'replace'))
+            replies.append(item[2])
+        return replies
+
+    def call(self, opcode, payload=b''):
+        "Sends one request, and returns the reply payload"
+        return self.call_many([(opcode, payload)])[0]
+
+    def setup_output(self, bcm):
+        self.call(OP_SETUP_OUTPUT, _PIN.pack(bcm))
+
+    def setup_input(self, bcm, pull_up):
+        self.call(OP_SETUP_INPUT, _PIN_VALUE.pack(bcm, 1 if pull_up else 0))
+
+    def input(self, bcm):
+        event = getattr(self._local, 'event', None)
+        if (event is not None) and (event[0] == bcm):
+            return event[1]
+        return _PIN.unpack(self.call(OP_READ, _PIN.pack(bcm)))[0]
+
+    def read_many(self, bcms):
+        return [_PIN.unpack(reply)[0] for reply in self.call_many([(OP_READ, _PIN.pack(bcm)) for bcm in bcms])]
+
+    def output(self, bcm, level):
+        self.call(OP_WRITE, _PIN_VALUE.pack(bcm, 1 if level else 0))
+
+    def snapshot(self):
+        "Returns (timestamp, {bcm:level}) of every pin set up on the broker, read together"
+        reply = self.call(OP_SNAPSHOT)
+        timestamp, = _TIMESTAMP.unpack_from(reply)
+        levels = {}
+        for offset in range(_TIMESTAMP.size, len(reply), _PIN_VALUE.size):
+            bcm, level = _PIN_VALUE.unpack_from(reply, offset)
+            levels[bcm] = level
+        return timestamp, levels
+
+    def add_event_detect(self, bcm, edge, callback, bouncetime=None):
+        "bouncetime is not supported, inputs are filtered by the hardware input pipeline"
+        self._callbacks[bcm] = (edge, callback)
+        self.call(OP_SUBSCRIBE, _PIN_VALUE.pack(bcm, _EDGE_CODES[edge]))
+
+    def remove_event_detect(self, bcm):
+        self._callbacks.pop(bcm, None)
+        self.call(OP_UNSUBSCRIBE, _PIN.pack(bcm))
+
+    def watch(self, callback):
+        """callback(kind, name, value) is called with each change published to the broker, by
+           any client or by the broker process, including those published by this backend"""
+        self._watcher = callback
+        self.call(OP_WATCH)
+
+    def publish(self, kind, name, value):
+        "Publishes a changed value to the broker, which notifies every watching client"
+        payload = json.dumps([kind, name, value]).encode('utf-8')
+        if len(payload) > _MAX_PAYLOAD:
+            raise BrokerError("The value of %s is too long to publish" % (name,))
+        self.call(OP_PUBLISH, payload)
+
+    def cleanup(self):
+        "Closes the connection, the pins stay as set, as the broker owns them"
+        with self._lock:
+            conn = self._conn
+            self._conn = None
+        if conn is not None:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
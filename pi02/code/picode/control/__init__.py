@@ -1,8 +1,15 @@
-import collections
+import collections, json, time
 
 from skipole import FailPage, GoTo, ValidateError, ServerError
 
-from .. import database_ops, hardware
+from .. import database_ops, hardware, events, routes, timing
+
+
+# the largest request body accepted by the bulk outputs endpoint, in bytes
+_MAX_BODY = 65536
+
+# output name : time.time() when the output was last set by this process
+_output_times = {}
 
 
 def control_page(skicall):
@@ -33,39 +40,70 @@ def set_output_from_browser(skicall):
 
 
 def set_multi_outputs(output_dict):
-    """output_dict is a dictionary of name:value to set"""
+    """output_dict is a dictionary of name:value to set, the values are stored in the database
+       in a single transaction, returns True if they are stored"""
+    values = {}
     for name, value in output_dict.items():
-        _set_output(name, value)
-    
+        valid, value = _apply_output(name, value)
+        if valid:
+            values[name] = value
+    result = database_ops.set_outputs(values)
+    now = time.time()
+    for name, value in values.items():
+        _output_times[name] = now
+        events.publish_output(name, value)
+    return result
+
 
 def _set_output(name, value):
     """Sets an output, given the output name and value"""
+    valid, value = _apply_output(name, value)
+    if not valid:
+        return
+    # Set output value in database, which may be queued and committed shortly afterwards
+    database_ops.set_output(name, value)
+    _output_times[name] = time.time()
+    # and push the change to any browsers subscribed to the event stream
+    events.publish_output(name, value)
+
+
+def _apply_output(name, value):
+    """Converts value to the output type, and sets any hardware output immediately.
+       Returns (True, value) or (False, None) if the name or value is invalid"""
+    valid, value = _convert_output(name, value)
+    if valid and (hardware.get_output_type(name) == 'boolean'):
+        # setting the output ends any pulse or PWM running on it
+        timing.cancel(name, restore=False)
+        hardware.set_boolean_output(name, value)
+    return valid, value
+
+
+def _convert_output(name, value):
+    """Converts value to the output type.
+       Returns (True, value) or (False, None) if the name or value is invalid"""
     output_type = hardware.get_output_type(name)
     if output_type is None:
-        return
+        return False, None
     if output_type == 'boolean':
         if (value == 'True') or (value == 'true') or (value is True):
             value = True
         else:
             value = False
-        hardware.set_boolean_output(name, value)
-    if output_type == 'int':
+    if output_type == 'integer':
         if not isinstance(value, int):
             try:
                 value = int(value)
             except:
                 # Invalid value
-                return
+                return False, None
     if output_type == 'text':
         if not isinstance(value, str):
             try:
                 value = str(value)
             except:
                 # Invalid value
-                return
-        
-    # Set output value in database
-    database_ops.set_output(name, value)
+                return False, None
+    return True, value
 
 
 def _get_output(name):
@@ -78,3 +116,157 @@ def _get_output(name):
             return hardvalue
     # if hardvalue not available, reads the stored output from the database
     return database_ops.get_output(name)
+
+
+def pulse_output(name, seconds, level=True):
+    """Sets boolean output name to level for seconds, then returns it to its stored value,
+       raises ValueError if invalid"""
+    timing.pulse(name, seconds, level)
+
+
+def pwm_output(name, period, duty):
+    """Runs software PWM on boolean output name, on for duty, from 0 to 1, of each period seconds,
+       until the output is set, or stop_output_timing is called, raises ValueError if invalid"""
+    timing.pwm(name, period, duty)
+
+
+def stop_output_timing(name):
+    "Stops any pulse or PWM on the output, returning it to its stored value"
+    return timing.cancel(name)
+
+
+def get_outputs_state():
+    """Returns a dictionary of output name:{'type', 'value', 'timestamp'} for every output, read
+       with one database query, timestamp is when the output was last set, or None if not since startup"""
+    outputs = database_ops.get_all_outputs()
+    state = {}
+    for name, oput in hardware.get_outputs().items():
+        value = outputs[name][0] if name in outputs else None
+        if oput.type == 'boolean':
+            hardvalue = hardware.get_boolean_output(name)
+            if hardvalue is not None:
+                value = hardvalue
+        state[name] = {'type':oput.type, 'value':value, 'timestamp':_output_times.get(name)}
+    return state
+
+
+def get_inputs_state():
+    "Returns a dictionary of input name:{'type', 'value', 'timestamp'} from the latest input snapshot"
+    snapshot = hardware.get_snapshot()
+    inputs = hardware.get_inputs()
+    return {name:{'type':inputs[name].type, 'value':value, 'timestamp':snapshot.timestamp}
+            for name, value in snapshot.values.items()}
+
+
+def _bulk_values(environ):
+    """Reads and validates the body of a bulk outputs request, {"outputs": {name: value, ...}}
+       Returns (values, None) with values a dictionary of converted values, or (None, error) with
+       error a dictionary to return with status 400"""
+    data, error = _read_json(environ)
+    if error:
+        return None, error
+    if (not isinstance(data, dict)) or (not isinstance(data.get('outputs'), dict)) or (not data['outputs']):
+        return None, {'error':'Expected {"outputs": {name: value, ...}}'}
+    outputs = hardware.get_outputs()
+    values = {}
+    invalid = {}
+    for name, value in data['outputs'].items():
+        if name not in outputs:
+            invalid[name] = 'Unknown output'
+            continue
+        # 1 and 0 compare equal to True and False, but are not taken as booleans
+        if (outputs[name].type == 'boolean') and not (isinstance(value, bool) or value in ('True', 'False', 'true', 'false')):
+            invalid[name] = 'Expected a boolean'
+            continue
+        if (outputs[name].type == 'integer') and (isinstance(value, bool) or not isinstance(value, (int, str))):
+            invalid[name] = 'Expected an integer'
+            continue
+        valid, value = _convert_output(name, value)
+        if not valid:
+            invalid[name] = 'Invalid value'
+            continue
+        values[name] = value
+    if invalid:
+        return None, {'error':'Invalid outputs, none have been set', 'invalid':invalid}
+    return values, None
+
+
+def outputs_json(environ, start_response):
+    """WSGI handler for /api/outputs. GET returns every output, a POST with a JSON body
+       {"outputs": {name: value, ...}} sets them all, or none if any is invalid, with
+       the values stored in a single transaction"""
+    method = environ.get('REQUEST_METHOD', 'GET')
+    if method == 'GET':
+        return routes.json_response(start_response, {'outputs':get_outputs_state()})
+    if method != 'POST':
+        return routes.json_response(start_response, {'error':'Method not allowed'}, status='405 Method Not Allowed',
+                                    headers=[('Allow', 'GET, POST')])
+    # a form on another site cannot send this content type
+    if environ.get('CONTENT_TYPE', '').split(';')[0].strip() != 'application/json':
+        return routes.json_response(start_response, {'error':'Content-Type must be application/json'},
+                                    status='415 Unsupported Media Type')
+    values, error = _bulk_values(environ)
+    if error:
+        return routes.json_response(start_response, error, status='400 Bad Request')
+    if not set_multi_outputs(values):
+        return routes.json_response(start_response, {'error':'Access failed - database error'},
+                                    status='500 Internal Server Error')
+    state = get_outputs_state()
+    return routes.json_response(start_response, {'outputs':{name:state[name] for name in values}})
+
+
+def state_json(environ, start_response):
+    "WSGI handler for /api/state, returns every output and input, with timestamps"
+    return routes.json_response(start_response, {'outputs':get_outputs_state(),
+                                                 'inputs':get_inputs_state(),
+                                                 'timestamp':time.time()})
+
+
+def _read_json(environ):
+    "Reads a JSON request body, returns (data, None), or (None, error) with error a dictionary to return with status 400"
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return None, {'error':'Invalid Content-Length'}
+    if (length <= 0) or (length > _MAX_BODY):
+        return None, {'error':'Request body missing, or too large'}
+    try:
+        return json.loads(environ['wsgi.input'].read(length).decode('utf-8')), None
+    except (ValueError, UnicodeDecodeError):
+        return None, {'error':'Invalid JSON'}
+
+
+def timing_json(environ, start_response):
+    """WSGI handler for /api/timing. GET returns the pulse or PWM running on each output, with the
+       lateness of its transitions. A POST with a JSON body {"output": name, "pulse": seconds},
+       optionally with "level": false for an off pulse, {"output": name, "pwm": {"period": seconds,
+       "duty": fraction}} or {"output": name, "stop": true} starts or stops one"""
+    method = environ.get('REQUEST_METHOD', 'GET')
+    if method == 'GET':
+        return routes.json_response(start_response, {'outputs':timing.stats()})
+    if method != 'POST':
+        return routes.json_response(start_response, {'error':'Method not allowed'}, status='405 Method Not Allowed',
+                                    headers=[('Allow', 'GET, POST')])
+    # a form on another site cannot send this content type
+    if environ.get('CONTENT_TYPE', '').split(';')[0].strip() != 'application/json':
+        return routes.json_response(start_response, {'error':'Content-Type must be application/json'},
+                                    status='415 Unsupported Media Type')
+    data, error = _read_json(environ)
+    if error:
+        return routes.json_response(start_response, error, status='400 Bad Request')
+    if (not isinstance(data, dict)) or ('output' not in data):
+        return routes.json_response(start_response, {'error':'Expected {"output": name, ...}'}, status='400 Bad Request')
+    name = data['output']
+    try:
+        if 'pulse' in data:
+            pulse_output(name, data['pulse'], data.get('level', True) is not False)
+        elif isinstance(data.get('pwm'), dict):
+            pwm_output(name, data['pwm'].get('period'), data['pwm'].get('duty'))
+        elif data.get('stop'):
+            stop_output_timing(name)
+        else:
+            return routes.json_response(start_response, {'error':'Expected one of pulse, pwm or stop'},
+                                        status='400 Bad Request')
+    except ValueError as e:
+        return routes.json_response(start_response, {'error':str(e)}, status='400 Bad Request')
+    return routes.json_response(start_response, {'outputs':timing.stats()})
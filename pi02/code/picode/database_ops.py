@@ -8,13 +8,13 @@
 
 
 
-import os, sqlite3, hashlib, random
+import os, sys, sqlite3, hashlib, random, threading, time, collections
 
 from datetime import date, timedelta, datetime
 
 from skipole import FailPage, GoTo, ValidateError, ServerError
 
-from . import hardware
+from . import hardware, passwords, metrics
 
 _OUTPUTS = hardware.get_outputs()
 
@@ -33,9 +33,399 @@ _USERNAME = "admin"
 _PASSWORD = "password"
 
 
-# The number of log messages to retain
+# The number of log messages created with a new database, a later migration removes
+# the trigger keeping this number, and _MESSAGE_RETENTION applies instead
 _N_MESSAGES = 50
 
+# The number of log messages to retain, older messages are deleted in a batch
+# after every _MESSAGE_TRIM_EVERY messages are logged
+_MESSAGE_RETENTION = 5000
+_MESSAGE_TRIM_EVERY = 100
+
+# log message severity levels, as the logging module
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG:'DEBUG', INFO:'INFO', WARNING:'WARNING', ERROR:'ERROR'}
+
+# messages logged without a connection are queued, and written by a background thread in one
+# transaction, _MESSAGE_FLUSH_DELAY seconds after the first arrives, so a burst costs one commit
+_MESSAGE_FLUSH_DELAY = 0.5
+# at most this many messages are queued, when full a WARNING or ERROR message waits up to
+# _MESSAGE_QUEUE_WAIT seconds for room, other messages are dropped and counted
+_MESSAGE_QUEUE_SIZE = 1000
+_MESSAGE_QUEUE_WAIT = 0.1
+
+# Page cache of each connection, negative values are KiB
+_CACHE_SIZE = -4096
+# Bytes of the database file accessed through memory mapping
+_MMAP_SIZE = 16777216
+# Milliseconds a connection waits for a lock held by another, before failing with "database is locked"
+_BUSY_TIMEOUT = 5000
+
+# A pooled connection which has been idle for longer than this number of seconds
+# is checked with a trivial query before being handed out again
+_HEALTH_CHECK_INTERVAL = 60
+
+# the connection pool, created by start_database
+_POOL = None
+
+# 'sync' commits each output value as it is set, 'batched' holds changes for
+# _OUTPUT_FLUSH_DELAY seconds, and commits them in a single transaction
+_OUTPUT_DURABILITY = 'batched'
+_OUTPUT_FLUSH_DELAY = 2.0
+
+# Set the environment variable PI02_DB_WORKING_DIR to a directory on a memory backed filesystem,
+# such as /dev/shm/pi02, to run the working database there rather than on the SD card. The
+# database in the setup directory is then a snapshot of it, written with the sqlite online
+# backup API every _SNAPSHOT_INTERVAL seconds if it has changed, at shutdown, and after every
+# critical change, see _critical_change. PI02_DB_SNAPSHOT_INTERVAL sets the interval
+_WORKING_DIR = os.environ.get('PI02_DB_WORKING_DIR', '')
+_SNAPSHOT_INTERVAL = float(os.environ.get('PI02_DB_SNAPSHOT_INTERVAL', 300))
+
+# the database in the setup directory, which is _DATABASE_PATH unless a working directory is set
+_SNAPSHOT_PATH = ''
+
+# the _Snapshotter, created by start_database if a working directory is set
+_snapshotter = None
+
+
+# metrics, labelled by the database_ops function which ran the statement
+_QUERIES = metrics.Histogram('pi02_db_query_seconds', 'Time executing SQL statements', ('function',))
+_COMMITS = metrics.Histogram('pi02_db_commit_seconds', 'Time committing transactions', ('function',))
+_LOCK_WAITS = metrics.Histogram('pi02_db_write_lock_seconds',
+                                'Time taken by the statement starting a write transaction, mostly waiting for the write lock',
+                                ('function',))
+_LOCKED = metrics.Counter('pi02_db_locked_total', 'Statements failing with database is locked', ('function',))
+_SNAPSHOT_SECONDS = metrics.Histogram('pi02_db_snapshot_seconds', 'Time copying the working database to its snapshot')
+
+
+class _InstrumentedCursor(sqlite3.Cursor):
+    "Times each statement, labelled with the function calling execute on the cursor or its connection"
+
+    def _timed(self, method, sql, parameters):
+        function = sys._getframe(2).f_code.co_name
+        # a statement which starts a write transaction first waits for the write lock
+        starts_write = not self.connection.in_transaction
+        start = time.perf_counter()
+        try:
+            return method(self, sql, parameters)
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e):
+                _LOCKED.inc(function)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            _QUERIES.observe(elapsed, function)
+            if starts_write and self.connection.in_transaction:
+                _LOCK_WAITS.observe(elapsed, function)
+
+    def execute(self, sql, parameters=()):
+        return self._timed(sqlite3.Cursor.execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self._timed(sqlite3.Cursor.executemany, sql, parameters)
+
+
+class _InstrumentedConnection(sqlite3.Connection):
+    "A connection recording metrics, used when metrics are enabled"
+
+    def cursor(self, factory=_InstrumentedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    # the C implementations of these do not call cursor() above
+    def execute(self, sql, parameters=()):
+        return self.cursor()._timed(sqlite3.Cursor.execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor()._timed(sqlite3.Cursor.executemany, sql, parameters)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            sqlite3.Connection.commit(self)
+        finally:
+            _COMMITS.observe(time.perf_counter() - start, sys._getframe(1).f_code.co_name)
+
+
+def _connect(path, **kwargs):
+    "Opens a connection, which records metrics if they are enabled"
+    if metrics.enabled:
+        kwargs['factory'] = _InstrumentedConnection
+    return sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, **kwargs)
+
+
+class ConnectionPool(object):
+    """Holds one long lived sqlite connection for each thread which uses it,
+       so a request pays for statement execution only, rather than a connect
+       and pragma round trip each time a database_ops function is called.
+
+       acquire() and release() calls may be nested within a thread, any transaction
+       left uncommitted is rolled back when the outermost release is made."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # thread ident : (thread, connection)
+        self._connections = {}
+        self.connects = 0
+        self.reuses = 0
+        self.health_failures = 0
+        self.closed = False
+        self._trace_callback = None
+
+    def _connect(self):
+        "Create a new connection"
+        con = _connect(self.path, check_same_thread=False)
+        configure_connection(con)
+        if self._trace_callback is not None:
+            con.set_trace_callback(self._trace_callback)
+        return con
+
+    def set_trace_callback(self, callback):
+        """callback(statement) is called with each SQL statement executed on pooled connections,
+           including BEGIN and COMMIT, None removes it"""
+        with self._lock:
+            self._trace_callback = callback
+            for thread, con in self._connections.values():
+                con.set_trace_callback(callback)
+
+    def _prune(self):
+        "Close connections belonging to threads which have finished, call with lock held"
+        for ident, (thread, con) in list(self._connections.items()):
+            if not thread.is_alive():
+                del self._connections[ident]
+                try:
+                    con.close()
+                except:
+                    pass
+
+    def acquire(self):
+        "Return the connection for this thread, creating it if necessary"
+        if self.closed:
+            raise ServerError(message="Database has been shut down.")
+        local = self._local
+        con = getattr(local, 'con', None)
+        if con is not None:
+            now = time.monotonic()
+            if (not local.depth) and (now - local.checked > _HEALTH_CHECK_INTERVAL):
+                try:
+                    con.execute("select 1").fetchone()
+                    local.checked = now
+                except sqlite3.Error:
+                    self.health_failures += 1
+                    self.discard(con)
+                    con = None
+        if con is not None:
+            local.depth += 1
+            self.reuses += 1
+            return con
+        try:
+            con = self._connect()
+        except:
+            raise ServerError(message="Failed database connection.")
+        thread = threading.current_thread()
+        with self._lock:
+            self._prune()
+            self._connections[thread.ident] = (thread, con)
+            self.connects += 1
+        local.con = con
+        local.depth = 1
+        local.checked = time.monotonic()
+        return con
+
+    def release(self, con):
+        "Release the connection, rolling back any uncommitted transaction on the outermost release"
+        local = self._local
+        if getattr(local, 'con', None) is not con:
+            return
+        local.depth -= 1
+        if local.depth:
+            return
+        try:
+            if con.in_transaction:
+                con.rollback()
+        except sqlite3.Error:
+            self.discard(con)
+
+    def discard(self, con):
+        "Close this thread's connection, a new one will be created on the next acquire"
+        local = self._local
+        if getattr(local, 'con', None) is con:
+            local.con = None
+            local.depth = 0
+        with self._lock:
+            ident = threading.get_ident()
+            if ident in self._connections and self._connections[ident][1] is con:
+                del self._connections[ident]
+        try:
+            con.close()
+        except:
+            pass
+
+    def close_all(self):
+        "Close every pooled connection, called on shutdown"
+        with self._lock:
+            self.closed = True
+            for thread, con in self._connections.values():
+                try:
+                    con.close()
+                except:
+                    pass
+            self._connections.clear()
+
+    def stats(self):
+        "Return a dictionary of pool counters"
+        with self._lock:
+            open_connections = len(self._connections)
+        return {'connects':self.connects,
+                'reuses':self.reuses,
+                'connects_saved':self.reuses,
+                'health_failures':self.health_failures,
+                'open_connections':open_connections}
+
+
+class _Snapshotter(object):
+    """Copies the working database, on a memory backed filesystem, to the snapshot in the setup
+       directory with the sqlite online backup API. The copy is a single transaction on the
+       snapshot, so a power cut during it leaves the previous snapshot intact"""
+
+    def __init__(self, working_path, snapshot_path, interval=_SNAPSHOT_INTERVAL):
+        self.working_path = working_path
+        self.snapshot_path = snapshot_path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._source = None
+        self._token = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.snapshots = 0
+        self.skipped = 0
+        self.failures = 0
+        self.last_snapshot = None
+
+    def _change_token(self):
+        "Returns the modification times of the working database and its write ahead log, which change on every commit"
+        token = []
+        for path in (self.working_path, self.working_path + '-wal'):
+            try:
+                token.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                token.append(None)
+        return tuple(token)
+
+    def snapshot(self, force=False):
+        """Copies the working database to the snapshot, unless force is False and it is unchanged
+           since the last copy, return True on success, False on failure"""
+        with self._lock:
+            try:
+                # opened before the change token is taken, as opening it creates the write ahead log
+                if self._source is None:
+                    self._source = sqlite3.connect(self.working_path, check_same_thread=False)
+                    self._source.execute("select 1 from sqlite_master limit 1")
+            except sqlite3.Error:
+                self.failures += 1
+                return False
+            # taken first, so a change made during the copy is copied next time
+            token = self._change_token()
+            if (not force) and (token == self._token):
+                self.skipped += 1
+                return True
+            start = time.perf_counter()
+            try:
+                dest = sqlite3.connect(self.snapshot_path, timeout=_BUSY_TIMEOUT / 1000)
+                try:
+                    dest.execute("PRAGMA synchronous = FULL")
+                    self._source.backup(dest)
+                finally:
+                    dest.close()
+            except (sqlite3.Error, OSError):
+                self.failures += 1
+                return False
+            _SNAPSHOT_SECONDS.observe(time.perf_counter() - start)
+            self._token = token
+            self.snapshots += 1
+            self.last_snapshot = time.time()
+            return True
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.snapshot()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="DatabaseSnapshot", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        "Stops the periodic snapshots, and takes a final one"
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.snapshot()
+        with self._lock:
+            if self._source is not None:
+                self._source.close()
+                self._source = None
+
+    def stats(self):
+        return {'snapshots':self.snapshots,
+                'skipped':self.skipped,
+                'failures':self.failures,
+                'last_snapshot':self.last_snapshot}
+
+
+def _restore_working(working_path, snapshot_path):
+    """Copies the snapshot to the working database, if the working database does not exist, as after
+       a reboot clears the memory backed filesystem. A working database which survived a crash of the
+       process is newer than the snapshot, and is kept"""
+    if os.path.exists(working_path) or not os.path.exists(snapshot_path):
+        return
+    source = sqlite3.connect(snapshot_path)
+    try:
+        dest = sqlite3.connect(working_path)
+        try:
+            source.backup(dest)
+        finally:
+            dest.close()
+    finally:
+        source.close()
+
+
+def start_snapshots(working_path, snapshot_path):
+    """For a further database kept in the working directory, such as the input history, restores it
+       from snapshot_path if it is missing, and returns a started _Snapshotter copying it back every
+       _SNAPSHOT_INTERVAL seconds if it has changed. Its stop() takes a final snapshot"""
+    _restore_working(working_path, snapshot_path)
+    snapshotter = _Snapshotter(working_path, snapshot_path)
+    snapshotter.start()
+    return snapshotter
+
+
+def _critical_change():
+    """Called after committing a change which must survive a power cut, passwords, users, power up
+       values, schedules and rules, and outputs whose power up value is their last value. If the
+       working database is held in memory, it is copied to the snapshot before returning"""
+    if _snapshotter is not None:
+        _snapshotter.snapshot(force=True)
+
+
+def snapshot_stats():
+    "Returns a dictionary of snapshot counters, empty if the working database is the file in the setup directory"
+    if _snapshotter is None:
+        return {}
+    return _snapshotter.stats()
+
+
+metrics.Gauge('pi02_db_snapshots', 'Copies of the working database to its snapshot',
+              lambda: {(key,):value for key, value in snapshot_stats().items() if key != 'last_snapshot'},
+              labels=('counter',), kind='counter')
+
 
 def get_access_user():
     return _USERNAME
@@ -44,7 +434,9 @@ def get_default_password():
     return _PASSWORD
 
 def hash_password(password, seed=None):
-    "Return (hashed_password, seed) if no seed given, create a random one"
+    """Return (hashed_password, seed) if no seed given, create a random one. This is the original
+       salted SHA-512, used when a database is first created, new passwords are hashed by the
+       passwords module, and this hash is replaced at the first login"""
     if not seed:
         # create seed
         seed = str(random.SystemRandom().randint(1000000, 9999999))
@@ -55,63 +447,224 @@ def hash_password(password, seed=None):
 
 def start_database(project, projectfiles):
     """Must be called first, before any other database operation, to check if database
-       exists, and if not, to create it, and to set globals _DATABASE_PATH and _DATABASE_EXISTS"""
-    global _DATABASE_PATH, _DATABASE_EXISTS
+       exists, and if not, to create it, and to set globals _DATABASE_PATH and _DATABASE_EXISTS.
+       An existing database is brought up to date by applying any outstanding migrations."""
+    global _DATABASE_PATH, _DATABASE_EXISTS, _POOL, _SNAPSHOT_PATH, _snapshotter
     if _DATABASE_EXISTS:
         return
     database_dir = os.path.join(projectfiles, project, _DATABASE_DIR_NAME)
     # Set global variables
-    _DATABASE_PATH = os.path.join(database_dir, _DATABASE_NAME)
-    _DATABASE_EXISTS = True
+    _SNAPSHOT_PATH = os.path.join(database_dir, _DATABASE_NAME)
+    _DATABASE_PATH = _SNAPSHOT_PATH
     # make directory for database
-    try:
-        os.mkdir(database_dir)
-    except FileExistsError:
-        return
-    # create the database
+    os.makedirs(database_dir, exist_ok=True)
+    if _WORKING_DIR:
+        # the working database is held in memory, and the file in the setup directory is its snapshot
+        _DATABASE_PATH = os.path.join(_WORKING_DIR, _DATABASE_NAME)
+        try:
+            os.makedirs(_WORKING_DIR, exist_ok=True)
+            _restore_working(_DATABASE_PATH, _SNAPSHOT_PATH)
+        except (sqlite3.Error, OSError) as e:
+            raise ServerError(message="Unable to restore the working database: %s" % (e,))
+    _DATABASE_EXISTS = True
+    _POOL = ConnectionPool(_DATABASE_PATH)
     con = open_database()
     try:
-        # make access user password
-        con.execute("create table users (username TEXT PRIMARY KEY, seed TEXT, password BLOB, cookie TEXT, last_connect TIMESTAMP)")
-        # make a table for each output type, text, integer and boolean
-        con.execute("create table text_outputs (outputname TEXT PRIMARY KEY, value TEXT, default_on_pwr TEXT, onpower INTEGER)")
-        con.execute("create table integer_outputs (outputname TEXT PRIMARY KEY, value INTEGER, default_on_pwr INTEGER, onpower INTEGER)")
-        con.execute("create table boolean_outputs (outputname TEXT PRIMARY KEY, value INTEGER, default_on_pwr INTEGER, onpower INTEGER)")
-        # create table of log message
-        con.execute("create table messages (mess_id integer primary key autoincrement, message TEXT, time timestamp)")
-        # Create trigger to maintain only n messages
-        n_messages = """CREATE TRIGGER n_messages_only AFTER INSERT ON messages
+        # write ahead logging lets readers continue while a write is in progress, it is
+        # a persistent setting of the database file
+        con.execute("PRAGMA journal_mode = WAL")
+        migrate_database(con)
+        _add_new_outputs(con)
+    finally:
+        con.close()
+    if _WORKING_DIR:
+        _snapshotter = _Snapshotter(_DATABASE_PATH, _SNAPSHOT_PATH)
+        # so the snapshot has any new database, migrations and outputs
+        if not _snapshotter.snapshot(force=True):
+            raise ServerError(message="Unable to write the database snapshot %s" % (_SNAPSHOT_PATH,))
+        _snapshotter.start()
+
+
+###############################
+#
+# Schema migrations
+#
+###############################
+
+# Each migration takes a connection, and is applied within a transaction, after which
+# PRAGMA user_version is set to the migration's position in _MIGRATIONS, counting from one.
+# New migrations are appended to the list, existing ones must never be changed.
+
+
+def _table_exists(con, table):
+    cur = con.execute("select name from sqlite_master where type = 'table' and name = ?", (table,))
+    return cur.fetchone() is not None
+
+
+def _migration_create_tables(con):
+    "Creates the original tables, a database made before versioning already has them"
+    if _table_exists(con, 'users'):
+        return
+    # make access user password
+    con.execute("create table users (username TEXT PRIMARY KEY, seed TEXT, password BLOB, cookie TEXT, last_connect TIMESTAMP)")
+    # make a table for each output type, text, integer and boolean
+    con.execute("create table text_outputs (outputname TEXT PRIMARY KEY, value TEXT, default_on_pwr TEXT, onpower INTEGER)")
+    con.execute("create table integer_outputs (outputname TEXT PRIMARY KEY, value INTEGER, default_on_pwr INTEGER, onpower INTEGER)")
+    con.execute("create table boolean_outputs (outputname TEXT PRIMARY KEY, value INTEGER, default_on_pwr INTEGER, onpower INTEGER)")
+    # create table of log message
+    con.execute("create table messages (mess_id integer primary key autoincrement, message TEXT, time timestamp)")
+    # Create trigger to maintain only n messages
+    n_messages = """CREATE TRIGGER n_messages_only AFTER INSERT ON messages
    BEGIN
      DELETE FROM messages WHERE mess_id <= (SELECT mess_id FROM messages ORDER BY mess_id DESC LIMIT 1 OFFSET %s);
    END;""" % (_N_MESSAGES,)
-        con.execute(n_messages)
-
-        # insert default values
-        now = datetime.utcnow()
-        hashed_password, seed = hash_password(_PASSWORD)
-        con.execute("insert into users (username, seed, password, cookie, last_connect) values (?, ?, ?, ?, ?)", (_USERNAME, seed, hashed_password, "000", now))
-        for name in _OUTPUTS:
-            outputtype, outputvalue, onpower, bcm, description = _OUTPUTS[name]
-            if onpower:
-                onpower = 1
+    con.execute(n_messages)
+
+    # insert default values
+    now = datetime.utcnow()
+    hashed_password, seed = hash_password(_PASSWORD)
+    con.execute("insert into users (username, seed, password, cookie, last_connect) values (?, ?, ?, ?, ?)", (_USERNAME, seed, hashed_password, "000", now))
+    for name in _OUTPUTS:
+        outputtype, outputvalue, onpower, bcm, description = _OUTPUTS[name]
+        if onpower:
+            onpower = 1
+        else:
+            onpower = 0
+        if outputtype == 'text':
+            con.execute("insert into text_outputs (outputname, value, default_on_pwr, onpower) values (?, ?, ?, ?)", (name, outputvalue, outputvalue, onpower))
+        elif outputtype == 'integer':
+            con.execute("insert into integer_outputs (outputname, value, default_on_pwr, onpower) values (?, ?, ?, ?)", (name, outputvalue, outputvalue, onpower))
+        elif outputtype == 'boolean':
+            if outputvalue:
+                con.execute("insert into boolean_outputs (outputname, value, default_on_pwr, onpower) values (?, 1, 1, ?)", (name, onpower))
             else:
-                onpower = 0
-            if outputtype == 'text':
-                con.execute("insert into text_outputs (outputname, value, default_on_pwr, onpower) values (?, ?, ?, ?)", (name, outputvalue, outputvalue, onpower))
-            elif outputtype == 'integer':
-                con.execute("insert into integer_outputs (outputname, value, default_on_pwr, onpower) values (?, ?, ?, ?)", (name, outputvalue, outputvalue, onpower))
-            elif outputtype == 'boolean':
-                if outputvalue:
-                    con.execute("insert into boolean_outputs (outputname, value, default_on_pwr, onpower) values (?, 1, 1, ?)", (name, onpower))
-                else:
-                    con.execute("insert into boolean_outputs (outputname, value, default_on_pwr, onpower) values (?, 0, 0, ?)", (name, onpower))
-
-        # set first log message
-        set_message("New database created", con)
+                con.execute("insert into boolean_outputs (outputname, value, default_on_pwr, onpower) values (?, 0, 0, ?)", (name, onpower))
+
+    # set first log message, with the columns of this version of the table
+    con.execute("insert into messages (message, time) values (?,?)", ("New database created", now))
+
+
+def _migration_message_time_index(con):
+    "Index log messages by time, for retrieving messages within a time range"
+    con.execute("create index if not exists messages_time on messages (time)")
+
+
+def _migration_unified_outputs(con):
+    """Replaces the text_outputs, integer_outputs and boolean_outputs tables with a single
+       outputs table, so all outputs are read with one query"""
+    con.execute("""create table outputs (outputname TEXT PRIMARY KEY, outputtype TEXT, value, default_on_pwr, onpower INTEGER)
+                   without rowid""")
+    for outputtype, table in (('text', 'text_outputs'), ('integer', 'integer_outputs'), ('boolean', 'boolean_outputs')):
+        con.execute("""insert into outputs (outputname, outputtype, value, default_on_pwr, onpower)
+                       select outputname, ?, value, default_on_pwr, onpower from %s""" % (table,), (outputtype,))
+        con.execute("drop table %s" % (table,))
+
+
+def _migration_schedules(con):
+    """Creates the schedules table, holding timed actions run by the scheduler. spec is a cron
+       or interval specification, args a JSON list, and last_run the time of the last run"""
+    con.execute("""create table schedules (name TEXT PRIMARY KEY, spec TEXT, action TEXT, args TEXT,
+                   misfire TEXT, enabled INTEGER, last_run REAL) without rowid""")
+
+
+def _migration_message_levels(con):
+    """Adds a severity level and a category to log messages, with indexes for filtered retrieval,
+       and removes the trigger which deleted an old message on every insert"""
+    con.execute("drop trigger if exists n_messages_only")
+    con.execute("alter table messages add column level INTEGER not null default %d" % (INFO,))
+    con.execute("alter table messages add column category TEXT not null default 'general'")
+    con.execute("create index messages_level on messages (level, mess_id)")
+    con.execute("create index messages_category on messages (category, mess_id)")
+
+
+def _migration_password_kdf(con):
+    """Records the key derivation function, and its cost, of each password hash, an empty
+       string is the original salted SHA-512"""
+    con.execute("alter table users add column kdf TEXT not null default ''")
 
-        con.commit()
-    finally:
-        con.close()
+
+def _migration_sessions(con):
+    """Creates the sessions table, so each user may be logged in from several browsers and clients,
+       the token itself is not stored, only its hash. The users cookie and last_connect columns
+       are no longer used"""
+    con.execute("""create table sessions (token_hash BLOB PRIMARY KEY, username TEXT not null,
+                   created TIMESTAMP, last_seen TIMESTAMP, expires TIMESTAMP) without rowid""")
+    con.execute("create index sessions_expires on sessions (expires)")
+    con.execute("create index sessions_username on sessions (username)")
+    con.execute("update users set cookie = '000'")
+
+
+def _migration_rules(con):
+    "Creates the rules table, holding the automation rules run by the rules engine, definition is JSON"
+    con.execute("create table rules (name TEXT PRIMARY KEY, definition TEXT, enabled INTEGER) without rowid")
+
+
+_MIGRATIONS = [_migration_create_tables,
+               _migration_message_time_index,
+               _migration_unified_outputs,
+               _migration_schedules,
+               _migration_message_levels,
+               _migration_password_kdf,
+               _migration_sessions,
+               _migration_rules]
+
+
+def _add_new_outputs(con):
+    "Inserts any output defined in hardware, but not yet in the database, with its default values"
+    rows = []
+    for name, oput in _OUTPUTS.items():
+        value = _to_database(oput.type, oput.value)
+        rows.append((name, oput.type, value, value, 1 if oput.onpower else 0))
+    con.executemany("""insert or ignore into outputs (outputname, outputtype, value, default_on_pwr, onpower)
+                       values (?, ?, ?, ?, ?)""", rows)
+    con.commit()
+
+
+def database_version(con):
+    "Returns the schema version of the database"
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate_database(con):
+    """Applies each migration not yet applied to the database, each within its own transaction,
+       so a failure leaves the database at the last successful version. Raises ServerError on failure,
+       or if the database is newer than this code"""
+    version = database_version(con)
+    if version > len(_MIGRATIONS):
+        raise ServerError(message="Database version %s is newer than this software." % (version,))
+    for number in range(version+1, len(_MIGRATIONS)+1):
+        migration = _MIGRATIONS[number-1]
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            migration(con)
+            # pragma arguments cannot be bound parameters, number is an integer
+            con.execute("PRAGMA user_version = %d" % (number,))
+            con.commit()
+        except Exception as e:
+            con.rollback()
+            raise ServerError(message="Database migration %s, %s, failed: %s" % (number, migration.__name__, e))
+
+
+def configure_connection(con):
+    """Sets the per connection pragmas, with write ahead logging, synchronous NORMAL only
+       syncs at checkpoints, and a committed transaction survives a crash of the process"""
+    con.execute("PRAGMA foreign_keys = 1")
+    con.execute("PRAGMA synchronous = NORMAL")
+    con.execute("PRAGMA cache_size = %d" % (_CACHE_SIZE,))
+    con.execute("PRAGMA mmap_size = %d" % (_MMAP_SIZE,))
+    con.execute("PRAGMA busy_timeout = %d" % (_BUSY_TIMEOUT,))
+
+
+def database_directory():
+    """Returns the setup directory holding the database, or its snapshot if the working database
+       is held in memory, other data files may be kept beside it"""
+    return os.path.dirname(_SNAPSHOT_PATH)
+
+
+def working_directory():
+    """Returns the directory holding the working database, which is the setup directory unless
+       PI02_DB_WORKING_DIR is set, frequently written data files may be kept beside it"""
+    return os.path.dirname(_DATABASE_PATH)
 
 
 def open_database():
@@ -122,8 +675,8 @@ def open_database():
        raise ServerError(message="Unknown database path.")
     # connect to database
     try:
-        con = sqlite3.connect(_DATABASE_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
-        con.execute("PRAGMA foreign_keys = 1")
+        con = _connect(_DATABASE_PATH)
+        configure_connection(con)
     except:
         raise ServerError(message="Failed database connection.")
     return con
@@ -134,17 +687,60 @@ def close_database(con):
     con.close()
 
 
+def get_connection():
+    """Returns this thread's pooled connection, which must be given back with release_connection
+       rather than closed"""
+    if not _DATABASE_EXISTS:
+        raise ServerError(message="Database does not exist.")
+    return _POOL.acquire()
+
+
+def release_connection(con):
+    "Gives back a connection obtained from get_connection, uncommitted changes are rolled back"
+    _POOL.release(con)
+
+
+def pool_stats():
+    "Returns a dictionary of connection pool counters, including connects_saved"
+    if _POOL is None:
+        return {}
+    return _POOL.stats()
+
+
+metrics.Gauge('pi02_db_pool', 'Connection pool counters', lambda: {(key,):value for key, value in pool_stats().items()},
+              labels=('counter',))
+
+
+def set_trace_callback(callback):
+    "Sets callback(statement) to be called with each statement executed on pooled connections, None removes it"
+    if _POOL is not None:
+        _POOL.set_trace_callback(callback)
+
+
+def stop_database():
+    """Called on shutdown, commits queued output values and log messages, takes a final snapshot
+       of a working database held in memory, and closes pooled connections"""
+    if _POOL is not None:
+        _output_writer.flush()
+        _message_writer.flush()
+        if _snapshotter is not None:
+            _snapshotter.stop()
+        _POOL.close_all()
+
+
 def get_password(user, con=None):
-    "Return (hashed_password, seed) for user, return None on failure"
+    "Return (hashed_password, seed, kdf) for user, return None on failure"
     if (not  _DATABASE_EXISTS) or (not user):
         return
     if con is None:
-        con = open_database()
-        result = get_password(user, con)
-        con.close()
+        con = get_connection()
+        try:
+            result = get_password(user, con)
+        finally:
+            release_connection(con)
     else:
         cur = con.cursor()
-        cur.execute("select password, seed from users where username = ?", (user,))
+        cur.execute("select password, seed, kdf from users where username = ?", (user,))
         result = cur.fetchone()
     return result
 
@@ -155,174 +751,505 @@ def set_password(user, password, con=None):
         return False
     if con is None:
         try:
-            con = open_database()
-            result = set_password(user, password, con)
-            con.close()
-            return result
+            con = get_connection()
+            try:
+                return set_password(user, password, con)
+            finally:
+                release_connection(con)
         except:
             return False
     else:
-        hashed_password, seed = hash_password(password)
         try:
-            con.execute("update users set password = ?, seed=? where username = ?", (hashed_password, seed, user))
+            hashed_password, seed, kdf = passwords.hash_password(password)
+            con.execute("update users set password = ?, seed = ?, kdf = ? where username = ?", (hashed_password, seed, kdf, user))
             con.commit()
         except:
             return False
+        passwords.clear_cache()
+        _critical_change()
     return True
 
 
-def get_cookie(user, con=None):
-    "Return cookie for user, return None on failure"
+def add_user(user, password, con=None):
+    "Return True on success, False on failure, this adds a new user, who may then log in"
     if (not  _DATABASE_EXISTS) or (not user):
-        return
+        return False
     if con is None:
-        con = open_database()
-        cookie = get_cookie(user, con)
-        con.close()
+        try:
+            con = get_connection()
+            try:
+                return add_user(user, password, con)
+            finally:
+                release_connection(con)
+        except:
+            return False
     else:
-        cur = con.cursor()
-        cur.execute("select cookie from users where username = ?", (user,))
-        result = cur.fetchone()
-        if result is None:
-            return
-        cookie = result[0]
-    return cookie
+        try:
+            hashed_password, seed, kdf = passwords.hash_password(password)
+            con.execute("insert into users (username, seed, password, cookie, last_connect, kdf) values (?, ?, ?, ?, ?, ?)",
+                        (user, seed, hashed_password, "000", datetime.utcnow(), kdf))
+            set_message("User %s added" % (user,), con, category='login')
+            con.commit()
+        except:
+            return False
+        _critical_change()
+    return True
 
 
-def set_cookie(user, cookie, con=None):
-    """Return True on success, False on failure, this updates both the cookie and 
-       the last_connect timestamp for an existing user. last_connect is updated because inevitably
-       if a user cookie is set (implying the user has just logged in) then the last_connect should
-       start from that moment. A log message is also created."""
-    if not  _DATABASE_EXISTS:
+def delete_user(user, con=None):
+    "Return True on success, False on failure, this removes the user and all their sessions, the access user cannot be removed"
+    if (not  _DATABASE_EXISTS) or (not user) or (user == _USERNAME):
         return False
     if con is None:
         try:
-            con = open_database()
-            result = set_cookie(user, cookie, con)
-            con.close()
-            return result
+            con = get_connection()
+            try:
+                return delete_user(user, con)
+            finally:
+                release_connection(con)
         except:
             return False
     else:
         try:
-            if cookie == "000":
-                # this logs the user out
-                con.execute("update users set cookie = ? where username = ?", (cookie, user))
-            else:
-                now = datetime.utcnow()
-                con.execute("update users set cookie = ?, last_connect = ? where username = ?", (cookie, now, user))
-                set_message("%s logged in" % (user,), con)
+            con.execute("delete from sessions where username = ?", (user,))
+            con.execute("delete from users where username = ?", (user,))
+            set_message("User %s removed" % (user,), con, category='login')
             con.commit()
         except:
             return False
+        _critical_change()
     return True
 
 
-def get_last_connect(user, con=None):
-    "Return last connection time for user, return None on failure"
-    if (not  _DATABASE_EXISTS) or (not user):
+def get_users(con=None):
+    "Return a list of usernames, return None on failure"
+    if not  _DATABASE_EXISTS:
         return
     if con is None:
-        con = open_database()
-        last_connect = get_last_connect(user, con)
-        con.close()
-    else:
-        cur = con.cursor()
-        cur.execute("select last_connect from users where username = ?", (user,))
-        result = cur.fetchone()
-        if result is None:
-            return
-        last_connect = result[0]
-    return last_connect
+        con = get_connection()
+        try:
+            return get_users(con)
+        finally:
+            release_connection(con)
+    cur = con.execute("select username from users order by username")
+    return [row[0] for row in cur.fetchall()]
 
 
-def set_last_connect(user, last_connect, con=None):
-    "Return True on success, False on failure, this updates an existing user"
+# sessions, each logged in browser or client has a row, found by the hash of its token
+
+def add_session(token_hash, user, created, expires, con=None):
+    "Return True on success, False on failure, this records a new session, and logs the login"
     if not  _DATABASE_EXISTS:
         return False
     if con is None:
         try:
-            con = open_database()
-            result = set_last_connect(user, cookie, con)
-            con.close()
-            return result
+            con = get_connection()
+            try:
+                return add_session(token_hash, user, created, expires, con)
+            finally:
+                release_connection(con)
         except:
             return False
     else:
         try:
-            con.execute("update users set last_connect = ? where username = ?", (last_connect, user))
+            con.execute("insert into sessions (token_hash, username, created, last_seen, expires) values (?, ?, ?, ?, ?)",
+                        (token_hash, user, created, created, expires))
+            set_message("%s logged in" % (user,), con, category='login')
             con.commit()
         except:
             return False
     return True
 
 
-def update_last_connect(user, con=None):
-    "Return True on success, False on failure, this updates an existing user"
+def get_session(token_hash, con=None):
+    "Return (username, created, last_seen, expires) of the session, None if not found"
+    if not  _DATABASE_EXISTS:
+        return
+    if con is None:
+        con = get_connection()
+        try:
+            return get_session(token_hash, con)
+        finally:
+            release_connection(con)
+    cur = con.execute("select username, created, last_seen, expires from sessions where token_hash = ?", (token_hash,))
+    return cur.fetchone()
+
+
+def existing_sessions(token_hashes, con=None):
+    "Return the set of the given token hashes which have a session, return None on failure"
+    if not  _DATABASE_EXISTS:
+        return
+    if con is None:
+        try:
+            con = get_connection()
+            try:
+                return existing_sessions(token_hashes, con)
+            finally:
+                release_connection(con)
+        except:
+            return
+    token_hashes = list(token_hashes)
+    existing = set()
+    # in chunks, within the limit on bound parameters
+    for start in range(0, len(token_hashes), 500):
+        chunk = token_hashes[start:start+500]
+        cur = con.execute("select token_hash from sessions where token_hash in (%s)" % (','.join('?' * len(chunk)),), chunk)
+        existing.update(row[0] for row in cur.fetchall())
+    return existing
+
+
+def delete_session(token_hash, con=None):
+    "Return True on success, False on failure, this ends one session, and logs the logout"
     if not  _DATABASE_EXISTS:
         return False
     if con is None:
         try:
-            con = open_database()
-            result = update_last_connect(user, con)
-            con.close()
-            return result
+            con = get_connection()
+            try:
+                return delete_session(token_hash, con)
+            finally:
+                release_connection(con)
         except:
             return False
     else:
         try:
-            now = datetime.utcnow()
-            con.execute("update users set last_connect = ? where username = ?", (now, user))
+            cur = con.execute("select username from sessions where token_hash = ?", (token_hash,))
+            result = cur.fetchone()
+            if result is not None:
+                con.execute("delete from sessions where token_hash = ?", (token_hash,))
+                set_message("%s logged out" % (result[0],), con, category='login')
             con.commit()
         except:
             return False
     return True
 
 
-# log messages
-
-def set_message(message, con=None):
-    "Return True on success, False on failure, this inserts the message, if con given, does not commit"
-    if (not  _DATABASE_EXISTS) or (not message):
+def delete_user_sessions(user, con=None):
+    "Return True on success, False on failure, this ends every session of the user"
+    if not  _DATABASE_EXISTS:
         return False
     if con is None:
         try:
-            con = open_database()
-            result = set_message(message, con)
-            if result:
-                con.commit()
-            con.close()
+            con = get_connection()
+            try:
+                return delete_user_sessions(user, con)
+            finally:
+                release_connection(con)
         except:
             return False
     else:
         try:
-            con.execute("insert into messages (message, time) values (?,?)", (message, datetime.utcnow()))
+            con.execute("delete from sessions where username = ?", (user,))
+            con.commit()
         except:
             return False
     return True
 
 
-def get_all_messages(con=None):
-    "Return string containing all messages return None on failure"
+def set_sessions_last_seen(last_seen, con=None):
+    """last_seen is a dictionary of token_hash:time last seen, all are written
+       in a single transaction, return True on success, False on failure"""
+    if not  _DATABASE_EXISTS:
+        return False
+    if not last_seen:
+        return True
+    if con is None:
+        try:
+            con = get_connection()
+            try:
+                return set_sessions_last_seen(last_seen, con)
+            finally:
+                release_connection(con)
+        except:
+            return False
+    try:
+        con.executemany("update sessions set last_seen = ? where token_hash = ?",
+                        [(seen, token_hash) for token_hash, seen in last_seen.items()])
+        con.commit()
+    except:
+        return False
+    return True
+
+
+def delete_expired_sessions(now, batch=500, con=None):
+    """Deletes sessions which expired before now, in transactions of at most batch rows, so other
+       writers are not held up, return the number deleted, or None on failure"""
     if not  _DATABASE_EXISTS:
         return
     if con is None:
-        con = open_database()
-        m_string = get_all_messages(con)
-        con.close()
-    else:
-        cur = con.cursor()
-        cur.execute("select message, time from messages order by mess_id DESC")
-        m_string = ''
-        for m in cur:
-            m_string += m[1].strftime("%d %b %Y %H:%M:%S") + "\n" + m[0] + "\n\n"
-    return m_string
+        try:
+            con = get_connection()
+            try:
+                return delete_expired_sessions(now, batch, con)
+            finally:
+                release_connection(con)
+        except:
+            return
+    deleted = 0
+    try:
+        while True:
+            # uses the index on expires
+            cur = con.execute("""delete from sessions where token_hash in
+                                   (select token_hash from sessions where expires < ? limit ?)""", (now, batch))
+            con.commit()
+            deleted += cur.rowcount
+            if cur.rowcount < batch:
+                break
+    except:
+        return
+    return deleted
+
+
+# log messages
+
+class _MessageWriter(object):
+    """Holds log messages, as rows (message, time, level, category), in a bounded queue, and
+       writes them in batched transactions on a background thread, so logging does not
+       wait for a commit"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending = collections.deque()
+        # held while writing, so flush and the writer thread keep messages in order
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.commits = 0
+        # dropped messages not yet reported in the log
+        self._unreported = 0
+        # messages logged since old messages were last deleted
+        self._since_trim = 0
+
+    def put(self, row, wait=False):
+        "Queues a row, return True if queued, False if the queue is full and the row dropped"
+        with self._condition:
+            if len(self._pending) >= _MESSAGE_QUEUE_SIZE:
+                if (not wait) or (not self._condition.wait_for(lambda: len(self._pending) < _MESSAGE_QUEUE_SIZE,
+                                                               _MESSAGE_QUEUE_WAIT)):
+                    self.dropped += 1
+                    self._unreported += 1
+                    return False
+            self._pending.append(row)
+            self.queued += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="MessageWriter", daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending)
+            # gather any burst of messages into the one transaction
+            time.sleep(_MESSAGE_FLUSH_DELAY)
+            self.flush()
+
+    def count(self, number, con):
+        "Counts messages inserted with con, deleting old messages after every _MESSAGE_TRIM_EVERY, does not commit"
+        with self._condition:
+            self._since_trim += number
+            trim = self._since_trim >= _MESSAGE_TRIM_EVERY
+            if trim:
+                self._since_trim = 0
+        if trim:
+            trim_messages(con)
+
+    def flush(self):
+        "Writes queued messages now, return True on success, or if there is nothing to write"
+        with self._write_lock:
+            with self._condition:
+                rows = list(self._pending)
+                self._pending.clear()
+                if self._unreported:
+                    rows.append(("%s log messages dropped, the log queue was full" % (self._unreported,),
+                                 datetime.utcnow(), WARNING, 'system'))
+                    self._unreported = 0
+                # room for any waiting to queue
+                self._condition.notify_all()
+            if not rows:
+                return True
+            try:
+                con = get_connection()
+                try:
+                    con.executemany("insert into messages (message, time, level, category) values (?,?,?,?)", rows)
+                    self.count(len(rows), con)
+                    con.commit()
+                finally:
+                    release_connection(con)
+            except:
+                self.failed += len(rows)
+                self._put_back(rows)
+                return False
+            self.written += len(rows)
+            self.commits += 1
+        return True
+
+    def _put_back(self, rows):
+        """Returns rows which failed to commit to the front of the queue, ahead of any queued since,
+           so the writer thread tries them again. The oldest are dropped if there is not room"""
+        with self._condition:
+            room = max(0, _MESSAGE_QUEUE_SIZE - len(self._pending))
+            if len(rows) > room:
+                lost = len(rows) - room
+                self.dropped += lost
+                self._unreported += lost
+                rows = rows[lost:]
+            self._pending.extendleft(reversed(rows))
+            self._condition.notify_all()
+
+    def stats(self):
+        "Return a dictionary of writer counters"
+        with self._condition:
+            pending = len(self._pending)
+        return {'queued':self.queued,
+                'written':self.written,
+                'dropped':self.dropped,
+                'failed':self.failed,
+                'commits':self.commits,
+                'pending':pending}
+
+
+_message_writer = _MessageWriter()
+
+metrics.Gauge('pi02_log_messages', 'Log message writer counters',
+              lambda: {(key,):value for key, value in _message_writer.stats().items()}, labels=('counter',))
+
+
+def set_message(message, con=None, level=INFO, category='general'):
+    """Return True on success, False on failure. If con is given, this inserts the message within
+       its transaction, and does not commit. Otherwise the message is queued, and written in a batch
+       by the message writer thread, False is returned if the queue is full and the message dropped.
+       Messages beyond _MESSAGE_RETENTION are deleted in batches"""
+    if (not  _DATABASE_EXISTS) or (not message):
+        return False
+    if con is None:
+        return _message_writer.put((message, datetime.utcnow(), level, category), wait=level >= WARNING)
+    try:
+        con.execute("insert into messages (message, time, level, category) values (?,?,?,?)",
+                    (message, datetime.utcnow(), level, category))
+        _message_writer.count(1, con)
+    except:
+        return False
+    return True
+
+
+def flush_messages():
+    "Writes any queued log messages now, return True on success"
+    return _message_writer.flush()
+
+
+def trim_messages(con):
+    "Deletes messages older than the newest _MESSAGE_RETENTION, does not commit"
+    # mess_id is autoincrement, so the newest messages have the highest ids
+    con.execute("delete from messages where mess_id <= (select max(mess_id) from messages) - ?", (_MESSAGE_RETENTION,))
+
+
+def get_messages(limit=100, level=None, category=None, since=None, until=None, before=None, con=None):
+    """Return a list of (mess_id, time, level, category, message), newest first, return None on failure.
+       level is the minimum level, since and until are datetimes in UTC, and before a mess_id, given to
+       retrieve the page of messages older than the last mess_id of a previous call"""
+    if not  _DATABASE_EXISTS:
+        return
+    if con is None:
+        # so messages just logged are included
+        _message_writer.flush()
+        try:
+            con = get_connection()
+            try:
+                return get_messages(limit, level, category, since, until, before, con)
+            finally:
+                release_connection(con)
+        except:
+            return
+    conditions = []
+    parameters = []
+    if level is not None:
+        conditions.append("level >= ?")
+        parameters.append(level)
+    if category is not None:
+        conditions.append("category = ?")
+        parameters.append(category)
+    if since is not None:
+        conditions.append("time >= ?")
+        parameters.append(since)
+    if until is not None:
+        conditions.append("time <= ?")
+        parameters.append(until)
+    if before is not None:
+        conditions.append("mess_id < ?")
+        parameters.append(before)
+    query = "select mess_id, time, level, category, message from messages"
+    if conditions:
+        query += " where " + " and ".join(conditions)
+    query += " order by mess_id DESC limit ?"
+    parameters.append(limit)
+    try:
+        return con.execute(query, parameters).fetchall()
+    except:
+        return
+
+
+def format_messages(messages):
+    "Return a string of the messages, as given by get_messages, for display"
+    return "".join("%s %s %s\n%s\n\n" % (m[1].strftime("%d %b %Y %H:%M:%S"), LEVEL_NAMES.get(m[2], m[2]), m[3], m[4])
+                   for m in messages)
+
+
+def get_all_messages(con=None):
+    "Return string containing all messages return None on failure"
+    messages = get_messages(_MESSAGE_RETENTION, con=con)
+    if messages is None:
+        return
+    return format_messages(messages)
 
 
 # controlling outputs
 
 
+def _to_database(outputtype, value):
+    "Converts an output value to the value stored, booleans are stored as 1 or 0"
+    if outputtype == 'boolean':
+        return 1 if value else 0
+    return value
+
+
+def _from_database(outputtype, value):
+    "Converts a stored value to the output value"
+    if outputtype == 'boolean':
+        return bool(value)
+    return value
+
+
+def get_all_outputs(con=None):
+    """Return a dictionary of outputname:(value, default_on_pwr, onpower) for every output,
+       read with a single query, return an empty dictionary on failure"""
+    if not  _DATABASE_EXISTS:
+        return {}
+    if con is None:
+        con = get_connection()
+        try:
+            outputs = get_all_outputs(con)
+        finally:
+            release_connection(con)
+        # values waiting to be committed are the current ones
+        for name, value in _output_writer.pending().items():
+            if name in outputs:
+                outputs[name] = (_from_database(_OUTPUTS[name].type, value),) + outputs[name][1:]
+        return outputs
+    outputs = {}
+    cur = con.execute("select outputname, value, default_on_pwr, onpower from outputs")
+    for name, value, default_on_pwr, onpower in cur:
+        if name not in _OUTPUTS:
+            continue
+        outputtype = _OUTPUTS[name].type
+        outputs[name] = (_from_database(outputtype, value), _from_database(outputtype, default_on_pwr), bool(onpower))
+    return outputs
+
+
 def get_output(name, con=None):
     "Return output value for given name, return None on failure"
     if name not in _OUTPUTS:
@@ -330,69 +1257,168 @@ def get_output(name, con=None):
     if not  _DATABASE_EXISTS:
         return
     if con is None:
-        con = open_database()
-        outputvalue = get_output(name, con)
-        con.close()
-    else:
-        outputtype = _OUTPUTS[name][0]
-        cur = con.cursor()
-        if outputtype == 'text':
-            cur.execute("select value from text_outputs where outputname = ?", (name,))
-            result = cur.fetchone()
-            if result is None:
-                return
-            outputvalue = result[0]
-        elif outputtype == 'integer':
-            cur.execute("select value from integer_outputs where outputname = ?", (name,))
-            result = cur.fetchone()
-            if result is None:
-                return
-            outputvalue = result[0]
-        elif outputtype == 'boolean':
-            cur.execute("select value from boolean_outputs where outputname = ?", (name,))
-            result = cur.fetchone()
-            if result is None:
-                return
-            outputvalue = bool(result[0])
-        else:
-            return
-    return outputvalue
+        # a value waiting to be committed is the current one
+        pending, outputvalue = _output_writer.get(name)
+        if pending:
+            return _from_database(_OUTPUTS[name].type, outputvalue)
+        con = get_connection()
+        try:
+            return get_output(name, con)
+        finally:
+            release_connection(con)
+    cur = con.execute("select value from outputs where outputname = ?", (name,))
+    result = cur.fetchone()
+    if result is None:
+        return
+    return _from_database(_OUTPUTS[name].type, result[0])
 
 
 def set_output(name, value, con=None):
-    "Return True on success, False on failure, this updates an existing output in the database"
+    """Return True on success, False on failure, this updates an existing output in the database.
+       If con is not given, and the output durability is 'batched', the value is queued and
+       committed with any other pending output values shortly afterwards"""
     if name not in _OUTPUTS:
         return False
     if not  _DATABASE_EXISTS:
         return False
+    if (con is None) and (_OUTPUT_DURABILITY == 'batched'):
+        _output_writer.put(name, value)
+        return True
+    return set_outputs({name:value}, con)
+
+
+def set_outputs(output_dict, con=None):
+    """output_dict is a dictionary of name:value, all are written in a single transaction,
+       return True on success, False on failure"""
+    if not  _DATABASE_EXISTS:
+        return False
+    if any(name not in _OUTPUTS for name in output_dict):
+        return False
     if con is None:
-        try:
-            con = open_database()
-            result = set_output(name, value, con)
-            con.close()
-            return result
-        except:
-            return False
-    else:
-        outputtype = _OUTPUTS[name][0]
-        try:
-            if outputtype == 'text':
-                con.execute("update text_outputs set value = ? where outputname = ?", (value, name))
-            elif outputtype == 'integer':
-                con.execute("update integer_outputs set value = ? where outputname = ?", (value, name))
-            elif outputtype == 'boolean':
-                if value:
-                    con.execute("update boolean_outputs set value = 1 where outputname = ?", (name,))
-                else:
-                    con.execute("update boolean_outputs set value = 0 where outputname = ?", (name,))
-            else:
+        # waits for any flush in progress, which may be committing older values of these outputs,
+        # and removes queued older values, so neither can be committed later over these
+        with _output_writer.write_lock:
+            _output_writer.discard(output_dict)
+            try:
+                con = get_connection()
+                try:
+                    return set_outputs(output_dict, con)
+                finally:
+                    release_connection(con)
+            except:
                 return False
-            con.commit()
-        except:
-            return False
+    rows = [(_to_database(_OUTPUTS[name].type, value), name) for name, value in output_dict.items()]
+    try:
+        con.executemany("update outputs set value = ? where outputname = ?", rows)
+        con.commit()
+        # an output which powers up at its last value needs that value to survive a power cut
+        critical = (_snapshotter is not None) and con.execute(
+            "select 1 from outputs where onpower = 0 and outputname in (%s) limit 1" % (','.join('?' * len(rows)),),
+            [name for value, name in rows]).fetchone()
+    except:
+        return False
+    if critical:
+        _critical_change()
     return True
 
 
+class _OutputWriter(object):
+    """Holds output values set while durability is 'batched', only the latest value for
+       each name is kept, and all are committed together _OUTPUT_FLUSH_DELAY seconds
+       after the first change, so rapid toggling costs one commit"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # held while values are committed, by a flush and by set_outputs, so a flush cannot
+        # commit a value older than one written directly while it was in progress
+        self.write_lock = threading.Lock()
+        # name : value
+        self._pending = {}
+        self._timer = None
+        self.queued = 0
+        self.commits = 0
+
+    def put(self, name, value):
+        with self._lock:
+            self._pending[name] = value
+            self.queued += 1
+            if self._timer is None:
+                self._timer = threading.Timer(_OUTPUT_FLUSH_DELAY, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def pending(self):
+        "Returns a dictionary of the values waiting to be committed"
+        with self._lock:
+            return dict(self._pending)
+
+    def get(self, name):
+        "Returns (True, value) if a value is pending for name, otherwise (False, None)"
+        with self._lock:
+            if name in self._pending:
+                return True, self._pending[name]
+        return False, None
+
+    def discard(self, names):
+        "Removes any pending values for names, which are being written directly"
+        with self._lock:
+            for name in names:
+                self._pending.pop(name, None)
+
+    def flush(self):
+        "Commits pending values, return True on success, or if there is nothing to commit"
+        with self.write_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                pending = self._pending
+                self._pending = {}
+            if not pending:
+                return True
+            try:
+                con = get_connection()
+                try:
+                    # given a connection, set_outputs does not discard values queued since
+                    stored = set_outputs(pending, con)
+                finally:
+                    release_connection(con)
+            except:
+                stored = False
+            if stored:
+                self.commits += 1
+                return True
+            # keep the values, unless newer ones have arrived, and try again later, a direct
+            # write waiting for the write lock discards them once it is released
+            with self._lock:
+                for name, value in pending.items():
+                    self._pending.setdefault(name, value)
+                if self._timer is None:
+                    self._timer = threading.Timer(_OUTPUT_FLUSH_DELAY, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        return False
+
+
+_output_writer = _OutputWriter()
+
+
+def set_output_durability(mode):
+    """mode is 'sync' to commit each output value as it is set, or 'batched' to queue
+       values and commit them together, changing to 'sync' flushes any queued values"""
+    global _OUTPUT_DURABILITY
+    if mode not in ('sync', 'batched'):
+        raise ValueError("Output durability must be 'sync' or 'batched'")
+    _OUTPUT_DURABILITY = mode
+    if mode == 'sync':
+        _output_writer.flush()
+
+
+def flush_outputs():
+    "Commits any queued output values now, return True on success"
+    return _output_writer.flush()
+
+
 def power_up_values():
     """Check database exists, if not, return an empty dictionary.
         If it does, return a dictionary of outputnames:values from the database
@@ -400,39 +1426,12 @@ def power_up_values():
         or last saved values if onpower is False"""
     if not _DATABASE_EXISTS:
         return {}
-    # so database exists, for each output, get its value
-    bool_tuple = (name for name in _OUTPUTS if _OUTPUTS[name][0] == 'boolean')
-    int_tuple =  (name for name in _OUTPUTS if _OUTPUTS[name][0] == 'integer')
-    text_tuple = (name for name in _OUTPUTS if _OUTPUTS[name][0] == 'text')
     outputdict = {}
-    con = open_database()
-    cur = con.cursor()
-    # read values
-    for name in bool_tuple:
-        cur.execute("select value,  default_on_pwr, onpower from boolean_outputs where outputname = ?", (name,))
-        result = cur.fetchone()
-        if result is not None:
-            if result[2]:
-                outputdict[name] = bool(result[1])
-            else:
-                outputdict[name] = bool(result[0])
-    for name in int_tuple:
-        cur.execute("select value,  default_on_pwr, onpower from integer_outputs where outputname = ?", (name,))
-        result = cur.fetchone()
-        if result is not None:
-            if result[2]:
-                outputdict[name] = result[1]
-            else:
-                outputdict[name] = result[0]
-    for name in text_tuple:
-        cur.execute("select value,  default_on_pwr, onpower from text_outputs where outputname = ?", (name,))
-        result = cur.fetchone()
-        if result is not None:
-            if result[2]:
-                outputdict[name] = result[1]
-            else:
-                outputdict[name] = result[0]
-    con.close()
+    for name, (value, default_on_pwr, onpower) in get_all_outputs().items():
+        if onpower:
+            outputdict[name] = default_on_pwr
+        else:
+            outputdict[name] = value
     return outputdict
 
 
@@ -446,68 +1445,211 @@ def get_power_values(name):
     if not _DATABASE_EXISTS:
         return ()
     # so database exists
-    con = open_database()
-    cur = con.cursor()
-    if _OUTPUTS[name][0] == 'boolean':
-        cur.execute("select default_on_pwr, onpower from boolean_outputs where outputname = ?", (name,))
-        result = cur.fetchone()
-        if result is None:
-            out = ()
-        else:
-            out = (bool(result[0]), bool(result[1]))
-    elif _OUTPUTS[name][0] == 'integer':
-        cur.execute("select default_on_pwr, onpower from integer_outputs where outputname = ?", (name,))
-        result = cur.fetchone()
-        if result is None:
-            out = ()
-        else:
-            out = (result[0], bool(result[1]))
-    elif _OUTPUTS[name][0] == 'text':
-        cur.execute("select default_on_pwr, onpower from text_outputs where outputname = ?", (name,))
+    con = get_connection()
+    try:
+        cur = con.execute("select default_on_pwr, onpower from outputs where outputname = ?", (name,))
         result = cur.fetchone()
-        if result is None:
-            out = ()
-        else:
-            out = (result[0], bool(result[1]))
-    else:
-        out = ()
-    con.close()
-    return out
+    finally:
+        release_connection(con)
+    if result is None:
+        return ()
+    return (_from_database(_OUTPUTS[name].type, result[0]), bool(result[1]))
 
 
 def set_power_values(name, default_on_pwr, onpower, con=None):
     "Return True on success, False on failure, this updates a name output power-up values"
     if name not in _OUTPUTS:
         return False
+    return set_multi_power_values({name:(default_on_pwr, onpower)}, con)
+
+
+def set_multi_power_values(power_dict, con=None):
+    """power_dict is a dictionary of outputname:(default_on_pwr, onpower), all are written
+       in a single transaction, return True on success, False on failure"""
     if not  _DATABASE_EXISTS:
         return False
+    if any(name not in _OUTPUTS for name in power_dict):
+        return False
     if con is None:
         try:
-            con = open_database()
-            result = set_power_values(name, default_on_pwr, onpower, con)
-            con.close()
-            return result
+            con = get_connection()
+            try:
+                return set_multi_power_values(power_dict, con)
+            finally:
+                release_connection(con)
         except:
             return False
-    else:
+    rows = []
+    for name, (default_on_pwr, onpower) in power_dict.items():
+        rows.append((_to_database(_OUTPUTS[name].type, default_on_pwr), 1 if onpower else 0, name))
+    try:
+        con.executemany("update outputs set default_on_pwr = ?,  onpower = ? where outputname= ?", rows)
+        con.commit()
+    except:
+        return False
+    _critical_change()
+    return True
+
+
+# schedules
+
+def get_schedules(con=None):
+    """Return a list of (name, spec, action, args, misfire, enabled, last_run) for every schedule,
+       return None on failure"""
+    if not  _DATABASE_EXISTS:
+        return
+    if con is None:
         try:
-            if onpower:
-                onpower = 1
-            else:
-                onpower = 0
-            if _OUTPUTS[name][0] == 'boolean':
-                if default_on_pwr:
-                    default_on_pwr = 1
-                else:
-                    default_on_pwr = 0
-                con.execute("update boolean_outputs set default_on_pwr = ?,  onpower = ? where outputname= ?", (default_on_pwr, onpower, name))
-            elif _OUTPUTS[name][0] == 'integer':
-                con.execute("update integer_outputs set default_on_pwr = ?,  onpower = ? where outputname= ?", (default_on_pwr, onpower, name))
-            elif _OUTPUTS[name][0] == 'text':
-                con.execute("update text_outputs set default_on_pwr = ?,  onpower = ? where outputname= ?", (default_on_pwr, onpower, name))
-            con.commit()
+            con = get_connection()
+            try:
+                return get_schedules(con)
+            finally:
+                release_connection(con)
+        except:
+            return
+    try:
+        cur = con.execute("select name, spec, action, args, misfire, enabled, last_run from schedules")
+        return [(name, spec, action, args, misfire, bool(enabled), last_run)
+                for name, spec, action, args, misfire, enabled, last_run in cur]
+    except:
+        return
+
+
+def set_schedule(name, spec, action, args, misfire, enabled, con=None):
+    "Return True on success, False on failure, this inserts or replaces a schedule, args is a JSON string"
+    if not  _DATABASE_EXISTS:
+        return False
+    if con is None:
+        try:
+            con = get_connection()
+            try:
+                return set_schedule(name, spec, action, args, misfire, enabled, con)
+            finally:
+                release_connection(con)
+        except:
+            return False
+    try:
+        # last_run of an existing schedule is kept
+        con.execute("""insert into schedules (name, spec, action, args, misfire, enabled) values (?, ?, ?, ?, ?, ?)
+                       on conflict (name) do update set spec = excluded.spec, action = excluded.action,
+                       args = excluded.args, misfire = excluded.misfire, enabled = excluded.enabled""",
+                    (name, spec, action, args, misfire, 1 if enabled else 0))
+        con.commit()
+    except:
+        return False
+    _critical_change()
+    return True
+
+
+def delete_schedule(name, con=None):
+    "Return True on success, False on failure"
+    if not  _DATABASE_EXISTS:
+        return False
+    if con is None:
+        try:
+            con = get_connection()
+            try:
+                return delete_schedule(name, con)
+            finally:
+                release_connection(con)
+        except:
+            return False
+    try:
+        con.execute("delete from schedules where name = ?", (name,))
+        con.commit()
+    except:
+        return False
+    _critical_change()
+    return True
+
+
+def set_schedule_last_runs(last_runs, con=None):
+    """last_runs is a dictionary of schedule name:time of last run, all are written
+       in a single transaction, return True on success, False on failure"""
+    if not  _DATABASE_EXISTS:
+        return False
+    if not last_runs:
+        return True
+    if con is None:
+        try:
+            con = get_connection()
+            try:
+                return set_schedule_last_runs(last_runs, con)
+            finally:
+                release_connection(con)
         except:
             return False
+    try:
+        con.executemany("update schedules set last_run = ? where name = ?",
+                        [(last_run, name) for name, last_run in last_runs.items()])
+        con.commit()
+    except:
+        return False
     return True
 
 
+# rules
+
+def get_rules(con=None):
+    "Return a list of (name, definition, enabled) for every rule, return None on failure"
+    if not  _DATABASE_EXISTS:
+        return
+    if con is None:
+        try:
+            con = get_connection()
+            try:
+                return get_rules(con)
+            finally:
+                release_connection(con)
+        except:
+            return
+    try:
+        cur = con.execute("select name, definition, enabled from rules")
+        return [(name, definition, bool(enabled)) for name, definition, enabled in cur]
+    except:
+        return
+
+
+def set_rule(name, definition, enabled, con=None):
+    "Return True on success, False on failure, this inserts or replaces a rule, definition is a JSON string"
+    if not  _DATABASE_EXISTS:
+        return False
+    if con is None:
+        try:
+            con = get_connection()
+            try:
+                return set_rule(name, definition, enabled, con)
+            finally:
+                release_connection(con)
+        except:
+            return False
+    try:
+        con.execute("insert or replace into rules (name, definition, enabled) values (?, ?, ?)",
+                    (name, definition, 1 if enabled else 0))
+        con.commit()
+    except:
+        return False
+    _critical_change()
+    return True
+
+
+def delete_rule(name, con=None):
+    "Return True on success, False on failure"
+    if not  _DATABASE_EXISTS:
+        return False
+    if con is None:
+        try:
+            con = get_connection()
+            try:
+                return delete_rule(name, con)
+            finally:
+                release_connection(con)
+        except:
+            return False
+    try:
+        con.execute("delete from rules where name = ?", (name,))
+        con.commit()
+    except:
+        return False
+    _critical_change()
+    return True
@@ -0,0 +1,239 @@
+#######################################################
+#
+# events.py
+# pushes input and output changes to browsers as
+# Server-Sent Events, replacing interval polling
+#
+#######################################################
+
+
+import json, queue, threading, time, uuid
+
+from collections import namedtuple
+
+from . import hardware
+
+
+# The number of events held for each subscriber, a subscriber whose queue
+# is full is dropped rather than stall the publisher
+_QUEUE_SIZE = 100
+
+# seconds between keepalive comments sent on an idle stream
+_KEEPALIVE = 15
+
+
+Event = namedtuple('Event', ['id', 'kind', 'name', 'value', 'timestamp'])
+
+
+class Subscription(object):
+    "Holds the bounded queue of events waiting to be sent to one client"
+
+    def __init__(self, maxsize=_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize)
+        self.closed = False
+
+    def put(self, event):
+        "Returns False if the queue is full"
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            return False
+        return True
+
+    def get(self, timeout):
+        "Returns the next event, or None if none arrives within timeout seconds"
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+
+
+class EventBroker(object):
+    """Fans out input and output changes to any number of subscribers. Only changes are
+       published, a value equal to the last one published for the same name is ignored"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        # functions called with each event, outside the lock
+        self._listeners = []
+        # (kind, name) : value
+        self._last = {}
+        self._next_id = 0
+        # kind : id of the latest event of that kind
+        self._versions = {}
+        # distinguishes versions of this process from those before a restart
+        self.epoch = uuid.uuid4().hex[:8]
+        self.published = 0
+        self.dropped_subscribers = 0
+
+    def subscribe(self, subscription=None):
+        if subscription is None:
+            subscription = Subscription()
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def add_listener(self, function):
+        "function(event) is called, on the publishing thread, with each published change"
+        self._listeners.append(function)
+
+    def unsubscribe(self, subscription):
+        subscription.closed = True
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def close_all(self):
+        "Closes every subscription, ending their streams, used on shutdown"
+        with self._lock:
+            for sub in self._subscribers:
+                sub.closed = True
+            self._subscribers = set()
+
+    def current_values(self):
+        "Returns a list of (kind, name, value) for every value published so far"
+        with self._lock:
+            return [(kind, name, value) for (kind, name), value in self._last.items()]
+
+    def version(self, kind):
+        "Returns the id of the latest event of this kind, which increases whenever a value of the kind changes"
+        return self._versions.get(kind, 0)
+
+    def publish(self, kind, name, value, versioned=True):
+        """kind is 'input' or 'output', returns the Event, or None if the value is unchanged.
+           If versioned is False the change is sent to subscribers, but the version of the kind is unchanged"""
+        with self._lock:
+            key = (kind, name)
+            if (key in self._last) and (self._last[key] == value):
+                return
+            self._last[key] = value
+            self._next_id += 1
+            if versioned:
+                self._versions[kind] = self._next_id
+            event = Event(self._next_id, kind, name, value, time.time())
+            self.published += 1
+            slow = [sub for sub in self._subscribers if not sub.put(event)]
+            for sub in slow:
+                sub.closed = True
+                self._subscribers.discard(sub)
+                self.dropped_subscribers += 1
+        for function in self._listeners:
+            function(event)
+        return event
+
+
+broker = EventBroker()
+
+_started = False
+
+# with the pins owned by the hardware broker process, its backend, through which output changes
+# are published to the broker, which notifies every web worker, so each knows of outputs set by
+# the others, and by the scheduler, rules and timed pulses running in the broker
+_remote = None
+
+# text inputs, such as the server time on input02, change on every sample, so if they
+# changed the input version a conditional /sensors_refresh would never be answered 304,
+# instead the tag of a refresh showing them also changes at the page refresh interval
+_UNVERSIONED_INPUTS = frozenset(name for name, iput in hardware.get_inputs().items() if iput.type == 'text')
+
+
+def publish_output(name, value):
+    "Called whenever an output is set"
+    broker.publish('output', name, value)
+    if _remote is not None:
+        try:
+            _remote.publish('output', name, value)
+        except OSError:
+            # the broker is not running, output changes of other workers are also missed
+            pass
+
+
+def _remote_changed(kind, name, value):
+    "Called by the broker backend with each change published to the hardware broker"
+    # published here directly, not sent back to the broker, an unchanged value is ignored
+    broker.publish(kind, name, value)
+
+
+def _sample_listener(snapshot):
+    "Called by the input sampler with each new snapshot"
+    for name, value in snapshot.values.items():
+        broker.publish('input', name, value, versioned=name not in _UNVERSIONED_INPUTS)
+
+
+def _edge_callback(event):
+    "Called by the input pipeline on an input edge, publishing the change without waiting for the sampler"
+    broker.publish('input', event.name, event.level)
+
+
+def start():
+    "Feeds the broker from the input sampler and the input event pipeline"
+    global _started, _remote
+    if _started:
+        return
+    _started = True
+    if hardware.gpio_is_remote():
+        _remote = hardware.get_backend()
+        try:
+            _remote.watch(_remote_changed)
+        except OSError:
+            # the watch is made when the backend connects to the broker
+            pass
+    hardware.add_sample_listener(_sample_listener)
+    hardware.input_pipeline.subscribe(_edge_callback)
+    hardware.input_pipeline.start()
+
+
+def input_version():
+    "Returns the version of the input values, or None if input changes are not being published"
+    if not _started:
+        return
+    return broker.version('input')
+
+
+def output_version():
+    "Returns the version of the output values, which are published whenever they are set"
+    return broker.version('output')
+
+
+def format_event(event):
+    "Returns the event as Server-Sent Event bytes"
+    data = json.dumps({'kind':event.kind, 'name':event.name, 'value':event.value, 'timestamp':event.timestamp})
+    return ("id: %s\nevent: %s\ndata: %s\n\n" % (event.id, event.kind, data)).encode('utf-8')
+
+
+def event_stream(environ, start_response):
+    """WSGI handler streaming events to a browser. The current values are sent first,
+       followed by each change as it occurs. A dropped, slow client ends the stream, and
+       the browser EventSource then reconnects, receiving current values again"""
+    start_response('200 OK', [('Content-Type', 'text/event-stream'),
+                              ('Cache-Control', 'no-cache'),
+                              ('X-Accel-Buffering', 'no')])
+    return _stream()
+
+
+def _stream():
+    subscription = broker.subscribe()
+    try:
+        yield from _initial_events()
+        while not subscription.closed:
+            event = subscription.get(_KEEPALIVE)
+            if subscription.closed:
+                break
+            if event is None:
+                yield b": keepalive\n\n"
+            else:
+                yield format_event(event)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+def _initial_events():
+    "Yields Server-Sent Event bytes starting a stream, with the current values"
+    yield b"retry: 2000\n\n"
+    for kind, name, value in broker.current_values():
+        data = json.dumps({'kind':kind, 'name':name, 'value':value, 'timestamp':time.time()})
+        yield ("event: %s\ndata: %s\n\n" % (kind, data)).encode('utf-8')
@@ -38,33 +38,117 @@ _INPUTS = {"input01" : Input('boolean', True, 23, "Input pin BCM 23"),
           }
 
 
+# _INPUT_FILTERS
 
-import time
+# This dictionary has keys boolean input names, and values being an InputFilter(debounce, glitch)
+# debounce is the minimum time in seconds between accepted edges, further edges within it are ignored
+# glitch is the time in seconds a new level must persist to be accepted, 0 to accept it immediately
+# inputs not listed here are not filtered
 
-# import RPi.GPIO
-_gpio_control = True
-try:
-    import RPi.GPIO as GPIO            # import RPi.GPIO module  
-except:
-    _gpio_control = False
+InputFilter = namedtuple('InputFilter', ['debounce', 'glitch'])
+
+_INPUT_FILTERS = {"input01" : InputFilter(0.3, 0.005)}
+
+
+
+import os, time, threading, collections, concurrent.futures
+
+from types import MappingProxyType
+
+from . import backends, metrics
+
+
+# The GPIO backend is chosen by the environment variable PI02_GPIO, one of 'rpi', 'simulated',
+# 'broker' or 'none'. If it is not set, RPi.GPIO is used if installed, otherwise there is no GPIO
+# control and boolean inputs and outputs read as None. With 'broker' the pins are owned by the
+# hardware broker process, pi02_broker.py, so several web worker processes may share them.
+
+_backend = None
+
+
+def select_backend(name=None):
+    """Selects the GPIO backend, call before initial_setup_outputs. name is 'rpi', 'simulated',
+       'none', or None for the default described above. Returns the backend, or None"""
+    global _backend
+    if name is None:
+        name = os.environ.get('PI02_GPIO')
+    if name is None:
+        try:
+            _backend = backends.RPiBackend()
+        except (ImportError, RuntimeError):
+            # not installed, or not running on a Raspberry Pi with access to the pins
+            _backend = None
+    else:
+        _backend = backends.make_backend(name)
+    return _backend
+
+
+def get_backend():
+    "Returns the GPIO backend in use, or None"
+    return _backend
+
+
+def gpio_is_remote():
+    """Returns True if the pins are owned by the hardware broker process, which then sets them
+       up, drives the outputs at power up, and runs the scheduler and history recording"""
+    return (_backend is not None) and (_backend.name == 'broker')
+
+
+select_backend()
+
+
+_GPIO_SECONDS = metrics.Histogram('pi02_gpio_seconds', 'Time taken by GPIO pin reads and writes', ('operation',))
+_EDGES = metrics.Counter('pi02_input_edges_total', 'Edges captured from each input, before filtering',
+                         ('input',), recent=True)
+_DELIVERY_SECONDS = metrics.Histogram('pi02_input_delivery_seconds',
+                                      'Time from an input edge to its delivery to a subscriber')
+_LISTEN_SECONDS = metrics.Histogram('pi02_listen_callback_seconds', 'Time taken by Listen callbacks', ('input',))
+
+
+def _read(bcm):
+    "Reads a pin of the backend, timed if metrics are enabled"
+    if not metrics.enabled:
+        return _backend.input(bcm)
+    start = time.perf_counter()
+    level = _backend.input(bcm)
+    _GPIO_SECONDS.observe(time.perf_counter() - start, 'read')
+    return level
+
+
+def _read_many(bcms):
+    "Reads several pins of the backend, timed as one read if metrics are enabled"
+    if not metrics.enabled:
+        return _backend.read_many(bcms)
+    start = time.perf_counter()
+    levels = _backend.read_many(bcms)
+    _GPIO_SECONDS.observe(time.perf_counter() - start, 'read')
+    return levels
+
+
+def _write(bcm, level):
+    "Sets a pin of the backend, timed if metrics are enabled"
+    if not metrics.enabled:
+        _backend.output(bcm, level)
+        return
+    start = time.perf_counter()
+    _backend.output(bcm, level)
+    _GPIO_SECONDS.observe(time.perf_counter() - start, 'write')
 
 
 def initial_setup_outputs():
     "Returns True if successfull, False if not"
-    if not _gpio_control:
+    if _backend is None:
         return False
-    GPIO.setmode(GPIO.BCM)             # choose BCM or BOARD
+    _backend.start()
     for oput in _OUTPUTS.values():
         # set outputs
         if oput.BCM is not None: 
-            GPIO.setup(oput.BCM, GPIO.OUT)
+            _backend.setup_output(oput.BCM)
     for iput in _INPUTS.values():
         # set inputs
         if iput.BCM is not None:
-            if iput.pud:
-                GPIO.setup(iput.BCM, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-            else:
-                GPIO.setup(iput.BCM, GPIO.IN, pull_up_down = GPIO.PUD_DOWN)
+            _backend.setup_input(iput.BCM, iput.pud)
+    return True
 
 
 def get_output_names():
@@ -99,28 +183,28 @@ def get_output_type(name):
 
 
 def get_boolean_output(name):
-    "Given an output name, return True or False for the state of the output, or None if name not found, or not boolean, or _gpio_control is False"
-    if not _gpio_control:
+    "Given an output name, return True or False for the state of the output, or None if name not found, or not boolean, or there is no GPIO backend"
+    if _backend is None:
         return
     if name not in _OUTPUTS:
         return
     if _OUTPUTS[name].type != 'boolean':
         return
-    return bool(GPIO.input(_OUTPUTS[name].BCM))
+    return bool(_read(_OUTPUTS[name].BCM))
 
 
 def set_boolean_output(name, value):
     "Given an output name, sets the output pin"
-    if not _gpio_control:
+    if _backend is None:
         return
     if name not in _OUTPUTS:
         return
     if _OUTPUTS[name].type != 'boolean':
         return
     if value:
-        GPIO.output(_OUTPUTS[name].BCM, 1)
+        _write(_OUTPUTS[name].BCM, 1)
     else:
-        GPIO.output(_OUTPUTS[name].BCM, 0)
+        _write(_OUTPUTS[name].BCM, 0)
 
 
 
@@ -158,14 +242,14 @@ def get_input_type(name):
 
 
 def get_boolean_input(name):
-    "Given an input name, return True or False for the state of the input, or None if name not found, or not boolean, or _gpio_control is False"
-    if not _gpio_control:
+    "Given an input name, return True or False for the state of the input, or None if name not found, or not boolean, or there is no GPIO backend"
+    if _backend is None:
         return
     if name not in _INPUTS:
         return
     if _INPUTS[name].type != 'boolean':
         return
-    return bool(GPIO.input(_INPUTS[name].BCM))
+    return bool(_read(_INPUTS[name].BCM))
 
 
 def get_text_input(name):
@@ -192,13 +276,360 @@ def get_float_input(name):
 
 
 
+# The input sampler reads every input at this interval, in seconds, holding the results
+# as a snapshot so page requests never read hardware themselves
+
+_SAMPLE_INTERVAL = 1.0
+
+
+# values is a read only mapping of input name to value, timestamp the time.time() when the
+# inputs were read, and sequence a number incremented with each sample
+
+Snapshot = namedtuple('Snapshot', ['values', 'timestamp', 'sequence'])
+
+_sampler = None
+_snapshot = None
+
+# functions called with each new snapshot, by the sampler thread
+_sample_listeners = []
+
+
+def read_inputs():
+    "Reads every input, returns a dictionary of input name to value"
+    values = {}
+    # the boolean pins are read together, in one round trip to a broker
+    pins = [(name, iput.BCM) for name, iput in _INPUTS.items() if (iput.type == 'boolean') and (iput.BCM is not None)]
+    levels = {}
+    if (_backend is not None) and pins:
+        levels = dict(zip((name for name, bcm in pins), _read_many([bcm for name, bcm in pins])))
+    for name, iput in _INPUTS.items():
+        if iput.type == 'boolean':
+            values[name] = bool(levels[name]) if name in levels else None
+        elif iput.type == 'text':
+            values[name] = get_text_input(name)
+        elif iput.type == 'float':
+            values[name] = get_float_input(name)
+        else:
+            values[name] = None
+    return values
+
+
+class InputSampler(threading.Thread):
+    """A daemon thread which reads all inputs every interval seconds, and sets
+       the latest Snapshot, available from get_snapshot()"""
+
+    def __init__(self, interval=_SAMPLE_INTERVAL):
+        threading.Thread.__init__(self, name="InputSampler", daemon=True)
+        self.interval = interval
+        self.sequence = 0
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        "Reads the inputs and sets a new snapshot"
+        global _snapshot
+        values = read_inputs()
+        self.sequence += 1
+        _snapshot = Snapshot(MappingProxyType(values), time.time(), self.sequence)
+        for listener in _sample_listeners:
+            try:
+                listener(_snapshot)
+            except Exception:
+                pass
+
+    def run(self):
+        next_sample = time.monotonic()
+        while True:
+            try:
+                self.sample()
+            except Exception:
+                # keep the last good snapshot, and try again next interval
+                pass
+            next_sample += self.interval
+            delay = next_sample - time.monotonic()
+            if delay < 0:
+                # running late, so do not attempt to catch up
+                next_sample = time.monotonic()
+                delay = 0
+            if self._stop_event.wait(delay):
+                break
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def start_sampler(interval=_SAMPLE_INTERVAL):
+    "Starts the input sampler thread, if not already running, and takes an initial sample"
+    global _sampler
+    if _sampler is not None:
+        return _sampler
+    _sampler = InputSampler(interval)
+    _sampler.sample()
+    _sampler.start()
+    return _sampler
+
+
+def stop_sampler():
+    "Stops the input sampler thread"
+    global _sampler
+    if _sampler is None:
+        return
+    _sampler.stop()
+    _sampler.join()
+    _sampler = None
+
+
+def add_sample_listener(listener):
+    """listener(snapshot) will be called by the sampler thread with each new snapshot,
+       it should return quickly, as the next sample waits for it"""
+    if listener not in _sample_listeners:
+        _sample_listeners.append(listener)
+
+
+def remove_sample_listener(listener):
+    "Stops calling listener, a new list is made so a sample in progress is not disturbed"
+    global _sample_listeners
+    _sample_listeners = [item for item in _sample_listeners if item is not listener]
+
+
+def get_snapshot():
+    """Returns the latest Snapshot of all inputs. If the sampler is not running, the
+       inputs are read now, so the result is always current"""
+    snapshot = _snapshot
+    if (_sampler is None) or (snapshot is None):
+        return Snapshot(MappingProxyType(read_inputs()), time.time(), 0)
+    return snapshot
+
+
+# maps BCM number to input name, for the edge callback
+_BCM_TO_NAME = {iput.BCM:name for name, iput in _INPUTS.items() if iput.BCM is not None}
+
+
 def get_input_name(bcm):
     "Given a bcm number, returns the name"
-    if bcm is None:
-        return
-    for name, iput in _INPUTS.items():
-        if iput.BCM == bcm:
-            return name
+    return _BCM_TO_NAME.get(bcm)
+
+
+###  input event pipeline ###
+
+# Edges on boolean inputs are captured by the GPIO backend callback into a ring buffer, which
+# does no more than read the level and append it. A dispatcher thread drains the buffer, applies
+# the debounce and glitch filters of _INPUT_FILTERS, coalesces edges of the same input received
+# together into a single event, and hands events to subscribers on a thread pool, so a slow
+# subscriber never delays edge capture.
+
+# the number of edges held in the ring buffer, when full the oldest is dropped
+_RING_SIZE = 1024
+
+# threads delivering events to subscribers
+_DISPATCH_WORKERS = 4
+
+# level is the input level as True or False, timestamp is time.time(), and edges is the
+# number of accepted edges this event stands for
+InputEvent = namedtuple('InputEvent', ['name', 'level', 'timestamp', 'edges'])
+
+
+class InputPipeline(object):
+
+    def __init__(self, ring_size=_RING_SIZE, workers=_DISPATCH_WORKERS):
+        # appends and pops of a deque are atomic, so the capture callback takes no lock
+        self._ring = collections.deque(maxlen=ring_size)
+        self._ring_size = ring_size
+        self._wake = threading.Event()
+        self._stop = False
+        self._thread = None
+        self._executor = None
+        self._workers = workers
+        # list of [callback, names, edge]
+        self._subscribers = []
+        # name : (level, monotonic time) of the last accepted edge, time None for the starting level
+        self._accepted = {}
+        # name : monotonic time at which a debounced input is to be read again
+        self._settle = {}
+        # name : (level, monotonic time, timestamp, deadline) of an edge to be accepted if the
+        # input still holds level when read again at deadline
+        self._glitch = {}
+        self.captured = 0
+        self.dropped = 0
+        self.debounced = 0
+        self.glitches = 0
+        self.coalesced = 0
+        self.delivered = 0
+        self.subscriber_errors = 0
+
+    def _capture(self, bcm):
+        "The GPIO backend callback, keep this short"
+        if len(self._ring) >= self._ring_size:
+            self.dropped += 1
+        self._ring.append((bcm, _read(bcm), time.monotonic(), time.time()))
+        self.captured += 1
+        if metrics.enabled:
+            _EDGES.inc(_BCM_TO_NAME.get(bcm, bcm))
+        self._wake.set()
+
+    def subscribe(self, callback, names=None, edge=backends.BOTH):
+        """callback(event) is called with an InputEvent for inputs in names, or all boolean inputs if
+           names is None, on rising, falling or both edges. Callbacks run on the dispatch thread pool"""
+        self._subscribers.append([callback, None if names is None else frozenset(names), edge])
+
+    def unsubscribe(self, callback):
+        self._subscribers = [sub for sub in self._subscribers if sub[0] is not callback]
+
+    def _accept(self, name, level, monotonic, timestamp):
+        """Applies the input filter, returns True if the edge is accepted, an edge to be checked
+           by the glitch filter is held in _glitch, and accepted later by _process"""
+        last = self._accepted.get(name)
+        if (last is not None) and (last[0] == level):
+            # a repeated level, the opposite edge was missed or filtered
+            return False
+        if name in self._glitch:
+            # an edge to this level is already waiting for its glitch check
+            return False
+        in_filter = _INPUT_FILTERS.get(name)
+        if in_filter is not None:
+            if (last is not None) and (last[1] is not None) and (monotonic - last[1] < in_filter.debounce):
+                self.debounced += 1
+                # check the level once the debounce time ends, in case it has settled changed
+                self._settle[name] = last[1] + in_filter.debounce
+                return False
+            if in_filter.glitch:
+                # read the input again once the glitch time ends, rather than waiting here
+                self._glitch[name] = (level, monotonic, timestamp, monotonic + in_filter.glitch)
+                return False
+        self._accepted[name] = (level, monotonic)
+        return True
+
+    def _process(self):
+        "Drains the ring buffer, returning a list of coalesced InputEvents"
+        # name : InputEvent, in order of first arrival
+        batch = {}
+        while self._ring:
+            bcm, level, monotonic, timestamp = self._ring.popleft()
+            name = _BCM_TO_NAME.get(bcm)
+            if name is None:
+                continue
+            level = bool(level)
+            if not self._accept(name, level, monotonic, timestamp):
+                continue
+            previous = batch.get(name)
+            if previous is None:
+                batch[name] = InputEvent(name, level, timestamp, 1)
+            else:
+                self.coalesced += 1
+                batch[name] = InputEvent(name, level, timestamp, previous.edges + 1)
+        if self._glitch:
+            now = time.monotonic()
+            for name, (level, monotonic, timestamp, deadline) in list(self._glitch.items()):
+                if deadline > now:
+                    continue
+                del self._glitch[name]
+                if bool(_read(_INPUTS[name].BCM)) != level:
+                    self.glitches += 1
+                    continue
+                self._accepted[name] = (level, monotonic)
+                previous = batch.get(name)
+                batch[name] = InputEvent(name, level, timestamp, previous.edges + 1 if previous else 1)
+        if self._settle:
+            now = time.monotonic()
+            for name, deadline in list(self._settle.items()):
+                if deadline > now:
+                    continue
+                del self._settle[name]
+                level = bool(_read(_INPUTS[name].BCM))
+                if level != self._accepted[name][0]:
+                    # the input settled at the level of an edge ignored during the debounce time
+                    self._accepted[name] = (level, now)
+                    previous = batch.get(name)
+                    batch[name] = InputEvent(name, level, time.time(), previous.edges + 1 if previous else 1)
+        return list(batch.values())
+
+    def _timeout(self):
+        "Returns the seconds until the next debounced or glitch filtered input is to be read, or None"
+        deadlines = list(self._settle.values()) + [pending[3] for pending in self._glitch.values()]
+        if not deadlines:
+            return
+        return max(0, min(deadlines) - time.monotonic())
+
+    def _deliver(self, callback, events):
+        for event in events:
+            try:
+                callback(event)
+                self.delivered += 1
+                if metrics.enabled:
+                    _DELIVERY_SECONDS.observe(time.time() - event.timestamp)
+            except Exception:
+                self.subscriber_errors += 1
+
+    def _run(self):
+        while not self._stop:
+            self._wake.wait(self._timeout())
+            self._wake.clear()
+            events = self._process()
+            if not events:
+                continue
+            for callback, names, edge in self._subscribers:
+                selected = [event for event in events
+                            if ((names is None) or (event.name in names))
+                            and ((edge == backends.BOTH) or ((edge == backends.RISING) == event.level))]
+                if selected:
+                    self._executor.submit(self._deliver, callback, selected)
+
+    def start(self):
+        "Registers edge detection on every boolean input, and starts the dispatcher"
+        if self._thread is not None:
+            return
+        if _backend is None:
+            return
+        # cleared, as the pipeline may have been stopped before
+        self._stop = False
+        self._settle = {}
+        self._glitch = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._workers,
+                                                               thread_name_prefix="InputDispatch")
+        self._thread = threading.Thread(target=self._run, name="InputPipeline", daemon=True)
+        self._thread.start()
+        for name, iput in _INPUTS.items():
+            if (iput.type == 'boolean') and isinstance(iput.BCM, int):
+                self._accepted[name] = (bool(_read(iput.BCM)), None)
+                _backend.add_event_detect(iput.BCM, backends.BOTH, self._capture)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        for iput in _INPUTS.values():
+            if (iput.type == 'boolean') and isinstance(iput.BCM, int):
+                _backend.remove_event_detect(iput.BCM)
+        self._stop = True
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+        self._executor.shutdown()
+
+    def level(self, name):
+        """Returns the filtered level of a boolean input, that of its last accepted edge, or None
+           if the pipeline is not running or does not handle the input"""
+        if self._thread is None:
+            return
+        accepted = self._accepted.get(name)
+        if accepted is None:
+            return
+        return accepted[0]
+
+    def counters(self):
+        "Returns a dictionary of the pipeline counters"
+        return {'captured':self.captured,
+                'dropped':self.dropped,
+                'debounced':self.debounced,
+                'glitches':self.glitches,
+                'coalesced':self.coalesced,
+                'delivered':self.delivered,
+                'subscriber_errors':self.subscriber_errors}
+
+
+input_pipeline = InputPipeline()
+
+metrics.Gauge('pi02_input_pipeline_total', 'Input pipeline counters',
+              lambda: {(key,):value for key, value in input_pipeline.counters().items()},
+              labels=('counter',), kind='counter')
 
 
 # example object to trigger a callback function which you supply when an input changes
@@ -215,9 +646,9 @@ class Listen(object):
        listen = Listen(mycallback, userdata)
        listen.start_loop()
 
-       This will then use the threaded interrupt facilities of RPi.GPIO
-       to call the callback when one of the inputs falls (if pud True)
-       or rises (if pud False), each with a 300ms bounce time
+       This will then use the input event pipeline to call the callback when one
+       of the inputs falls (if pud True) or rises (if pud False), filtered as set
+       in _INPUT_FILTERS. The callback is called on a pipeline dispatch thread.
       
     """ 
 
@@ -231,146 +662,28 @@ class Listen(object):
     def input_description(self, name):
         return get_input_description(name)
 
-    def _pincallback(self, channel):
-        """This is the callback added to each pin, in turn it calls
+    def _eventcallback(self, event):
+        """This is subscribed to the input pipeline, in turn it calls
            callbackfunction(name, userdata)"""
-        name = get_input_name(channel)
-        # and call the callback function
-        self.set_callback(name, self.userdata)
+        iput = _INPUTS[event.name]
+        # pull up pins call on a falling edge, pull down pins on a rising edge
+        if event.level != bool(iput.pud):
+            if not metrics.enabled:
+                self.set_callback(event.name, self.userdata)
+                return
+            with _LISTEN_SECONDS.time(event.name):
+                self.set_callback(event.name, self.userdata)
 
     def start_loop(self):
-        "Sets up listenning threads"
-        if not _gpio_control:
+        "Subscribes to the input pipeline, starting it if necessary"
+        if _backend is None:
             return
-        for name, iput in _INPUTS.items():
-            if (iput.type == 'boolean') and isinstance(iput.BCM, int):
-                if iput.pud:
-                    # True for pull up pin, therefore detect falling edge
-                    GPIO.add_event_detect(iput.BCM, GPIO.FALLING, callback=self._pincallback, bouncetime=300)
-                else:
-                    GPIO.add_event_detect(iput.BCM, GPIO.RISING, callback=self._pincallback, bouncetime=300)
+        input_pipeline.subscribe(self._eventcallback)
+        input_pipeline.start()
 
 
 
 ###  scheduled actions ###
 
-# event1 and event2 are example functions to be run 2 minutes past the hour and 32 minutes past the hour
-# these will be replaced by your own event functions.
-
-
-def event1(*args):
-    "event1 description"
-    print('******1******')
-
-
-def event2(*args):
-    "event2 description"
-    print('******2******')
-
-
-
-### scheduled actions to occur at set times each hour ###
-
-class ScheduledEvents(object):
-
-    def __init__(self, *args):
-        "Used to create a schedule of events, each occuring at given minutes past the hour"
-        # create a list of event callbacks and minutes past the hour for each event in turn
-        self.event_list = [(event1, 2), (event2, 32)]
-        self.args = args
-        self.schedule = sched.scheduler(time.time, time.sleep)
-
-
-    @property
-    def queue(self):
-        return self.schedule.queue
-
-
-    def _create_next_hour_events(self):
-        "Create a new set of events for the following hour"
-
-        # On moving into the next hour, thishour timestamp is moved
-        # forward by an hour 
-        self.thishour = self.thishour + 3600
-
-        # create scheduled events which are to occur
-        # at interval minutes during thishour
-
-        for evt_callback, mins in self.event_list:
-            self.schedule.enterabs(time = self.thishour + mins*60,
-                                   priority = 1,
-                                   action = evt_callback,
-                                   argument = self.args
-                                   )
-
-        # schedule a final event to occur 30 seconds after last event
-        last_event = self.event_list[-1]
- 
-        final_event_time = self.thishour + last_event[1]*60 + 30
-        self.schedule.enterabs(time = final_event_time,
-                               priority = 1,
-                               action = self._create_next_hour_events
-                               )
-
-
-    def __call__(self): 
-        "Schedule Events, and run the scheduler, this is a blocking call, so run in a thread"
-        # set the scheduled events for the current hour
-
-        # get a time tuple for now
-        ttnow = time.localtime()
-        # get the timestamp of now
-        rightnow = time.mktime(ttnow)
-
-        # get the timestamp for the beginning of the current hour
-        self.thishour = time.mktime((ttnow.tm_year,
-                                     ttnow.tm_mon,
-                                     ttnow.tm_mday,
-                                     ttnow.tm_hour,
-                                     0,                  # zero minutes
-                                     0,                  # zero seconds
-                                     ttnow.tm_wday,
-                                     ttnow.tm_yday,
-                                     ttnow.tm_isdst))
-
-        # create times at which events are to occur
-        # during the remaining part of this hour
-        for evt_callback, mins in self.event_list:
-            event_time = self.thishour + mins*60
-            if event_time > rightnow:
-                self.schedule.enterabs(time = event_time,
-                                       priority = 1,
-                                       action = evt_callback,
-                                       argument = self.args
-                                       )
-
-        # schedule a final event to occur 30 seconds after last event
-        last_event = self.event_list[-1]
-        
-        final_event_time = self.thishour + last_event[1]*60 + 30
-        self.schedule.enterabs(time = final_event_time,
-                               priority = 1,
-                               action = self._create_next_hour_events
-                               )
-
-
-        # and run the schedule
-        self.schedule.run()
-
-
-# How to use
-
-# create event callback functions
-# add them in time order to the self.event_list attribute, as tuples of (event function, minutes after the hour)
-
-# create a ScheduledEvents instance
-# scheduled_events = ScheduledEvents(*args)
-# this is a callable, use it as a thread target
-# run_scheduled_events = threading.Thread(target=scheduled_events)
-# and start the thread
-# run_scheduled_events.start()
-
-# the event callbacks should be set with whatever action is required
-
-
-
+# Actions at set times are run by picode.scheduler, which takes cron or interval
+# specifications, see the How to use notes at the end of scheduler.py
@@ -0,0 +1,306 @@
+#######################################################
+#
+# history.py
+# records input readings over time, in a separate
+# sqlite database beside setup.db, with per-minute and
+# per-hour rollups and retention limits
+#
+#######################################################
+
+# If the working database is held in memory, with PI02_DB_WORKING_DIR set, history.db is kept
+# beside it, and copied to the setup directory by its own snapshotter, as the minute rollups
+# are the most frequent writes. Readings since the last snapshot are lost at a power cut
+
+
+import os, threading, time
+
+from urllib.parse import parse_qs
+
+from . import database_ops, hardware, routes
+
+
+_HISTORY_NAME = 'history.db'
+
+# pending readings and rollups are written in one transaction at this interval, in seconds
+_FLUSH_INTERVAL = 60
+
+# a reading is stored raw when its value changes, or if this many seconds have passed
+# since the last stored value, so an unchanging input costs one row a minute
+_RAW_HEARTBEAT = 60
+
+# rollup periods, in seconds
+MINUTE = 60
+HOUR = 3600
+
+# retention, in seconds, of raw readings and of each rollup period
+_RETENTION = {'raw': 7*24*3600,
+              MINUTE: 30*24*3600,
+              HOUR: 2*365*24*3600}
+
+# rows deleted in each retention transaction
+_PRUNE_BATCH = 5000
+
+# seconds between retention passes
+_PRUNE_INTERVAL = 3600
+
+_store = None
+
+# the database_ops._Snapshotter of history.db, if it is kept in the working directory
+_snapshotter = None
+
+
+def _numeric(value):
+    "Returns the value as a float, or None if it cannot be recorded"
+    if value is None or isinstance(value, str):
+        return
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return
+
+
+class _Rollup(object):
+    "Accumulates min, max, mean and edge count for one input over one bucket"
+
+    def __init__(self, bucket, value):
+        self.bucket = bucket
+        self.count = 1
+        self.minimum = value
+        self.maximum = value
+        self.total = value
+        self.edges = 0
+        self.last = value
+
+    def add(self, value):
+        self.count += 1
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+        self.total += value
+        if value != self.last:
+            self.edges += 1
+        self.last = value
+
+    def row(self, name, period):
+        return (name, period, self.bucket, self.count, self.minimum, self.maximum, self.total, self.edges)
+
+
+class HistoryStore(object):
+    """Receives input snapshots, holds readings and rollups in memory, and writes them
+       in batched transactions from its own thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self.pool = database_ops.ConnectionPool(path)
+        self._lock = threading.Lock()
+        # name : (time, value) of the last raw reading stored
+        self._last_raw = {}
+        # (name, period) : _Rollup of the current bucket
+        self._current = {}
+        self._pending_raw = []
+        self._pending_rollups = []
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._last_prune = 0
+        self.rows_written = 0
+        self.flushes = 0
+        self._create()
+
+    def _create(self):
+        con = self.pool.acquire()
+        try:
+            con.execute("PRAGMA journal_mode = WAL")
+            con.execute("create table if not exists readings (name TEXT, time REAL, value REAL, primary key (name, time)) without rowid")
+            con.execute("""create table if not exists rollups (name TEXT, period INTEGER, bucket INTEGER, count INTEGER,
+                           minimum REAL, maximum REAL, total REAL, edges INTEGER, primary key (name, period, bucket)) without rowid""")
+            con.commit()
+        finally:
+            self.pool.release(con)
+
+    def add_snapshot(self, snapshot):
+        "Called by the input sampler with each new snapshot"
+        timestamp = snapshot.timestamp
+        with self._lock:
+            for name, value in snapshot.values.items():
+                value = _numeric(value)
+                if value is None:
+                    continue
+                last = self._last_raw.get(name)
+                if (last is None) or (last[1] != value) or (timestamp - last[0] >= _RAW_HEARTBEAT):
+                    self._last_raw[name] = (timestamp, value)
+                    self._pending_raw.append((name, timestamp, value))
+                for period in (MINUTE, HOUR):
+                    bucket = int(timestamp // period) * period
+                    rollup = self._current.get((name, period))
+                    if rollup is None or rollup.bucket != bucket:
+                        if rollup is not None:
+                            # the previous bucket is complete
+                            self._pending_rollups.append(rollup.row(name, period))
+                        self._current[name, period] = _Rollup(bucket, value)
+                    else:
+                        rollup.add(value)
+
+    def flush(self):
+        "Writes pending readings, completed rollups and the partial current rollups in one transaction"
+        with self._lock:
+            raw = self._pending_raw
+            rollups = self._pending_rollups
+            self._pending_raw = []
+            self._pending_rollups = []
+            # current buckets are written as they stand, and replaced as they fill
+            rollups.extend(rollup.row(name, period) for (name, period), rollup in self._current.items())
+        if not (raw or rollups):
+            return
+        con = self.pool.acquire()
+        try:
+            con.executemany("insert or replace into readings (name, time, value) values (?, ?, ?)", raw)
+            con.executemany("""insert or replace into rollups (name, period, bucket, count, minimum, maximum, total, edges)
+                               values (?, ?, ?, ?, ?, ?, ?, ?)""", rollups)
+            con.commit()
+            self.rows_written += len(raw) + len(rollups)
+            self.flushes += 1
+        except Exception:
+            # put the rows back, to be tried again at the next flush
+            with self._lock:
+                self._pending_raw[:0] = raw
+                self._pending_rollups[:0] = rollups
+            raise
+        finally:
+            self.pool.release(con)
+
+    def prune(self, now=None):
+        "Deletes rows older than their retention period, in batches"
+        if now is None:
+            now = time.time()
+        con = self.pool.acquire()
+        try:
+            names = [row[0] for row in con.execute("select distinct name from rollups")]
+            for name in names:
+                cutoff = now - _RETENTION['raw']
+                while con.execute("""delete from readings where name = ? and time in
+                                     (select time from readings where name = ? and time < ? limit ?)""",
+                                  (name, name, cutoff, _PRUNE_BATCH)).rowcount:
+                    con.commit()
+                for period in (MINUTE, HOUR):
+                    cutoff = now - _RETENTION[period]
+                    while con.execute("""delete from rollups where name = ? and period = ? and bucket in
+                                         (select bucket from rollups where name = ? and period = ? and bucket < ? limit ?)""",
+                                      (name, period, name, period, cutoff, _PRUNE_BATCH)).rowcount:
+                        con.commit()
+            con.commit()
+        finally:
+            self.pool.release(con)
+
+    def _run(self):
+        while not self._stop_event.wait(_FLUSH_INTERVAL):
+            try:
+                self.flush()
+                if time.monotonic() - self._last_prune > _PRUNE_INTERVAL:
+                    self._last_prune = time.monotonic()
+                    self.prune()
+            except Exception:
+                pass
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._last_prune = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="HistoryWriter", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        "Stops the writer thread, flushing pending data, and closes connections"
+        if self.pool.closed:
+            return
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        try:
+            self.flush()
+        finally:
+            self.pool.close_all()
+
+    def query(self, name, start, end, resolution=None, max_points=1000):
+        """Returns a dictionary with keys 'name', 'resolution' and 'points'. resolution is 'raw', 'minute' or 'hour'
+           if not given, the finest resolution returning no more than about max_points is chosen.
+           Raw points are [time, value], rollup points are [bucket, min, max, mean, edges]"""
+        span = end - start
+        if resolution is None:
+            if span <= 6*3600:
+                resolution = 'raw'
+            elif span / MINUTE <= max_points:
+                resolution = 'minute'
+            else:
+                resolution = 'hour'
+        con = self.pool.acquire()
+        try:
+            if resolution == 'raw':
+                cur = con.execute("select time, value from readings where name = ? and time >= ? and time <= ? order by time",
+                                  (name, start, end))
+                points = [list(row) for row in cur]
+                with self._lock:
+                    stored = points[-1][0] if points else None
+                    points.extend([t, v] for n, t, v in self._pending_raw
+                                  if n == name and start <= t <= end and (stored is None or t > stored))
+            else:
+                period = MINUTE if resolution == 'minute' else HOUR
+                cur = con.execute("""select bucket, minimum, maximum, total, count, edges from rollups
+                                     where name = ? and period = ? and bucket >= ? and bucket <= ? order by bucket""",
+                                  (name, period, int(start // period) * period, end))
+                points = [[bucket, minimum, maximum, total/count, edges] for bucket, minimum, maximum, total, count, edges in cur]
+        finally:
+            self.pool.release(con)
+        return {'name':name, 'resolution':resolution, 'points':points}
+
+
+def start(database_dir):
+    """Creates the history store beside the working database, and records each input snapshot.
+       database_dir is the setup directory, which holds the snapshot of a history store kept
+       in a working directory"""
+    global _store, _snapshotter
+    if _store is not None:
+        return _store
+    working_dir = database_ops.working_directory()
+    path = os.path.join(working_dir, _HISTORY_NAME)
+    if os.path.abspath(working_dir) != os.path.abspath(database_dir):
+        _snapshotter = database_ops.start_snapshots(path, os.path.join(database_dir, _HISTORY_NAME))
+    _store = HistoryStore(path)
+    hardware.add_sample_listener(_store.add_snapshot)
+    _store.start()
+    return _store
+
+
+def stop():
+    "Called on shutdown, flushes pending readings, and takes a final snapshot of a store in a working directory"
+    if _store is not None:
+        _store.stop()
+    if _snapshotter is not None:
+        _snapshotter.stop()
+
+
+def query(name, start, end, resolution=None, max_points=1000):
+    "Returns the query result from the history store, see HistoryStore.query"
+    if _store is None:
+        return {'name':name, 'resolution':resolution, 'points':[]}
+    return _store.query(name, start, end, resolution, max_points)
+
+
+def history_json(environ, start_response):
+    """WSGI handler, /api/history?name=input01&start=t1&end=t2&resolution=minute
+       start and end are unix timestamps, defaulting to the last hour"""
+    params = parse_qs(environ.get('QUERY_STRING', ''))
+    name = params.get('name', [''])[0]
+    if name not in hardware.get_inputs():
+        return routes.json_response(start_response, {'error':'Unknown input name'}, status='400 Bad Request')
+    resolution = params.get('resolution', [None])[0]
+    if resolution not in (None, 'raw', 'minute', 'hour'):
+        return routes.json_response(start_response, {'error':'Invalid resolution'}, status='400 Bad Request')
+    try:
+        end = float(params['end'][0]) if 'end' in params else time.time()
+        start = float(params['start'][0]) if 'start' in params else end - 3600
+        max_points = int(params['max_points'][0]) if 'max_points' in params else 1000
+    except ValueError:
+        return routes.json_response(start_response, {'error':'Invalid parameter'}, status='400 Bad Request')
+    return routes.json_response(start_response, query(name, start, end, resolution, max_points))
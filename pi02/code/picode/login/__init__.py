@@ -1,25 +1,37 @@
 
 
-import uuid
-from datetime import datetime, timedelta
+import json
+
+from urllib.parse import parse_qs
 
 from http import cookies
 
 from skipole import FailPage, GoTo, ValidateError, ServerError
 
-from .. import database_ops
+from .. import database_ops, sessions, passwords, routes
+
+# the number of log messages shown on the logs page, unless a limit is requested
+_LOG_PAGE = 200
+
+# level name : level
+_LEVELS = {name:level for level, name in database_ops.LEVEL_NAMES.items()}
 
-_ONE_MINUTE = timedelta(minutes = 1)
+# the largest request body accepted by /api/login
+_MAX_BODY = 4096
 
-def check_password(password):
-    "Returns True if password ok, False otherwise"
+def check_password(password, user=None):
+    "Returns True if password ok for user, by default the access user, False otherwise"
     try:
-        access_user = database_ops.get_access_user()
-        database_password, seed = database_ops.get_password(access_user)
-        if (database_password, seed) == database_ops.hash_password(password, seed):
-            # password ok
+        if not user:
+            user = database_ops.get_access_user()
+        database_password, seed, kdf = database_ops.get_password(user)
+        # the hash is computed on the password hashing thread
+        if passwords.verify(user, password, database_password, seed, kdf):
+            # password ok, if hashed with other settings than those now set, hash it again
+            if passwords.needs_rehash(kdf):
+                database_ops.set_password(user, password)
             return True
-        database_ops.set_message("Invalid password submitted")
+        database_ops.set_message("Invalid password submitted", level=database_ops.WARNING, category='login')
     except:
         pass
         # Any exception causes False to be returned
@@ -42,37 +54,23 @@ def request_login(skicall):
     """create a cookie"""
     # After a user has tried to login and his password successfully checked then
     # this function is called from responder 2010 which is of type 'SetCookies'
-    # a cookie is generated, set into the database and sent to the user browser
-    # so future access is immediate when a received cookie is compared with the database cookie
+    # a new session is started, and its token sent to the user browser as a cookie,
+    # so future access is immediate when a received cookie is found in the sessions.
+    # Each login has its own session, so several browsers and clients may be logged in at once
 
     # create a cookie for cookie key 'project2'
     project = skicall.project
-    # generate a cookie string
-    ck_string = uuid.uuid4().hex
+    user = database_ops.get_access_user()
+    ck_string = sessions.create_session(user)
+    if not ck_string:
+        raise FailPage("Access failed - database error")
     ck_key = project +"2"
     cki = cookies.SimpleCookie()
     cki[ck_key] = ck_string
-    # twelve hours expirey time
+    # twelve hours expirey time, the lifetime of the session
     cki[ck_key]['max-age'] = 43200
     # set root project path
     cki[ck_key]['path'] = skicall.projectpaths()[project]
-    # is an admin user already logged in? - get the stored cookie.
-    user = database_ops.get_access_user()
-    stored_cookie = database_ops.get_cookie(user)
-    if stored_cookie != "000":
-        # someone is logged in, find last access time
-        last_connect = database_ops.get_last_connect(user)
-        now = datetime.utcnow()
-        if now - last_connect < _ONE_MINUTE:
-            # cannot allow the user to log in
-            raise GoTo(target=2012)
-    # Either no one is currently logged in,
-    # or it has been longer than a minute since the last connection,
-    # so log this user in by setting the cookie into the database
-    # and returning it here for the SetCookies responder to apply it
-    status = database_ops.set_cookie(user, ck_string)
-    if not status:
-        raise FailPage("Access failed - database error")
     return cki
 
 
@@ -81,27 +79,12 @@ def check(skicall):
     if ('logged_in' in skicall.call_data) and skicall.call_data['logged_in']:
         # user is already logged in, go to page 2011
         raise GoTo(target=2011)
-    # user is not logged in, but do not allow access to login page, if admin user has
-    # accessed the system in the last minute
-    user = database_ops.get_access_user()
-    # is an admin user logged in?
-    stored_cookie = database_ops.get_cookie(user)
-    if stored_cookie == "000":
-        # no one is logged in, ok to go to login page
-        return
-    # someone is logged in, find last access time
-    last_connect = database_ops.get_last_connect(user)
-    now = datetime.utcnow()
-    if now - last_connect < _ONE_MINUTE:
-        raise GoTo(target=2012)
-    # It has been longer than a minute since the last connection, so allow user
-    # to access the login page
+    # user is not logged in, ok to go to login page, a login does not affect other sessions
     return
-    
 
 
 def logout(skicall):
-    """Logs the user out by deleting the user cookie from the database, and also 
+    """Logs the user out by ending the session of the received cookie, and also
           set a cookie in the user browser to '000' which indicates logged out"""
 
     # When a user chooses logout - this calls responder 11 which is of type 'SetCookies'
@@ -115,18 +98,81 @@ def logout(skicall):
     cki[ck_key] = "000"
     # set root project path in the cookie
     cki[ck_key]['path'] = skicall.projectpaths()[project]
-    # and set the cookie string into database
-    user = database_ops.get_access_user()
-    status = database_ops.set_cookie(user, "000")
-    if not status:
-        raise FailPage("Access failed - database error")
+    # and end this session, any other sessions stay logged in
+    if skicall.received_cookies and (ck_key in skicall.received_cookies):
+        status = sessions.end_session(skicall.received_cookies[ck_key])
+        if not status:
+            raise FailPage("Access failed - database error")
     return cki
 
 
+def login_json(environ, start_response):
+    """WSGI handler for /api/login, for automation clients. A POST with a JSON body
+       {"username": name, "password": password} starts a new session, username defaults
+       to the access user. The token is returned, and set as the cookie, which is sent
+       with further requests"""
+    if environ.get('REQUEST_METHOD', 'GET') != 'POST':
+        return routes.json_response(start_response, {'error':'Method not allowed'}, status='405 Method Not Allowed',
+                                    headers=[('Allow', 'POST')])
+    if environ.get('CONTENT_TYPE', '').split(';')[0].strip() != 'application/json':
+        return routes.json_response(start_response, {'error':'Content-Type must be application/json'},
+                                    status='415 Unsupported Media Type')
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        if (length <= 0) or (length > _MAX_BODY):
+            raise ValueError
+        data = json.loads(environ['wsgi.input'].read(length).decode('utf-8'))
+        user = data.get('username') or database_ops.get_access_user()
+        password = data['password']
+        if not (isinstance(user, str) and isinstance(password, str) and password):
+            raise ValueError
+    except (ValueError, KeyError, AttributeError, UnicodeDecodeError):
+        return routes.json_response(start_response, {'error':'Expected {"username": name, "password": password}'},
+                                    status='400 Bad Request')
+    if not check_password(password, user):
+        return routes.json_response(start_response, {'error':'Invalid username or password'}, status='401 Unauthorized')
+    token = sessions.create_session(user)
+    if not token:
+        return routes.json_response(start_response, {'error':'Access failed - database error'},
+                                    status='500 Internal Server Error')
+    cki = cookies.SimpleCookie()
+    ck_key = environ['pi02.cookie_name']
+    cki[ck_key] = token
+    cki[ck_key]['max-age'] = 43200
+    cki[ck_key]['path'] = '/'
+    return routes.json_response(start_response, {'user':user, 'token':token},
+                                headers=[('Set-Cookie', cki[ck_key].OutputString())])
+
+
+def logout_json(environ, start_response):
+    "WSGI handler for /api/logout, ends the session of the received cookie, other sessions stay logged in"
+    if environ.get('REQUEST_METHOD', 'GET') != 'POST':
+        return routes.json_response(start_response, {'error':'Method not allowed'}, status='405 Method Not Allowed',
+                                    headers=[('Allow', 'POST')])
+    token = routes.received_token(environ)
+    if not sessions.end_session(token):
+        return routes.json_response(start_response, {'error':'Access failed - database error'},
+                                    status='500 Internal Server Error')
+    return routes.json_response(start_response, {'logged_out':True})
+
+
 # Following is not really a login function, but fits here as well as anywhere else
 
 def display_logs(skicall):
-    "Displays logs from the database"
-    skicall.page_data['messages', 'para_text'] = database_ops.get_all_messages()
+    """Displays logs from the database, the newest first. The page url may have a query string
+       with level (such as WARNING), category, limit, and before, a message id to page back from"""
+    params = parse_qs(skicall.environ.get('QUERY_STRING', ''))
+    level = params.get('level', [''])[0].upper()
+    level = _LEVELS.get(level)
+    category = params.get('category', [None])[0]
+    try:
+        limit = min(int(params.get('limit', [_LOG_PAGE])[0]), database_ops._MESSAGE_RETENTION)
+        before = int(params['before'][0]) if 'before' in params else None
+    except ValueError:
+        raise FailPage("Invalid log query")
+    messages = database_ops.get_messages(limit, level, category, before=before)
+    if messages is None:
+        raise FailPage("Access failed - database error")
+    skicall.page_data['messages', 'para_text'] = database_ops.format_messages(messages)
 
 
@@ -0,0 +1,270 @@
+#######################################################
+#
+# metrics.py
+# counters and latency histograms of the hot paths,
+# served as Prometheus text at /api/metrics, and as
+# percentiles of recent observations at
+# /api/metrics/recent
+#
+#######################################################
+
+
+import bisect, collections, json, os, threading, time
+
+
+# Set the environment variable PI02_METRICS=0 to disable metrics, each instrumented
+# point then costs a test of this global, and nothing is recorded
+enabled = os.environ.get('PI02_METRICS', '1') != '0'
+
+# upper bounds, in seconds, of the histogram buckets
+_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# each histogram series, and each counter made with recent=True, keeps this many of its latest
+# observations, from which /api/metrics/recent gives percentiles and rates over the window
+_RECENT_SIZE = 2048
+_RECENT_WINDOW = 300
+
+_lock = threading.Lock()
+
+# name : metric, in order of registration
+_metrics = {}
+
+
+def _register(metric):
+    with _lock:
+        if metric.name in _metrics:
+            raise ValueError("Metric %s is already registered" % (metric.name,))
+        _metrics[metric.name] = metric
+    return metric
+
+
+def _label_text(labels, values, extra=None):
+    'Returns the {label="value",...} part of a sample line'
+    pairs = list(zip(labels, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"')) for label, value in pairs) + '}'
+
+
+class Counter(object):
+    """A count for each combination of label values, such as Counter('pi02_input_edges_total',
+       'Edges captured', ('input',)), incremented with inc('input01')"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=(), recent=False):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # label values tuple : count
+        self._values = {}
+        # label values tuple : deque of monotonic times, if recent
+        self._recent = {} if recent else None
+        _register(self)
+
+    def inc(self, *values, amount=1):
+        if not enabled:
+            return
+        with _lock:
+            self._values[values] = self._values.get(values, 0) + amount
+            if self._recent is not None:
+                times = self._recent.get(values)
+                if times is None:
+                    times = self._recent[values] = collections.deque(maxlen=_RECENT_SIZE)
+                times.append(time.monotonic())
+
+    def samples(self):
+        "Returns a list of (suffix, label values, extra label, value)"
+        with _lock:
+            return [('', values, None, count) for values, count in self._values.items()]
+
+    def recent(self, now):
+        "Returns label values : {'rate':per second} over the recent window"
+        if self._recent is None:
+            return {}
+        with _lock:
+            times = {values:list(times) for values, times in self._recent.items()}
+        result = {}
+        for values, series in times.items():
+            start = now - _RECENT_WINDOW
+            if (len(series) == _RECENT_SIZE) and (series[0] > start):
+                # the deque is full, so the rate is over the time it covers
+                start = series[0]
+            count = len(series) - bisect.bisect_left(series, start)
+            result[values] = {'count':count, 'rate':round(count / max(now - start, 0.001), 3)}
+        return result
+
+
+class _Series(object):
+
+    __slots__ = ('counts', 'total', 'count', 'recent')
+
+    def __init__(self):
+        self.counts = [0] * (len(_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        # (monotonic time, value)
+        self.recent = collections.deque(maxlen=_RECENT_SIZE)
+
+
+class Histogram(object):
+    """Durations in seconds, for each combination of label values, such as
+       Histogram('pi02_responder_seconds', 'Responder latency', ('ident',)),
+       recorded with observe(0.002, 2003), or with time(2003) as a context manager"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # label values tuple : _Series
+        self._series = {}
+        _register(self)
+
+    def observe(self, seconds, *values):
+        if not enabled:
+            return
+        index = bisect.bisect_left(_BUCKETS, seconds)
+        with _lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = _Series()
+            series.counts[index] += 1
+            series.total += seconds
+            series.count += 1
+            series.recent.append((time.monotonic(), seconds))
+
+    def time(self, *values):
+        "Returns a context manager which observes the time taken within it"
+        return _Timer(self, values)
+
+    def samples(self):
+        with _lock:
+            series = [(values, list(s.counts), s.total, s.count) for values, s in self._series.items()]
+        result = []
+        for values, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket in zip(_BUCKETS + ('+Inf',), counts):
+                cumulative += bucket
+                result.append(('_bucket', values, ('le', bound), cumulative))
+            result.append(('_sum', values, None, total))
+            result.append(('_count', values, None, count))
+        return result
+
+    def recent(self, now):
+        "Returns label values : count, rate, percentiles in milliseconds, over the recent window"
+        window_start = now - _RECENT_WINDOW
+        with _lock:
+            recent = {values:list(s.recent) for values, s in self._series.items()}
+        result = {}
+        for values, series in recent.items():
+            start = window_start
+            if (len(series) == _RECENT_SIZE) and (series[0][0] > start):
+                # the deque is full, so the rate is over the time it covers
+                start = series[0][0]
+            observations = sorted(value for when, value in series if when >= start)
+            if not observations:
+                continue
+            last = len(observations) - 1
+            result[values] = {'count':len(observations),
+                              'rate':round(len(observations) / max(now - start, 0.001), 3),
+                              'p50_ms':round(observations[last // 2] * 1000, 3),
+                              'p90_ms':round(observations[(last * 9) // 10] * 1000, 3),
+                              'p99_ms':round(observations[(last * 99) // 100] * 1000, 3),
+                              'max_ms':round(observations[last] * 1000, 3)}
+        return result
+
+
+class _Timer(object):
+
+    __slots__ = ('histogram', 'values', 'start')
+
+    def __init__(self, histogram, values):
+        self.histogram = histogram
+        self.values = values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start, *self.values)
+        return False
+
+
+class Gauge(object):
+    """A value read when the metrics are served, function() returns a number, or a dictionary
+       of label values tuple : number. kind may be 'counter' for a count kept elsewhere"""
+
+    def __init__(self, name, help, function, labels=(), kind='gauge'):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.labels = tuple(labels)
+        self.kind = kind
+        _register(self)
+
+    def samples(self):
+        try:
+            value = self.function()
+        except Exception:
+            return []
+        if isinstance(value, dict):
+            return [('', values if isinstance(values, tuple) else (values,), None, number)
+                    for values, number in value.items() if isinstance(number, (int, float))]
+        if value is None:
+            return []
+        return [('', (), None, value)]
+
+    def recent(self, now):
+        return {}
+
+
+def text():
+    "Returns every metric in the Prometheus text exposition format"
+    with _lock:
+        metrics = list(_metrics.values())
+    lines = []
+    for metric in metrics:
+        samples = metric.samples()
+        if not samples:
+            continue
+        lines.append("# HELP %s %s" % (metric.name, metric.help))
+        lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+        for suffix, values, extra, value in samples:
+            lines.append("%s%s%s %s" % (metric.name, suffix, _label_text(metric.labels, values, extra), value))
+    return "\n".join(lines) + "\n"
+
+
+def recent():
+    "Returns a dictionary of metric name : list of recent rates and percentiles of each series"
+    now = time.monotonic()
+    with _lock:
+        metrics = list(_metrics.values())
+    result = {}
+    for metric in metrics:
+        series = metric.recent(now)
+        if series:
+            result[metric.name] = [dict(zip(metric.labels, values), **stats) for values, stats in series.items()]
+    return result
+
+
+def metrics_text(environ, start_response):
+    "WSGI handler for /api/metrics, for Prometheus to scrape"
+    body = text().encode('utf-8')
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                              ('Content-Length', str(len(body))),
+                              ('Cache-Control', 'no-cache')])
+    return [body]
+
+
+def metrics_recent(environ, start_response):
+    "WSGI handler for /api/metrics/recent, the rates and latency percentiles of the last five minutes"
+    body = json.dumps({'enabled':enabled, 'window_seconds':_RECENT_WINDOW, 'metrics':recent()}).encode('utf-8')
+    start_response('200 OK', [('Content-Type', 'application/json'),
+                              ('Content-Length', str(len(body))),
+                              ('Cache-Control', 'no-cache')])
+    return [body]
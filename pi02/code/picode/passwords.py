@@ -0,0 +1,148 @@
+#######################################################
+#
+# passwords.py
+# hashes and verifies passwords with a key derivation
+# function, PBKDF2 or scrypt, with the function and its
+# cost stored beside each hash so they can be changed
+#
+#######################################################
+
+
+import hashlib, hmac, os, threading, time, concurrent.futures
+
+
+# The function, and its cost, used for new hashes. A stored hash made with
+# other settings is replaced with one made with these on the next login.
+# benchmarks/bench_hash.py reports the time taken at each cost on this machine.
+_SCHEME = 'pbkdf2_sha256'
+
+_COST = {'pbkdf2_sha256': {'iterations':100000},
+         # memory used is 128 * n * r bytes
+         'scrypt': {'n':16384, 'r':8, 'p':1}}
+
+# bytes of random salt, and of derived key
+_SALT_SIZE = 16
+_KEY_SIZE = 32
+
+# hashes are computed on this many threads, further requests wait, so parallel
+# logins cannot take every processor core
+_HASH_WORKERS = 1
+
+# a login waiting longer than this number of seconds for a hash fails
+_HASH_TIMEOUT = 30
+
+# a successful verification is remembered for this number of seconds, so repeated checks
+# of the same password, such as by automation logging in often, are not hashed again
+_CACHE_SECONDS = 300
+_CACHE_SIZE = 32
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=_HASH_WORKERS, thread_name_prefix="PasswordHash")
+
+# cache key : expiry time, keys are made with a secret of this process, so hold nothing
+# which could be used to recover a password
+_cache = {}
+_cache_lock = threading.Lock()
+_CACHE_SECRET = os.urandom(32)
+
+
+def configure(scheme, **cost):
+    "Sets the scheme, 'pbkdf2_sha256' or 'scrypt', and its cost parameters, used for new hashes"
+    global _SCHEME
+    if scheme not in _COST:
+        raise ValueError("Unknown password scheme %s" % (scheme,))
+    if scheme == 'scrypt' and not hasattr(hashlib, 'scrypt'):
+        raise ValueError("scrypt is not available in this python")
+    _SCHEME = scheme
+    if cost:
+        _COST[scheme] = dict(cost)
+
+
+def current_kdf():
+    "Returns the kdf string describing the scheme and cost used for new hashes"
+    return format_kdf(_SCHEME, _COST[_SCHEME])
+
+
+def format_kdf(scheme, cost):
+    "Returns a kdf string, such as 'scrypt:n=16384,p=1,r=8'"
+    return scheme + ':' + ','.join("%s=%s" % (key, value) for key, value in sorted(cost.items()))
+
+
+def parse_kdf(kdf):
+    "Returns (scheme, cost dictionary), an empty kdf is the original salted SHA-512"
+    if not kdf:
+        return 'sha512', {}
+    scheme, _, parameters = kdf.partition(':')
+    cost = {}
+    for item in parameters.split(','):
+        if item:
+            key, _, value = item.partition('=')
+            cost[key] = int(value)
+    return scheme, cost
+
+
+def derive(password, salt, kdf):
+    "Returns the key derived from the password and salt, raises ValueError for an unknown kdf"
+    scheme, cost = parse_kdf(kdf)
+    if scheme == 'sha512':
+        # the original hash, kept to check passwords stored before kdf was recorded
+        return hashlib.sha512((salt + password).encode('utf-8')).digest()
+    if scheme == 'pbkdf2_sha256':
+        return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'),
+                                   cost['iterations'], _KEY_SIZE)
+    if scheme == 'scrypt':
+        return hashlib.scrypt(password.encode('utf-8'), salt=salt.encode('utf-8'), n=cost['n'], r=cost['r'],
+                              p=cost['p'], maxmem=256*cost['n']*cost['r'] + 1048576, dklen=_KEY_SIZE)
+    raise ValueError("Unknown password scheme %s" % (scheme,))
+
+
+def hash_password(password):
+    "Returns (hashed_password, salt, kdf) of the password, made with the current settings"
+    salt = os.urandom(_SALT_SIZE).hex()
+    kdf = current_kdf()
+    return _run(derive, password, salt, kdf), salt, kdf
+
+
+def needs_rehash(kdf):
+    "Returns True if a hash made with kdf should be replaced with one made with the current settings"
+    return kdf != current_kdf()
+
+
+def _cache_key(user, password, hashed_password):
+    # the stored hash is part of the key, so a changed password does not match
+    return hmac.new(_CACHE_SECRET, b'\0'.join((user.encode('utf-8'), password.encode('utf-8'), bytes(hashed_password))),
+                    hashlib.sha256).digest()
+
+
+def verify(user, password, hashed_password, salt, kdf):
+    "Returns True if the password matches the stored hash, the hash is computed on the hashing thread"
+    key = _cache_key(user, password, hashed_password)
+    now = time.monotonic()
+    with _cache_lock:
+        expiry = _cache.get(key)
+        if expiry is not None:
+            if expiry > now:
+                return True
+            del _cache[key]
+    try:
+        derived = _run(derive, password, salt, kdf)
+    except (ValueError, KeyError, concurrent.futures.TimeoutError):
+        return False
+    if not hmac.compare_digest(derived, bytes(hashed_password)):
+        return False
+    with _cache_lock:
+        if len(_cache) >= _CACHE_SIZE:
+            # drop the entry expiring first
+            del _cache[min(_cache, key=_cache.get)]
+        _cache[key] = now + _CACHE_SECONDS
+    return True
+
+
+def clear_cache():
+    "Forgets remembered verifications, called when a password is changed"
+    with _cache_lock:
+        _cache.clear()
+
+
+def _run(function, *args):
+    "Runs function on the hashing thread, and waits for the result"
+    return _executor.submit(function, *args).result(timeout=_HASH_TIMEOUT)
@@ -0,0 +1,143 @@
+#######################################################
+#
+# routes.py
+# a WSGI dispatcher which serves endpoints that do not
+# fit the skipole page model, such as streamed events,
+# passing every other request to the skipole application
+#
+#######################################################
+
+
+import json, time
+
+from http import cookies
+
+from . import sessions, events, metrics
+
+
+_ROUTE_SECONDS = metrics.Histogram('pi02_route_seconds', 'Time taken by dispatcher route handlers', ('path',))
+_NOT_MODIFIED = metrics.Counter('pi02_not_modified_total', 'Conditional requests answered 304 Not Modified', ('path',))
+
+
+class Dispatcher(object):
+    """Wraps the skipole WSGIApplication. Routes added with add_route are served by their
+       own WSGI callable, all other requests are passed to the wrapped application.
+
+       A protected route is only served if the request carries the cookie of a logged in user"""
+
+    def __init__(self, application, project):
+        self.application = application
+        self.project = project
+        # path : (handler, protected)
+        self._routes = {}
+        # path : (version function, period), for conditional responses
+        self._conditional = {}
+        self.not_modified = 0
+
+    def add_project(self, proj, url=None):
+        "Adds a sub project to the wrapped skipole application"
+        return self.application.add_project(proj, url=url)
+
+    def add_route(self, path, handler, protected=True):
+        """handler is a WSGI callable handler(environ, start_response) which will
+           be called for requests to this exact path"""
+        self._routes[path] = (handler, protected)
+
+    def add_conditional(self, path, version, period=None):
+        """Requests to path, passed to the wrapped application, are given an ETag made from
+           version(), which returns a number increasing whenever the data served at path changes,
+           or None if it is not known. A GET from a logged in user with a matching If-None-Match
+           header is answered 304 Not Modified, without calling the application.
+
+           If the data also shows values which are not versioned, such as the server time, period
+           is the number of seconds they may be shown unchanged, normally the page refresh interval,
+           and the tag also changes every period seconds"""
+        self._conditional[path] = (version, period)
+
+    def _etag(self, path):
+        "Returns the ETag for a conditional path, or None"
+        version, period = self._conditional[path]
+        version = version()
+        if version is None:
+            return
+        # the process epoch makes tags from before a restart stale
+        if period is None:
+            return '"%s-%s"' % (events.broker.epoch, version)
+        return '"%s-%s-%s"' % (events.broker.epoch, version, int(time.time() // period))
+
+    def logged_in(self, environ):
+        "Returns True if the request carries the cookie of a logged in user"
+        return self.user(environ) is not None
+
+    def user(self, environ):
+        "Returns the user logged in with the cookie the request carries, or None"
+        return sessions.check_token(received_token(environ, self.project + '2'))
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if (path in self._conditional) and (environ.get('REQUEST_METHOD', 'GET') == 'GET'):
+            return self._conditional_call(path, environ, start_response)
+        route = self._routes.get(path)
+        if route is None:
+            return self.application(environ, start_response)
+        handler, protected = route
+        # so handlers which set or read the session cookie know its name
+        environ['pi02.cookie_name'] = self.project + '2'
+        if protected and not self.logged_in(environ):
+            return json_response(start_response, {'error':'Not logged in'}, status='403 Forbidden')
+        if not metrics.enabled:
+            return handler(environ, start_response)
+        # the time taken to start the response, a streamed body is not included
+        with _ROUTE_SECONDS.time(path):
+            return handler(environ, start_response)
+
+    def _conditional_call(self, path, environ, start_response):
+        etag = self._etag(path)
+        # a user not logged in is not served the data, so is given no tag for it
+        if (etag is None) or (not self.logged_in(environ)):
+            return self.application(environ, start_response)
+        if environ.get('HTTP_IF_NONE_MATCH') == etag:
+            self.not_modified += 1
+            _NOT_MODIFIED.inc(path)
+            start_response('304 Not Modified', [('ETag', etag), ('Cache-Control', 'no-cache')])
+            return []
+
+        def conditional_start_response(status, headers, exc_info=None):
+            if not status.startswith('200'):
+                return start_response(status, headers, exc_info)
+            # the browser may keep the response, but must check the tag before using it
+            headers = [(key, value) for key, value in headers if key.lower() not in ('cache-control', 'pragma', 'etag')]
+            headers.append(('Cache-Control', 'no-cache'))
+            headers.append(('ETag', etag))
+            return start_response(status, headers, exc_info)
+
+        return self.application(environ, conditional_start_response)
+
+
+def received_token(environ, cookie_name=None):
+    "Returns the value of the session cookie of the request, or None"
+    cookie_header = environ.get('HTTP_COOKIE')
+    if not cookie_header:
+        return
+    received = cookies.SimpleCookie()
+    try:
+        received.load(cookie_header)
+    except cookies.CookieError:
+        return
+    cookie_name = cookie_name or environ.get('pi02.cookie_name')
+    if cookie_name not in received:
+        return
+    return received[cookie_name].value
+
+
+def json_response(start_response, data, status='200 OK', headers=None):
+    "Starts the response, and returns the list of body bytes for the JSON encoded data"
+    body = json.dumps(data).encode('utf-8')
+    response_headers = [('Content-Type', 'application/json'),
+                        ('Content-Length', str(len(body))),
+                        ('Cache-Control', 'no-cache')]
+    if headers:
+        response_headers.extend(headers)
+    start_response(status, response_headers)
+    return [body]
+
@@ -0,0 +1,466 @@
+#######################################################
+#
+# rules.py
+# runs automation rules, which set outputs in response
+# to input changes, in this process as each change is
+# received, rather than through a web request
+#
+#######################################################
+
+
+import json, threading, time
+
+from . import database_ops, hardware, control, actions, backends, metrics, routes
+
+
+# A rule definition is a dictionary, stored as JSON in the rules table, for example
+#
+#   {"when": {"input": "input01", "edge": "falling"},
+#    "if": [{"output": "output01", "equals": true}],
+#    "then": [["set_output", "output01", false]]}
+#
+# "when" is the trigger, one of
+#   {"input": name, "edge": "rising" | "falling" | "both"}   on each edge of a boolean input
+#   {"input": name, "level": true | false}                   when a boolean input changes to the level
+#   {"input": name, "above": x, "reset_below": y}            when a numeric input rises above x, and
+#                                                            not again until it has fallen below y
+#   {"input": name, "below": x, "reset_above": y}            when a numeric input falls below x, and
+#                                                            not again until it has risen above y
+# reset_below and reset_above default to x, giving no hysteresis.
+#
+# "if" is an optional list of conditions, each on an "input" or an "output", with one of
+# "equals", "above" or "below", all must hold when the rule fires.
+#
+# "delay" is an optional number of seconds between the trigger and the rule firing. A level or
+# threshold rule whose trigger no longer holds before then does not fire, and a trigger while
+# a firing is pending restarts the delay.
+#
+# "then" is a list of actions, each a list of the action name followed by its arguments.
+#
+# A level or threshold rule is triggered by a change, so on start up the rules take the state
+# of the current input values without firing.
+
+_EDGES = {'rising':backends.RISING, 'falling':backends.FALLING, 'both':backends.BOTH}
+
+_NUMERIC = ('float', 'integer')
+
+engine = None
+
+_FIRINGS = metrics.Counter('pi02_rule_firings_total', 'Rule firings', ('rule',))
+_EVALUATION_SECONDS = metrics.Histogram('pi02_rule_evaluation_seconds',
+                                        'Time to evaluate the rules of an input change', ('input',))
+_LATENCY_SECONDS = metrics.Histogram('pi02_rule_latency_seconds',
+                                     'Time from an input change, or the end of a delay, to the rule actions completing', ('rule',))
+
+
+# actions are registered in picode.actions, in one table for the scheduler and the rules engine,
+# register_action is kept here so existing code registering rules actions is unchanged
+register_action = actions.register_action
+
+
+def _number(definition, key):
+    value = definition[key]
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("%s must be a number" % (key,))
+    return value
+
+
+def _compile_condition(condition):
+    "Returns (source, name, operator, value), source is 'input' or 'output'"
+    if not isinstance(condition, dict):
+        raise ValueError("A condition is a dictionary")
+    if 'input' in condition:
+        source, name = 'input', condition['input']
+        if hardware.get_input_type(name) is None:
+            raise ValueError("Unknown input %s" % (name,))
+    elif 'output' in condition:
+        source, name = 'output', condition['output']
+        if hardware.get_output_type(name) is None:
+            raise ValueError("Unknown output %s" % (name,))
+    else:
+        raise ValueError("A condition needs an input or an output")
+    for operator in ('equals', 'above', 'below'):
+        if operator in condition:
+            value = condition[operator] if operator == 'equals' else _number(condition, operator)
+            return (source, name, operator, value)
+    raise ValueError("A condition needs one of equals, above or below")
+
+
+class Rule(object):
+    "A rule compiled from its definition, with its trigger state and counters, raises ValueError if invalid"
+
+    def __init__(self, name, definition, enabled=True):
+        if not isinstance(definition, dict):
+            raise ValueError("A rule definition is a dictionary")
+        self.name = name
+        self.definition = definition
+        self.enabled = enabled
+        when = definition.get('when')
+        if not isinstance(when, dict) or ('input' not in when):
+            raise ValueError("A rule needs a when trigger on an input")
+        self.input = when['input']
+        input_type = hardware.get_input_type(self.input)
+        if input_type is None:
+            raise ValueError("Unknown input %s" % (self.input,))
+        if 'edge' in when or 'level' in when:
+            if input_type != 'boolean':
+                raise ValueError("Edge and level triggers need a boolean input")
+            if 'edge' in when:
+                if when['edge'] not in _EDGES:
+                    raise ValueError("edge is one of rising, falling or both")
+                self.kind = 'edge'
+                self.edge = _EDGES[when['edge']]
+            else:
+                self.kind = 'level'
+                self.level = bool(when['level'])
+        elif 'above' in when or 'below' in when:
+            if input_type not in _NUMERIC:
+                raise ValueError("Threshold triggers need a numeric input")
+            if 'above' in when:
+                self.kind = 'above'
+                self.threshold = _number(when, 'above')
+                self.reset = _number(when, 'reset_below') if 'reset_below' in when else self.threshold
+                if self.reset > self.threshold:
+                    raise ValueError("reset_below must not be above the threshold")
+            else:
+                self.kind = 'below'
+                self.threshold = _number(when, 'below')
+                self.reset = _number(when, 'reset_above') if 'reset_above' in when else self.threshold
+                if self.reset < self.threshold:
+                    raise ValueError("reset_above must not be below the threshold")
+        else:
+            raise ValueError("A trigger needs one of edge, level, above or below")
+        conditions = definition.get('if', [])
+        if not isinstance(conditions, list):
+            raise ValueError("if is a list of conditions")
+        self.conditions = tuple(_compile_condition(condition) for condition in conditions)
+        self.delay = _number(definition, 'delay') if 'delay' in definition else 0
+        if self.delay < 0:
+            raise ValueError("delay must not be negative")
+        then = definition.get('then')
+        if not isinstance(then, list) or not then:
+            raise ValueError("A rule needs a list of then actions")
+        self.actions = []
+        for action in then:
+            if not isinstance(action, list) or not action or (not actions.is_registered(action[0])):
+                raise ValueError("Unknown action %s" % (action,))
+            self.actions.append((action[0], tuple(action[1:])))
+        # a level or threshold rule is active while its trigger holds, until reset
+        self.active = False
+        # the threading.Timer of a pending delayed firing
+        self.timer = None
+        self.firings = 0
+        self.errors = 0
+        self.skipped = 0
+        self.last_fired = None
+        self.last_latency = 0.0
+
+    def prime(self, value):
+        "Sets the trigger state from the current input value, without firing"
+        if value is None:
+            return
+        if self.kind == 'level':
+            self.active = bool(value) == self.level
+        elif self.kind == 'above':
+            self.active = value > self.threshold
+        elif self.kind == 'below':
+            self.active = value < self.threshold
+
+    def triggered(self, value):
+        """Updates the trigger state for a new input value, returns True if the rule is
+           triggered, and cancels a pending firing if its trigger no longer holds"""
+        if value is None:
+            return False
+        if self.kind == 'edge':
+            return (self.edge == backends.BOTH) or ((self.edge == backends.RISING) == bool(value))
+        if self.kind == 'level':
+            holds = bool(value) == self.level
+            reset = not holds
+        elif self.kind == 'above':
+            holds = value > self.threshold
+            reset = value < self.reset
+        else:
+            holds = value < self.threshold
+            reset = value > self.reset
+        if self.active:
+            if reset:
+                self.active = False
+                self.cancel()
+            return False
+        if holds:
+            self.active = True
+            return True
+        return False
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def stats(self):
+        "Returns a dictionary of the rule and its counters, latency in seconds"
+        return {'name':self.name,
+                'enabled':self.enabled,
+                'definition':self.definition,
+                'active':self.active,
+                'pending':self.timer is not None,
+                'firings':self.firings,
+                'errors':self.errors,
+                'skipped':self.skipped,
+                'last_fired':self.last_fired,
+                'last_latency':round(self.last_latency, 6)}
+
+
+class RulesEngine(object):
+    """Holds the enabled rules in a dispatch table of input name : tuple of rules triggered by it,
+       so an input change evaluates only its own rules. The table is replaced, never altered,
+       when rules are added or removed. Changes are evaluated one at a time under a lock, as
+       input events are delivered on several threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name : Rule
+        self._rules = {}
+        # input name : tuple of enabled rules
+        self._by_input = {}
+        # input name : last value, and the time.time() it was read
+        self._values = {}
+        self._times = {}
+        self._running = False
+
+    def _rebuild(self):
+        "Replaces the dispatch table, the lock must be held"
+        by_input = {}
+        for rule in self._rules.values():
+            if rule.enabled:
+                by_input.setdefault(rule.input, []).append(rule)
+        self._by_input = {name:tuple(rules) for name, rules in by_input.items()}
+
+    def add_rule(self, rule):
+        "Adds or replaces a rule"
+        with self._lock:
+            old = self._rules.get(rule.name)
+            if old is not None:
+                old.cancel()
+            rule.prime(self._values.get(rule.input))
+            self._rules[rule.name] = rule
+            self._rebuild()
+
+    def remove_rule(self, name):
+        with self._lock:
+            rule = self._rules.pop(name, None)
+            if rule is not None:
+                rule.cancel()
+                self._rebuild()
+
+    def rules(self):
+        "Returns a list of rule stats dictionaries, in name order"
+        with self._lock:
+            return [self._rules[name].stats() for name in sorted(self._rules)]
+
+    def _condition(self, source, name, operator, value):
+        if source == 'input':
+            # a boolean input is taken at its debounced and glitch filtered level
+            current = hardware.input_pipeline.level(name)
+            if current is None:
+                current = self._values.get(name)
+        else:
+            current = control._get_output(name)
+        if current is None:
+            return False
+        if operator == 'equals':
+            return current == value
+        try:
+            return current > value if operator == 'above' else current < value
+        except TypeError:
+            return False
+
+    def _changed(self, name, value, timestamp, edges=1):
+        """Records a new input value, and returns a list of rules to fire now, the lock must be held.
+           A pulse, two edges returning to the same level, triggers the edge rules of both edges"""
+        previous = self._values.get(name)
+        if timestamp < self._times.get(name, 0):
+            # delivered out of order, a later value has already been handled
+            return []
+        self._times[name] = timestamp
+        self._values[name] = value
+        if value == previous:
+            if (edges < 2) or (value is None):
+                return []
+            changes = (not value, value)
+        else:
+            changes = (value,)
+        fire = []
+        for rule in self._by_input.get(name, ()):
+            for change in changes:
+                if not rule.triggered(change):
+                    continue
+                if rule.delay:
+                    rule.cancel()
+                    rule.timer = threading.Timer(rule.delay, self._delayed, (rule,))
+                    rule.timer.daemon = True
+                    rule.timer.start()
+                else:
+                    fire.append(rule)
+        return fire
+
+    def _fire(self, rule, since):
+        "Runs the rule actions if its conditions hold, since is the time.time() the firing was due"
+        with self._lock:
+            if not all(self._condition(*condition) for condition in rule.conditions):
+                rule.skipped += 1
+                return
+        try:
+            for action, args in rule.actions:
+                actions.run(action, args, 'rules')
+        except Exception:
+            rule.errors += 1
+        now = time.time()
+        rule.firings += 1
+        rule.last_fired = now
+        rule.last_latency = now - since
+        if metrics.enabled:
+            _FIRINGS.inc(rule.name)
+            _LATENCY_SECONDS.observe(rule.last_latency, rule.name)
+
+    def _delayed(self, rule):
+        "Called by the timer of a delayed firing"
+        with self._lock:
+            if (rule.timer is None) or (threading.current_thread() is not rule.timer) or not self._running:
+                # cancelled, or replaced by a later trigger
+                return
+            rule.timer = None
+        self._fire(rule, time.time())
+
+    def _evaluate(self, changes):
+        "changes is a list of (name, value, timestamp, edges), fires the triggered rules"
+        if not self._running:
+            return
+        start = time.perf_counter()
+        fire = []
+        with self._lock:
+            for name, value, timestamp, edges in changes:
+                fire.extend((rule, timestamp) for rule in self._changed(name, value, timestamp, edges))
+        if metrics.enabled:
+            elapsed = time.perf_counter() - start
+            for name, value, timestamp, edges in changes:
+                if name in self._by_input:
+                    _EVALUATION_SECONDS.observe(elapsed, name)
+        for rule, timestamp in fire:
+            self._fire(rule, timestamp)
+
+    def input_event(self, event):
+        "Subscribed to the input pipeline, handles an edge of a boolean input"
+        self._evaluate([(event.name, event.level, event.timestamp, event.edges)])
+
+    def snapshot(self, snapshot):
+        """A sample listener, handles changes of numeric inputs, and of boolean inputs if there is no
+           input pipeline, or if the event of an edge was missed. A boolean input sampled at other than
+           its filtered level, such as while it bounces, is ignored"""
+        changes = []
+        for name, value in snapshot.values.items():
+            if value == self._values.get(name):
+                continue
+            filtered = hardware.input_pipeline.level(name)
+            if (filtered is not None) and (value != filtered):
+                continue
+            changes.append((name, value, snapshot.timestamp, 1))
+        self._evaluate(changes)
+
+    def start(self):
+        "Takes the current input values, without firing, and subscribes to input changes"
+        if self._running:
+            return
+        hardware.input_pipeline.subscribe(self.input_event)
+        hardware.input_pipeline.start()
+        snapshot = hardware.get_snapshot()
+        with self._lock:
+            self._running = True
+            for name, value in snapshot.values.items():
+                filtered = hardware.input_pipeline.level(name)
+                self._values[name] = value if filtered is None else filtered
+                self._times[name] = snapshot.timestamp
+            for rule in self._rules.values():
+                rule.prime(self._values.get(rule.input))
+        hardware.add_sample_listener(self.snapshot)
+
+    def stop(self):
+        "Unsubscribes, and cancels pending delayed firings"
+        if not self._running:
+            return
+        hardware.input_pipeline.unsubscribe(self.input_event)
+        hardware.remove_sample_listener(self.snapshot)
+        with self._lock:
+            self._running = False
+            for rule in self._rules.values():
+                rule.cancel()
+
+
+def start():
+    "Creates the rules engine, loads rules from the database, and starts it"
+    global engine
+    if engine is not None:
+        return engine
+    engine = RulesEngine()
+    for name, definition, enabled in database_ops.get_rules() or []:
+        try:
+            rule = Rule(name, json.loads(definition), enabled)
+        except (ValueError, TypeError):
+            database_ops.set_message("Rule %s is invalid and has not been loaded" % (name,),
+                                     level=database_ops.WARNING, category='rules')
+            continue
+        engine.add_rule(rule)
+    engine.start()
+    return engine
+
+
+def stop():
+    "Called on shutdown"
+    if engine is not None:
+        engine.stop()
+
+
+def add_rule(name, definition, enabled=True):
+    """Adds or replaces a rule, saving it in the database, raises ValueError if it is invalid.
+       For example add_rule('stop', {'when':{'input':'input01', 'edge':'falling'}, 'then':[['set_output', 'output01', False]]})
+       turns output01 off when input01 falls"""
+    rule = Rule(name, definition, enabled)
+    if not database_ops.set_rule(name, json.dumps(definition), enabled):
+        raise ValueError("Unable to save rule %s" % (name,))
+    if engine is not None:
+        engine.add_rule(rule)
+
+
+def remove_rule(name):
+    "Removes a rule, returns False if it could not be deleted from the database"
+    if engine is not None:
+        engine.remove_rule(name)
+    return database_ops.delete_rule(name)
+
+
+def rules():
+    "Returns a list of rule stats dictionaries"
+    if engine is None:
+        return []
+    return engine.rules()
+
+
+def rules_json(environ, start_response):
+    "WSGI handler, /api/rules returns each rule with its firing counters"
+    return routes.json_response(start_response, {'rules':rules()})
+
+
+# How to use
+
+# add a rule, which is kept in setup.db and loaded when the rules engine is started,
+# for example, to switch output01 on while input01 is high, checked for half a second
+#
+# rules.add_rule('follow_on', {'when':{'input':'input01', 'level':True}, 'delay':0.5,
+#                              'then':[['set_output', 'output01', True]]})
+# rules.add_rule('follow_off', {'when':{'input':'input01', 'level':False},
+#                               'then':[['set_output', 'output01', False]]})
+#
+# further actions may be registered as for the scheduler, an action registered with either
+# is available to both
+#
+# rules.register_action('alarm', alarm)
@@ -0,0 +1,454 @@
+#######################################################
+#
+# scheduler.py
+# runs timed actions, given by cron or interval specs,
+# from a heap ordered timer queue on a bounded pool of
+# worker threads, with schedules kept in setup.db
+#
+#######################################################
+
+
+import heapq, json, threading, time, concurrent.futures
+
+from datetime import datetime, timedelta
+
+from . import database_ops, actions, routes
+
+
+# threads running actions
+_WORKERS = 4
+
+# actions waiting for, or running on, a worker, above this further due runs are skipped
+_MAX_PENDING = 64
+
+# a run starting more than this number of seconds after it was due is a misfire,
+# handled by the job misfire policy
+_MISFIRE_GRACE = 60
+
+# the most missed runs made up by a job with the 'all' misfire policy
+_MAX_CATCH_UP = 100
+
+# if the wall clock and the monotonic clock drift apart by more than this number of
+# seconds between two passes of the scheduler, the clock has been changed
+_CLOCK_JUMP = 2
+
+# seconds between writes of last run times to the database
+_PERSIST_INTERVAL = 60
+
+# misfire policies, after a missed run, 'skip' waits for the next due time,
+# 'once' runs once now, and 'all' runs once for every time missed
+MISFIRE_POLICIES = ('skip', 'once', 'all')
+
+engine = None
+
+
+# actions are registered in picode.actions, in one table for the scheduler and the rules engine,
+# register_action is kept here so existing code registering scheduler actions is unchanged
+register_action = actions.register_action
+
+
+def _parse_field(field, minimum, maximum):
+    "Parses one cron field, returning a sorted tuple of the values it allows"
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+            if step < 1:
+                raise ValueError("Invalid step in %s" % (field,))
+        if part == '*':
+            start, end = minimum, maximum
+        elif '-' in part:
+            start, end = (int(item) for item in part.split('-', 1))
+        else:
+            start = int(part)
+            end = maximum if step > 1 else start
+        if start < minimum or end > maximum or start > end:
+            raise ValueError("Value out of range in %s" % (field,))
+        values.update(range(start, end+1, step))
+    return tuple(sorted(values))
+
+
+class CronSpec(object):
+    """A cron specification, of five fields 'minute hour day-of-month month day-of-week',
+       each field is *, a number, a range a-b, a list a,b,c, any of these with a step /n.
+       Day of week is 0 to 7, with both 0 and 7 Sunday. As cron, if both day fields are
+       restricted, a day matching either is due. Times are local"""
+
+    def __init__(self, text):
+        fields = text.split()
+        if len(fields) != 5:
+            raise ValueError("A cron spec has five fields")
+        self.text = text
+        self.minutes = _parse_field(fields[0], 0, 59)
+        self.hours = _parse_field(fields[1], 0, 23)
+        self.days = _parse_field(fields[2], 1, 31)
+        self.months = frozenset(_parse_field(fields[3], 1, 12))
+        self.weekdays = frozenset(day % 7 for day in _parse_field(fields[4], 0, 7))
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+        self._day_set = frozenset(self.days)
+
+    def _day_due(self, day):
+        if day.month not in self.months:
+            return False
+        # python weekday has Monday 0, cron has Sunday 0
+        weekday = (day.weekday() + 1) % 7
+        if self._any_day:
+            return weekday in self.weekdays
+        if self._any_weekday:
+            return day.day in self._day_set
+        return (day.day in self._day_set) or (weekday in self.weekdays)
+
+    def next_after(self, timestamp):
+        "Returns the first due time after timestamp, or None if there is none within five years"
+        start = datetime.fromtimestamp(timestamp).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.replace(hour=0, minute=0)
+        for count in range(5*366):
+            if self._day_due(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        due = day.replace(hour=hour, minute=minute)
+                        if due >= start:
+                            return due.timestamp()
+            day += timedelta(days=1)
+
+
+class IntervalSpec(object):
+    "An interval specification 'every n', running every n seconds"
+
+    def __init__(self, text):
+        fields = text.split()
+        if len(fields) != 2 or fields[0] != 'every':
+            raise ValueError("An interval spec is 'every seconds'")
+        self.text = text
+        self.interval = float(fields[1])
+        if self.interval <= 0:
+            raise ValueError("The interval must be positive")
+
+    def next_after(self, timestamp):
+        return timestamp + self.interval
+
+
+def parse_spec(text):
+    "Returns a CronSpec or IntervalSpec, raises ValueError if text is invalid"
+    text = text.strip()
+    if text.startswith('every'):
+        return IntervalSpec(text)
+    return CronSpec(text)
+
+
+class Job(object):
+    "A schedule, with its next due time and counters"
+
+    def __init__(self, name, spec, action, args=(), misfire='once', enabled=True, last_run=None):
+        if not actions.is_registered(action):
+            raise ValueError("Unknown action %s" % (action,))
+        if misfire not in MISFIRE_POLICIES:
+            raise ValueError("Unknown misfire policy %s" % (misfire,))
+        self.name = name
+        self.spec = parse_spec(spec)
+        self.action = action
+        self.args = tuple(args)
+        self.misfire = misfire
+        self.enabled = enabled
+        self.last_run = last_run
+        self.next_run = None
+        # incremented each time the job is rescheduled, so stale heap entries are ignored
+        self.generation = 0
+        self.running = 0
+        self.runs = 0
+        self.errors = 0
+        self.misfires = 0
+        self.skipped = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+        self.last_duration = 0.0
+
+    def stats(self):
+        "Returns a dictionary of the job and its counters, lateness in seconds"
+        return {'name':self.name,
+                'spec':self.spec.text,
+                'action':self.action,
+                'args':list(self.args),
+                'misfire':self.misfire,
+                'enabled':self.enabled,
+                'next_run':self.next_run,
+                'last_run':self.last_run,
+                'runs':self.runs,
+                'errors':self.errors,
+                'misfires':self.misfires,
+                'skipped':self.skipped,
+                'last_lateness':round(self.last_lateness, 6),
+                'max_lateness':round(self.max_lateness, 6),
+                'mean_lateness':round(self.total_lateness / self.runs, 6) if self.runs else 0.0,
+                'last_duration':round(self.last_duration, 6)}
+
+
+class Scheduler(object):
+    """Holds jobs in a heap of (due time, sequence, generation, job), a single thread waits
+       for the earliest, and hands due runs to a bounded pool of worker threads, so a slow
+       action never delays another"""
+
+    def __init__(self, workers=_WORKERS, max_pending=_MAX_PENDING):
+        self._condition = threading.Condition()
+        self._heap = []
+        self._sequence = 0
+        # name : Job
+        self._jobs = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="SchedulerWorker")
+        self._max_pending = max_pending
+        self._pending = 0
+        self._thread = None
+        self._stop = False
+        # name : last run time, not yet written to the database
+        self._unsaved = {}
+        self._last_persist = time.monotonic()
+        self.clock_jumps = 0
+        self.rejected = 0
+
+    def _push(self, job):
+        "Adds the job at its next_run to the heap, the condition lock must be held"
+        job.generation += 1
+        if job.enabled and job.next_run is not None:
+            self._sequence += 1
+            heapq.heappush(self._heap, (job.next_run, self._sequence, job.generation, job))
+        self._condition.notify()
+
+    def add_job(self, job, now=None):
+        "Adds or replaces a job, a job with a previous last_run has runs missed since then treated as misfires"
+        if now is None:
+            now = time.time()
+        with self._condition:
+            old = self._jobs.get(job.name)
+            if old is not None:
+                # a replaced job must not be run from its old heap entries
+                old.generation += 1
+            self._jobs[job.name] = job
+            if job.last_run is not None:
+                job.next_run = job.spec.next_after(job.last_run)
+            else:
+                job.next_run = job.spec.next_after(now)
+            self._push(job)
+
+    def remove_job(self, name):
+        with self._condition:
+            job = self._jobs.pop(name, None)
+            if job is not None:
+                job.generation += 1
+
+    def get_job(self, name):
+        return self._jobs.get(name)
+
+    def jobs(self):
+        "Returns a list of job stats dictionaries, in order of next run"
+        with self._condition:
+            jobs = list(self._jobs.values())
+        jobs.sort(key=lambda job: (job.next_run is None, job.next_run or 0))
+        return [job.stats() for job in jobs]
+
+    def _reschedule_all(self, now):
+        "After the clock is changed, every job is given a due time from now, the condition lock must be held"
+        self._heap = []
+        for job in self._jobs.values():
+            job.next_run = job.spec.next_after(now)
+            self._push(job)
+
+    def _dispatch(self, job, due):
+        "Hands a run of the job to the worker pool, the condition lock must be held"
+        if job.running and job.misfire != 'all':
+            # the previous run has not finished, runs of a slow action are not stacked up
+            job.skipped += 1
+            return
+        if self._pending >= self._max_pending:
+            self.rejected += 1
+            job.skipped += 1
+            return
+        self._pending += 1
+        job.running += 1
+        self._executor.submit(self._run_job, job, due)
+
+    def _run_job(self, job, due):
+        start = time.time()
+        lateness = max(0.0, start - due)
+        try:
+            actions.run(job.action, job.args, 'scheduler')
+        except Exception:
+            job.errors += 1
+        finish = time.time()
+        with self._condition:
+            self._pending -= 1
+            job.running -= 1
+            job.runs += 1
+            job.last_run = start
+            job.last_lateness = lateness
+            job.total_lateness += lateness
+            if lateness > job.max_lateness:
+                job.max_lateness = lateness
+            job.last_duration = finish - start
+            self._unsaved[job.name] = start
+
+    def _due(self, job, due, now):
+        """Runs a due job, applying its misfire policy if it is late, and schedules
+           its next run, the condition lock must be held"""
+        if now - due <= _MISFIRE_GRACE:
+            self._dispatch(job, due)
+            # from the due time, so an interval does not drift by the lateness of each run
+            job.next_run = job.spec.next_after(due)
+        else:
+            job.misfires += 1
+            # catch up runs are due now, so lateness measures the scheduler, not the missed time
+            if job.misfire == 'once':
+                self._dispatch(job, now)
+            elif job.misfire == 'all':
+                count = 0
+                while (due is not None) and (due <= now) and (count < _MAX_CATCH_UP):
+                    self._dispatch(job, now)
+                    due = job.spec.next_after(due)
+                    count += 1
+            else:
+                job.skipped += 1
+            job.next_run = job.spec.next_after(now)
+        self._push(job)
+
+    def _persist(self):
+        with self._condition:
+            unsaved = self._unsaved
+            self._unsaved = {}
+        if unsaved and not database_ops.set_schedule_last_runs(unsaved):
+            # put them back to be tried again
+            with self._condition:
+                for name, last_run in unsaved.items():
+                    self._unsaved.setdefault(name, last_run)
+
+    def _run(self):
+        wall = time.time()
+        monotonic = time.monotonic()
+        while True:
+            with self._condition:
+                if self._stop:
+                    return
+                now = time.time()
+                now_monotonic = time.monotonic()
+                # the wall clock should advance as the monotonic clock does
+                if abs((now - wall) - (now_monotonic - monotonic)) > _CLOCK_JUMP:
+                    self.clock_jumps += 1
+                    if now < wall:
+                        # moved back, due times would be a long way off
+                        self._reschedule_all(now)
+                    # moved forward, due times now passed are handled as misfires
+                wall, monotonic = now, now_monotonic
+                while self._heap and self._heap[0][0] <= now:
+                    due, sequence, generation, job = heapq.heappop(self._heap)
+                    if generation != job.generation:
+                        # replaced, removed or rescheduled
+                        continue
+                    self._due(job, due, now)
+                # skip stale heap entries, so the wait is for a live job
+                while self._heap and (self._heap[0][2] != self._heap[0][3].generation):
+                    heapq.heappop(self._heap)
+                timeout = _PERSIST_INTERVAL
+                if self._heap:
+                    timeout = min(timeout, max(0, self._heap[0][0] - now))
+                # wake regularly to notice changes of the clock
+                self._condition.wait(min(timeout, 1.0))
+            if time.monotonic() - self._last_persist > _PERSIST_INTERVAL:
+                self._last_persist = time.monotonic()
+                self._persist()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="Scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        "Stops the scheduler thread, waits for running actions, and saves last run times"
+        if self._thread is None:
+            return
+        with self._condition:
+            self._stop = True
+            self._condition.notify()
+        self._thread.join()
+        self._thread = None
+        self._executor.shutdown()
+        self._persist()
+
+
+def start():
+    "Creates the scheduler, loads schedules from the database, and starts it"
+    global engine
+    if engine is not None:
+        return engine
+    engine = Scheduler()
+    now = time.time()
+    for name, spec, action, args, misfire, enabled, last_run in database_ops.get_schedules() or []:
+        try:
+            job = Job(name, spec, action, json.loads(args or '[]'), misfire, enabled, last_run)
+        except (ValueError, TypeError):
+            database_ops.set_message("Schedule %s is invalid and has not been loaded" % (name,),
+                                     level=database_ops.WARNING, category='scheduler')
+            continue
+        engine.add_job(job, now)
+    engine.start()
+    return engine
+
+
+def stop():
+    "Called on shutdown"
+    if engine is not None:
+        engine.stop()
+
+
+def add_schedule(name, spec, action, args=(), misfire='once', enabled=True):
+    """Adds or replaces a schedule, saving it in the database, raises ValueError if it is invalid.
+       For example add_schedule('lamp_on', '30 18 * * 1-5', 'set_output', ['output01', True])
+       sets output01 on at 18:30 each weekday, and add_schedule('flash', 'every 10', 'toggle_output', ['output01'])
+       toggles it every ten seconds"""
+    job = Job(name, spec, action, args, misfire, enabled)
+    if not database_ops.set_schedule(name, spec, action, json.dumps(list(args)), misfire, enabled):
+        raise ValueError("Unable to save schedule %s" % (name,))
+    if engine is not None:
+        engine.add_job(job)
+
+
+def remove_schedule(name):
+    "Removes a schedule, returns False if it could not be deleted from the database"
+    if engine is not None:
+        engine.remove_job(name)
+    return database_ops.delete_schedule(name)
+
+
+def jobs():
+    "Returns a list of job stats dictionaries"
+    if engine is None:
+        return []
+    return engine.jobs()
+
+
+def schedules_json(environ, start_response):
+    "WSGI handler, /api/schedules returns each job with its next run and lateness counters"
+    if engine is None:
+        return routes.json_response(start_response, {'jobs':[]})
+    return routes.json_response(start_response, {'jobs':engine.jobs(),
+                                                 'rejected':engine.rejected,
+                                                 'clock_jumps':engine.clock_jumps})
+
+
+# How to use
+
+# create an action function, and register it, for example
+#
+# def event1(*args):
+#     database_ops.set_message("Event 1 has run", category='scheduler')
+#
+# scheduler.register_action('event1', event1)
+#
+# then add a schedule to run it, at 2 minutes past each hour
+#
+# scheduler.add_schedule('event1', '2 * * * *', 'event1')
+#
+# schedules are kept in setup.db, and loaded when the scheduler is started,
+# so add_schedule is only needed once, or to change a schedule
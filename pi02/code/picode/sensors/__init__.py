@@ -14,12 +14,13 @@ def sensor_table(skicall):
 
 
 def _get_sensor_values(sensors):
-    "Returns list of sensor values"
+    "Returns list of sensor values, taken from the latest input snapshot"
+    snapshot = hardware.get_snapshot().values
     values = []
     for name in sensors:
         input_type = hardware.get_input_type(name)
         if input_type == 'boolean':
-            invalue = hardware.get_boolean_input(name)
+            invalue = snapshot.get(name)
             if invalue is None:
                 value = 'UNKNOWN'
             elif invalue:
@@ -27,9 +28,9 @@ def _get_sensor_values(sensors):
             else:
                 value = 'OFF'
         elif input_type == 'text':
-            value = hardware.get_text_input(name)
+            value = snapshot.get(name, '')
         elif input_type == 'float':
-            value = str(hardware.get_float_input(name))
+            value = str(snapshot.get(name))
         else:
             value = ''
         values.append(value)
@@ -0,0 +1,205 @@
+#######################################################
+#
+# sessions.py
+# holds the logged in sessions in memory, keyed by the
+# hash of their token, so protected requests are
+# authenticated without touching the database
+#
+#######################################################
+
+
+import hashlib, secrets, threading
+
+from datetime import datetime, timedelta
+
+from . import database_ops, metrics
+
+
+# a session lasts this long after logging in, the same as the max-age of its cookie
+_SESSION_LIFETIME = timedelta(hours=12)
+
+# last seen times are written to the sessions table at this interval, in seconds,
+# in one transaction for all sessions
+_FLUSH_INTERVAL = 30
+
+# cached sessions are checked against the database at this interval, in seconds, with one
+# query for all of them, so a session logged out through another web worker process is
+# accepted by this process for up to this long
+_REVALIDATE_INTERVAL = 5
+
+# expired sessions are deleted from the database at this interval, in seconds
+_EXPIRY_INTERVAL = 600
+
+# bytes of randomness in a token
+_TOKEN_BYTES = 24
+
+_lock = threading.Lock()
+
+# token hash : _Session, loaded from the database on first use
+_sessions = {}
+
+# token hash : last seen time, waiting to be written to the database
+_seen = {}
+
+_stop_event = threading.Event()
+_thread = None
+
+
+class _Session(object):
+
+    def __init__(self, user, expires):
+        self.user = user
+        self.expires = expires
+
+
+def token_hash(token):
+    "Returns the hash of a token, only the hash is held and stored"
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+
+def check_token(token):
+    """Returns the user logged in with this token, or None, and records the time
+       the session was last seen, which is written to the database in batches"""
+    if (not token) or (token == "000"):
+        return
+    key = token_hash(token)
+    now = datetime.utcnow()
+    try:
+        with _lock:
+            session = _sessions.get(key)
+        if session is None:
+            # not yet cached, such as after a restart, the database lookup is by primary key
+            result = database_ops.get_session(key)
+            if result is None:
+                return
+            user, created, last_seen, expires = result
+            session = _Session(user, expires)
+            with _lock:
+                session = _sessions.setdefault(key, session)
+        if session.expires <= now:
+            return
+        with _lock:
+            _seen[key] = now
+    except:
+        return
+    return session.user
+
+
+def create_session(user):
+    "Starts a new session for user, returns its token, or None on failure"
+    token = secrets.token_urlsafe(_TOKEN_BYTES)
+    key = token_hash(token)
+    now = datetime.utcnow()
+    expires = now + _SESSION_LIFETIME
+    if not database_ops.add_session(key, user, now, expires):
+        return
+    with _lock:
+        _sessions[key] = _Session(user, expires)
+    return token
+
+
+def end_session(token):
+    "Ends the session with this token, return True on success, False on failure"
+    if (not token) or (token == "000"):
+        return True
+    key = token_hash(token)
+    with _lock:
+        _sessions.pop(key, None)
+        _seen.pop(key, None)
+    return database_ops.delete_session(key)
+
+
+def end_user_sessions(user):
+    "Ends every session of user, return True on success, False on failure"
+    with _lock:
+        for key in [key for key, session in _sessions.items() if session.user == user]:
+            del _sessions[key]
+            _seen.pop(key, None)
+    return database_ops.delete_user_sessions(user)
+
+
+def active_sessions():
+    "Returns the number of cached sessions which have not expired"
+    now = datetime.utcnow()
+    with _lock:
+        return sum(1 for session in _sessions.values() if session.expires > now)
+
+
+metrics.Gauge('pi02_sessions_active', 'Logged in sessions held in memory', active_sessions)
+
+
+def flush():
+    "Writes held last seen times to the database, called periodically and on shutdown"
+    with _lock:
+        seen = _seen.copy()
+        _seen.clear()
+    if seen and not database_ops.set_sessions_last_seen(seen):
+        # keep them for the next attempt, unless newer times have been recorded since
+        with _lock:
+            for key, value in seen.items():
+                _seen.setdefault(key, value)
+
+
+def expire():
+    "Removes expired sessions from the cache, and deletes them from the database in batches"
+    now = datetime.utcnow()
+    with _lock:
+        for key in [key for key, session in _sessions.items() if session.expires <= now]:
+            del _sessions[key]
+            _seen.pop(key, None)
+    return database_ops.delete_expired_sessions(now)
+
+
+def revalidate():
+    """Removes cached sessions which are no longer in the database, such as those logged out
+       through another web worker process, when the pins are served by the hardware broker.
+       Called every _REVALIDATE_INTERVAL seconds, until then such a session is still accepted"""
+    with _lock:
+        keys = list(_sessions)
+    if not keys:
+        return
+    existing = database_ops.existing_sessions(keys)
+    if existing is None:
+        return
+    with _lock:
+        for key in keys:
+            if key not in existing:
+                _sessions.pop(key, None)
+                _seen.pop(key, None)
+
+
+def _run():
+    last_flush = last_expiry = datetime.utcnow()
+    while not _stop_event.wait(_REVALIDATE_INTERVAL):
+        try:
+            revalidate()
+            now = datetime.utcnow()
+            if now - last_flush >= timedelta(seconds=_FLUSH_INTERVAL):
+                last_flush = now
+                flush()
+            if now - last_expiry >= timedelta(seconds=_EXPIRY_INTERVAL):
+                last_expiry = now
+                expire()
+        except:
+            pass
+
+
+def start():
+    "Removes sessions which expired while stopped, and starts the thread writing last seen times"
+    global _thread
+    if _thread is not None:
+        return
+    expire()
+    _stop_event.clear()
+    _thread = threading.Thread(target=_run, name="Sessions", daemon=True)
+    _thread.start()
+
+
+def stop():
+    "Stops the session thread, and writes held last seen times"
+    global _thread
+    _stop_event.set()
+    if _thread is not None:
+        _thread.join()
+        _thread = None
+    flush()
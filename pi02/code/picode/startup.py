@@ -0,0 +1,121 @@
+#######################################################
+#
+# startup.py
+# times each phase of starting pi02, and runs work
+# which is not needed to drive the outputs or serve
+# the first request after startup, in the background
+#
+#######################################################
+
+
+import json, os, sys, threading, time
+
+
+# if this environment variable is set to 1 the startup timeline is printed,
+# any other value is taken as a file path, and the timeline written to it as JSON
+_REPORT_VARIABLE = 'PI02_STARTUP_REPORT'
+
+
+class Timeline(object):
+    "Records the start and duration of named phases, relative to the creation of the timeline"
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        # list of [name, start, duration, deferred]
+        self.phases = []
+        self._deferred = []
+        self._lock = threading.Lock()
+        self.ready = None
+        self.finished = threading.Event()
+
+    def phase(self, name, deferred=False):
+        "Returns a context manager timing the phase"
+        return _Phase(self, name, deferred)
+
+    def _record(self, name, start, duration, deferred):
+        with self._lock:
+            self.phases.append([name, start - self.origin, duration, deferred])
+
+    def mark_ready(self):
+        "Records the time at which the application is ready to serve requests"
+        self.ready = time.perf_counter() - self.origin
+
+    def defer(self, name, function, *args, **kwargs):
+        "Adds function(*args, **kwargs) to the work run in the background by run_deferred"
+        self._deferred.append((name, function, args, kwargs))
+
+    def run_deferred(self):
+        "Runs the deferred work in order in a background thread, then reports the timeline"
+        deferred = self._deferred
+        self._deferred = []
+
+        def run():
+            for name, function, args, kwargs in deferred:
+                try:
+                    with self.phase(name, deferred=True):
+                        function(*args, **kwargs)
+                except Exception as e:
+                    print("Deferred startup %s failed: %s" % (name, e), file=sys.stderr)
+            self.report()
+            self.finished.set()
+
+        thread = threading.Thread(target=run, name="DeferredStartup", daemon=True)
+        thread.start()
+        return thread
+
+    def as_dict(self):
+        with self._lock:
+            phases = [{'name':name, 'start_ms':round(start*1000, 3), 'duration_ms':round(duration*1000, 3), 'deferred':deferred}
+                      for name, start, duration, deferred in self.phases]
+        return {'ready_ms':None if self.ready is None else round(self.ready*1000, 3),
+                'phases':phases}
+
+    def text(self):
+        "Returns the timeline as a table"
+        data = self.as_dict()
+        lines = ["%-32s %10s %10s" % ('phase', 'start ms', 'ms')]
+        for phase in data['phases']:
+            name = phase['name'] + (' (deferred)' if phase['deferred'] else '')
+            lines.append("%-32s %10.1f %10.1f" % (name, phase['start_ms'], phase['duration_ms']))
+        if data['ready_ms'] is not None:
+            lines.append("%-32s %10.1f" % ('ready', data['ready_ms']))
+        return "\n".join(lines)
+
+    def report(self):
+        "Prints or writes the timeline, if requested by the PI02_STARTUP_REPORT environment variable"
+        destination = os.environ.get(_REPORT_VARIABLE)
+        if not destination:
+            return
+        if destination == '1':
+            print(self.text())
+            return
+        with open(destination, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+
+class _Phase(object):
+
+    def __init__(self, timeline, name, deferred):
+        self.timeline = timeline
+        self.name = name
+        self.deferred = deferred
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timeline._record(self.name, self.start, time.perf_counter() - self.start, self.deferred)
+        return False
+
+
+timeline = Timeline()
+
+
+def startup_json(environ, start_response):
+    "WSGI handler, /api/startup returns the startup timeline"
+    body = json.dumps(timeline.as_dict()).encode('utf-8')
+    start_response('200 OK', [('Content-Type', 'application/json'),
+                              ('Content-Length', str(len(body))),
+                              ('Cache-Control', 'no-cache')])
+    return [body]
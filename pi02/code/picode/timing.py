@@ -0,0 +1,320 @@
+#######################################################
+#
+# timing.py
+# timed pulses and low frequency software PWM on
+# boolean outputs, driven by one thread from a heap of
+# transitions on the monotonic clock
+#
+#######################################################
+
+
+import heapq, threading, time
+
+from . import database_ops, hardware, events, metrics
+
+
+# by default the timing thread waits on its condition until a transition is due. Given a
+# spin of a few milliseconds, it waits until that long before, and then polls the clock, as
+# a wait may overrun by a scheduler tick, at the cost of a busy processor while polling
+_SPIN = 0
+
+# limits of a pulse length, and of a PWM period, in seconds
+_MIN_PULSE = 0.001
+_MAX_PULSE = 3600
+_MIN_PERIOD = 0.02
+_MAX_PERIOD = 3600
+
+# a PWM output which falls more than this many periods behind starts a new cycle now,
+# rather than running the missed cycles late
+_MAX_LAG = 1
+
+engine = None
+
+_LATENESS_SECONDS = metrics.Histogram('pi02_timing_lateness_seconds',
+                                      'Time from a pulse or PWM transition being due to the output being set', ('output',))
+
+
+class _Program(object):
+    "A pulse or PWM running on an output, restore is the stored value the output returns to when it ends"
+
+    def __init__(self, kind, name, restore, level=True, duration=0, period=0, duty=0):
+        self.kind = kind
+        self.name = name
+        self.restore = restore
+        self.level = level
+        self.duration = duration
+        self.period = period
+        self.duty = duty
+        self.started = time.time()
+        self.cycle_start = None
+        self.cycles = 0
+        self.resyncs = 0
+        self.cancelled = False
+
+    def info(self):
+        result = {'kind':self.kind, 'started':self.started}
+        if self.kind == 'pulse':
+            result.update({'level':self.level, 'duration':self.duration})
+        else:
+            result.update({'period':self.period, 'duty':self.duty, 'cycles':self.cycles, 'resyncs':self.resyncs})
+        return result
+
+
+class _Jitter(object):
+    "Lateness of the transitions of one output, in seconds"
+
+    __slots__ = ('count', 'total', 'maximum', 'last')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.last = 0.0
+
+    def add(self, lateness):
+        self.count += 1
+        self.total += lateness
+        self.last = lateness
+        if lateness > self.maximum:
+            self.maximum = lateness
+
+    def stats(self):
+        return {'transitions':self.count,
+                'last_lateness':round(self.last, 6),
+                'max_lateness':round(self.maximum, 6),
+                'mean_lateness':round(self.total / self.count, 6) if self.count else 0.0}
+
+
+class TimingEngine(object):
+    """Holds the pending transitions of every output in one heap of (due, sequence, program, level),
+       with due on the monotonic clock, a single thread sets each output as its transition falls due.
+       Each output runs at most one program, starting another, or setting the output, replaces it.
+       Outputs are only set with the condition lock held, so a transition never follows a cancel"""
+
+    def __init__(self, spin=_SPIN):
+        self._condition = threading.Condition()
+        self._heap = []
+        self._sequence = 0
+        # output name : _Program
+        self._programs = {}
+        # output name : _Jitter
+        self._jitter = {}
+        self._spin = spin
+        self._thread = None
+        self._stop = False
+
+    def _push(self, due, program, level):
+        "The condition lock must be held"
+        self._sequence += 1
+        heapq.heappush(self._heap, (due, self._sequence, program, level))
+        self._condition.notify()
+
+    def _set(self, name, level, due=None):
+        """Sets the output, and publishes the change to the event stream, recording its lateness
+           if due is given, the condition lock must be held"""
+        if due is not None:
+            lateness = max(0.0, time.monotonic() - due)
+            jitter = self._jitter.get(name)
+            if jitter is None:
+                jitter = self._jitter[name] = _Jitter()
+            jitter.add(lateness)
+            if metrics.enabled:
+                _LATENESS_SECONDS.observe(lateness, name)
+        hardware.set_boolean_output(name, level)
+        events.publish_output(name, level)
+
+    def _replace(self, name, program):
+        "Cancels any program on the output, and records the new one, the condition lock must be held"
+        old = self._programs.pop(name, None)
+        if old is not None:
+            old.cancelled = True
+        if program is not None:
+            self._programs[name] = program
+        return old
+
+    def pulse(self, name, duration, level, restore):
+        "Sets the output to level now, and to restore after duration seconds"
+        with self._condition:
+            program = _Program('pulse', name, restore, level=level, duration=duration)
+            self._replace(name, program)
+            self._set(name, level)
+            self._push(time.monotonic() + duration, program, restore)
+        self._start()
+
+    def pwm(self, name, period, duty, restore):
+        "Sets the output on for duty of each period seconds, starting now"
+        with self._condition:
+            program = _Program('pwm', name, restore, period=period, duty=duty)
+            self._replace(name, program)
+            program.cycle_start = time.monotonic()
+            self._set(name, duty > 0)
+            if 0 < duty < 1:
+                self._push(program.cycle_start + duty * period, program, False)
+        self._start()
+
+    def cancel(self, name, restore=True):
+        """Stops any program on the output, setting it to the stored value it had
+           when the program started if restore is True, returns True if there was one"""
+        with self._condition:
+            old = self._replace(name, None)
+            if old is None:
+                return False
+            if restore:
+                self._set(name, old.restore)
+        return True
+
+    def _transition(self, program, level, due):
+        "Sets the output, and pushes the next transition of a PWM, the condition lock must be held"
+        self._set(program.name, level, due)
+        if program.kind == 'pulse':
+            del self._programs[program.name]
+            return
+        if level:
+            program.cycle_start = due
+            self._push(due + program.duty * program.period, program, False)
+            return
+        program.cycles += 1
+        following = program.cycle_start + program.period
+        now = time.monotonic()
+        if now - following > _MAX_LAG * program.period:
+            # fallen behind, such as after the system was suspended
+            program.resyncs += 1
+            following = now
+        self._push(following, program, True)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._stop:
+                        return
+                    # discard transitions of cancelled programs
+                    while self._heap and self._heap[0][2].cancelled:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    due = self._heap[0][0]
+                    delay = due - time.monotonic()
+                    if delay <= self._spin:
+                        break
+                    self._condition.wait(delay - self._spin)
+            if self._spin:
+                # poll the clock for the final part, without the lock so programs may be changed
+                while time.monotonic() < due:
+                    pass
+            with self._condition:
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    due, sequence, program, level = heapq.heappop(self._heap)
+                    if not program.cancelled:
+                        self._transition(program, level, due)
+
+    def _start(self):
+        with self._condition:
+            if (self._thread is not None) or self._stop:
+                return
+            self._thread = threading.Thread(target=self._run, name="Timing", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        "Stops the thread, and sets outputs which were running a program to their power up values"
+        with self._condition:
+            self._stop = True
+            programs = list(self._programs.values())
+            self._programs = {}
+            self._heap = []
+            for program in programs:
+                program.cancelled = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if programs:
+            power_up = database_ops.power_up_values()
+            for program in programs:
+                level = power_up.get(program.name, program.restore)
+                hardware.set_boolean_output(program.name, level)
+                events.publish_output(program.name, level)
+
+    def stats(self):
+        "Returns a dictionary of output name : running program, and lateness statistics of its transitions"
+        with self._condition:
+            names = set(self._programs) | set(self._jitter)
+            result = {}
+            for name in sorted(names):
+                program = self._programs.get(name)
+                jitter = self._jitter.get(name)
+                result[name] = {'program':program.info() if program is not None else None}
+                result[name].update(jitter.stats() if jitter is not None else _Jitter().stats())
+            return result
+
+
+def _engine():
+    "Returns the engine, created on first use, its thread is started by the first program"
+    global engine
+    if engine is None:
+        engine = TimingEngine()
+    return engine
+
+
+def _check_output(name):
+    if hardware.get_output_type(name) != 'boolean':
+        raise ValueError("%s is not a boolean output" % (name,))
+
+
+def _check_number(value, minimum, maximum, label):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not (minimum <= value <= maximum):
+        raise ValueError("%s must be a number from %s to %s" % (label, minimum, maximum))
+
+
+def pulse(name, duration, level=True):
+    """Sets boolean output name to level for duration seconds, then returns it to its stored value,
+       raises ValueError if invalid"""
+    _check_output(name)
+    _check_number(duration, _MIN_PULSE, _MAX_PULSE, "duration")
+    _engine().pulse(name, duration, bool(level), bool(database_ops.get_output(name)))
+
+
+def pwm(name, period, duty):
+    """Runs software PWM on boolean output name, on for duty, a fraction from 0 to 1, of each
+       period seconds, until stopped or the output is set. A duty of 0 or 1 holds the output
+       off or on, with no transitions. Raises ValueError if invalid"""
+    _check_output(name)
+    _check_number(period, _MIN_PERIOD, _MAX_PERIOD, "period")
+    _check_number(duty, 0, 1, "duty")
+    _engine().pwm(name, period, duty, bool(database_ops.get_output(name)))
+
+
+def cancel(name, restore=True):
+    "Stops any pulse or PWM on the output, returning it to its stored value if restore is True"
+    if engine is None:
+        return False
+    return engine.cancel(name, restore)
+
+
+def stop():
+    "Called on shutdown, outputs running a pulse or PWM are set to their power up values"
+    if engine is not None:
+        engine.stop()
+
+
+def stats():
+    if engine is None:
+        return {}
+    return engine.stats()
+
+
+# How to use
+#
+# pulse output01 on for 250 milliseconds
+#
+# timing.pulse('output01', 0.25)
+#
+# run a heater on output01 for 30% of each ten second period
+#
+# timing.pwm('output01', 10, 0.3)
+#
+# these are also available through control.pulse_output and control.pwm_output, and
+# as the JSON endpoint /api/timing, setting the output, with control._set_output
+# or the web pages, stops them
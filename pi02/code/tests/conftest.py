@@ -0,0 +1,49 @@
+#######################################################
+#
+# conftest.py
+# runs the tests with simulated GPIO pins, and gives
+# each test needing a database a new one in a
+# temporary directory
+#
+#######################################################
+
+# usage, from the pi02/code directory
+#
+#   python3 -m pytest -q tests
+
+
+import os, sys
+
+# the backend is selected when picode.hardware is imported
+os.environ['PI02_GPIO'] = 'simulated'
+os.environ.pop('PI02_DB_WORKING_DIR', None)
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if CODE_DIR not in sys.path:
+    sys.path.insert(0, CODE_DIR)
+
+import pytest
+
+from picode import database_ops, hardware
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Starts database_ops with a new database beneath tmp_path, and stops it after the test,
+       so the next test may start another"""
+    monkeypatch.setattr(database_ops, '_WORKING_DIR', '')
+    database_ops.start_database('pi02', str(tmp_path))
+    yield database_ops
+    database_ops.stop_database()
+    database_ops._DATABASE_EXISTS = False
+    database_ops._POOL = None
+    database_ops._snapshotter = None
+
+
+@pytest.fixture
+def backend():
+    "The simulated GPIO backend, with the pins set up, and output01 off"
+    sim = hardware.get_backend()
+    hardware.initial_setup_outputs()
+    hardware.set_boolean_output('output01', False)
+    return sim
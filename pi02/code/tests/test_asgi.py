@@ -0,0 +1,226 @@
+#######################################################
+#
+# test_asgi.py
+# the ASGI front end driven with fake scope, receive
+# and send, routing, WSGI calls on the worker threads,
+# the event stream, and the shutdown functions
+#
+#######################################################
+
+
+import asyncio, json, threading
+
+import pytest
+
+from picode import asgi, events
+
+
+def _scope(path, method='GET', query=b'', headers=()):
+    return {'type':'http', 'http_version':'1.1', 'method':method, 'scheme':'http', 'path':path,
+            'query_string':query, 'root_path':'', 'headers':list(headers),
+            'client':('127.0.0.1', 50000), 'server':('127.0.0.1', 8000)}
+
+
+def _request(app, scope, body=b''):
+    "Runs the request to completion, returns (status, headers dictionary, body)"
+
+    async def run():
+        messages = [{'type':'http.request', 'body':body, 'more_body':False}]
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            return {'type':'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        await app(scope, receive, send)
+        return sent
+
+    sent = asyncio.run(run())
+    start = sent[0]
+    assert start['type'] == 'http.response.start'
+    return start['status'], dict(start['headers']), b''.join(message.get('body', b'') for message in sent[1:])
+
+
+def _wsgi_application(environ, start_response):
+    "Returns the environ it was called with, and the name of the thread it ran on"
+    body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+    data = {'method':environ['REQUEST_METHOD'], 'path':environ['PATH_INFO'], 'query':environ['QUERY_STRING'],
+            'cookie':environ.get('HTTP_COOKIE'), 'type':environ.get('CONTENT_TYPE'),
+            'body':body.decode('utf-8'), 'thread':threading.current_thread().name}
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [json.dumps(data).encode('utf-8')]
+
+
+@pytest.fixture
+def app():
+    result = asgi.ASGIApplication(_wsgi_application, workers=2,
+                                  logged_in=lambda environ: environ.get('HTTP_COOKIE') == 'pi022=valid')
+    yield result
+    result.shutdown()
+
+
+async def _stream(scope, receive, send):
+    await send({'type':'http.response.start', 'status':200, 'headers':[]})
+    await send({'type':'http.response.body', 'body':b'stream'})
+
+
+def test_requests_are_passed_to_the_wsgi_application_on_a_worker_thread(app):
+    scope = _scope('/control', 'POST', b'a=1', [(b'content-type', b'text/plain'), (b'cookie', b'pi022=valid')])
+    status, headers, body = _request(app, scope, b'value')
+    assert status == 200
+    assert headers[b'content-type'] == b'application/json'
+    assert json.loads(body.decode('utf-8')) == {'method':'POST', 'path':'/control', 'query':'a=1', 'cookie':'pi022=valid',
+                                                'type':'text/plain', 'body':'value', 'thread':json.loads(body)['thread']}
+    # not run on the event loop
+    assert json.loads(body)['thread'].startswith('WSGIWorker')
+    assert app.wsgi_calls == 1
+
+
+def test_wsgi_calls_run_concurrently_on_the_pool(app):
+    release = threading.Event()
+    running = []
+
+    def slow_application(environ, start_response):
+        running.append(environ['PATH_INFO'])
+        # both calls must be running at once for either to finish
+        if len(running) == 2:
+            release.set()
+        assert release.wait(2)
+        start_response('200 OK', [])
+        return [b'done']
+
+    app.wsgi_application = slow_application
+
+    async def both():
+        return await asyncio.gather(*[asyncio.get_running_loop().run_in_executor(None, _request, app, _scope(path))
+                                      for path in ('/one', '/two')])
+
+    assert [result[2] for result in asyncio.run(both())] == [b'done', b'done']
+    assert sorted(running) == ['/one', '/two']
+
+
+def test_routes_are_served_on_the_event_loop_and_protected(app):
+    app.add_route('/api/stream', _stream)
+    app.add_route('/api/public', _stream, protected=False)
+    status, headers, body = _request(app, _scope('/api/stream'))
+    assert (status, body) == (403, b'{"error": "Not logged in"}')
+    status, headers, body = _request(app, _scope('/api/stream', headers=[(b'cookie', b'pi022=valid')]))
+    assert (status, body) == (200, b'stream')
+    assert _request(app, _scope('/api/public'))[0] == 200
+    # none were passed to the WSGI application
+    assert app.wsgi_calls == 0
+
+
+def test_a_request_body_beyond_the_limit_is_refused(app, monkeypatch):
+    monkeypatch.setattr(asgi, '_MAX_BODY', 4)
+    status, headers, body = _request(app, _scope('/control', 'POST'), b'too long')
+    assert status == 413
+    assert app.wsgi_calls == 0
+
+
+def test_lifespan_shutdown_calls_the_shutdown_functions_once(app):
+    called = []
+
+    def failing():
+        called.append('failing')
+        raise RuntimeError("fails")
+
+    app.add_shutdown(lambda: called.append('first'))
+    app.add_shutdown(failing)
+    app.add_shutdown(lambda: called.append('last'))
+
+    async def lifespan():
+        messages = [{'type':'lifespan.startup'}, {'type':'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        await app({'type':'lifespan'}, receive, send)
+        return sent
+
+    assert asyncio.run(lifespan()) == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    # a failure does not stop the others
+    assert called == ['first', 'failing', 'last']
+    app.shutdown()
+    assert called == ['first', 'failing', 'last']
+    # the workers have stopped, so requests are refused
+    assert _request(app, _scope('/control'))[0] == 503
+
+
+def test_the_event_stream_sends_current_values_then_published_events(app, monkeypatch):
+    monkeypatch.setattr(events, 'broker', events.EventBroker())
+    events.broker.publish('output', 'output01', False)
+    app.add_route('/api/events', asgi.event_stream_asgi)
+
+    async def run():
+        sent = []
+        disconnect = asyncio.Event()
+
+        async def receive():
+            await disconnect.wait()
+            return {'type':'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+            if len(sent) == 3:
+                # the initial events have been sent, publish from another thread, as the input pipeline does
+                threading.Thread(target=events.broker.publish, args=('output', 'output01', True)).start()
+            elif len(sent) == 4:
+                disconnect.set()
+
+        scope = _scope('/api/events', headers=[(b'cookie', b'pi022=valid')])
+        await asyncio.wait_for(app(scope, receive, send), 5)
+        return sent
+
+    sent = asyncio.run(run())
+    assert sent[0]['status'] == 200
+    assert (b'content-type', b'text/event-stream') in sent[0]['headers']
+    assert sent[1]['body'] == b"retry: 2000\n\n"
+    assert json.loads(sent[2]['body'].decode('utf-8').split('data: ')[1])['value'] is False
+    assert sent[3]['body'].startswith(b"id: 2\nevent: output\n")
+    assert json.loads(sent[3]['body'].decode('utf-8').split('data: ')[1])['value'] is True
+    # the stream ends, and its subscription is removed
+    assert sent[-1] == {'type':'http.response.body', 'body':b'', 'more_body':False}
+    assert events.broker.subscriber_count == 0
+
+
+def test_closing_all_subscriptions_ends_the_event_stream(app, monkeypatch):
+    monkeypatch.setattr(events, 'broker', events.EventBroker())
+    app.add_route('/api/events', asgi.event_stream_asgi)
+
+    async def run():
+        sent = []
+
+        async def receive():
+            await asyncio.sleep(10)
+
+        async def send(message):
+            sent.append(message)
+            if len(sent) == 2:
+                # as on shutdown, before the requests in progress are awaited
+                asyncio.get_running_loop().call_later(0.1, events.broker.close_all)
+
+        await asyncio.wait_for(app(_scope('/api/events', headers=[(b'cookie', b'pi022=valid')]), receive, send), 5)
+        return sent
+
+    sent = asyncio.run(run())
+    assert sent[-1] == {'type':'http.response.body', 'body':b'', 'more_body':False}
+
+
+def test_wsgi_environ_joins_repeated_headers_and_decodes_the_path():
+    scope = _scope('/café', headers=[(b'accept', b'text/html'), (b'accept', b'application/json'),
+                                           (b'content-length', b'3')])
+    environ = asgi.wsgi_environ(scope, b'abc')
+    assert environ['HTTP_ACCEPT'] == 'text/html,application/json'
+    assert environ['CONTENT_LENGTH'] == '3'
+    # WSGI strings are the bytes of the path, decoded as latin-1
+    assert environ['PATH_INFO'].encode('latin-1').decode('utf-8') == '/café'
+    assert environ['wsgi.input'].read() == b'abc'
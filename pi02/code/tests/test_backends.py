@@ -0,0 +1,31 @@
+import sys, types
+
+from picode import backends, hardware
+
+
+def test_rpi_unavailable_means_no_gpio(monkeypatch):
+    "RPi.GPIO raises RuntimeError when imported other than on a Raspberry Pi, which is not fatal"
+    class Unavailable(object):
+        def __init__(self):
+            raise RuntimeError("This module can only be run on a Raspberry Pi!")
+    monkeypatch.setattr(hardware, '_backend', hardware.get_backend())
+    monkeypatch.setattr(backends, 'RPiBackend', Unavailable)
+    monkeypatch.delenv('PI02_GPIO')
+    assert hardware.select_backend() is None
+    assert hardware.get_boolean_output('output01') is None
+
+
+def test_rpi_mode_is_set_with_the_pins(monkeypatch):
+    calls = []
+    gpio = types.SimpleNamespace(BCM='BCM', OUT='OUT', RISING=1, FALLING=2, BOTH=3,
+                                 setmode=lambda mode: calls.append(('setmode', mode)),
+                                 setup=lambda bcm, *args, **kwargs: calls.append(('setup', bcm)))
+    package = types.ModuleType('RPi')
+    package.GPIO = gpio
+    monkeypatch.setitem(sys.modules, 'RPi', package)
+    monkeypatch.setitem(sys.modules, 'RPi.GPIO', gpio)
+    rpi = backends.RPiBackend()
+    assert calls == []
+    rpi.start()
+    rpi.setup_output(24)
+    assert calls == [('setmode', 'BCM'), ('setup', 24)]
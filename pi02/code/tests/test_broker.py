@@ -0,0 +1,124 @@
+#######################################################
+#
+# test_broker.py
+# the hardware broker serving simulated pins, edge
+# events, and output change notifications to several
+# web worker backends
+#
+#######################################################
+
+
+import os, queue, tempfile
+
+import pytest
+
+from picode import backends, broker, events
+
+
+@pytest.fixture
+def server():
+    "A broker serving a simulated backend, on a short socket path, with pin 23 an input and 24 an output"
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'broker.sock')
+    result = broker.BrokerServer(backends.SimulatedBackend(), path)
+    result.add_pins('input', [23])
+    result.add_pins('output', [24])
+    result.backend.setup_input(23, True)
+    result.backend.setup_output(24)
+    result.start()
+    yield result
+    result.stop()
+    os.rmdir(directory)
+
+
+@pytest.fixture
+def workers(server):
+    "Two worker backends connected to the broker"
+    result = [broker.BrokerBackend(server.path), broker.BrokerBackend(server.path)]
+    yield result
+    for worker in result:
+        worker.cleanup()
+
+
+def _watch(worker):
+    "Watches the worker backend, returning the queue of changes it is notified of"
+    received = queue.Queue()
+    worker.watch(lambda kind, name, value: received.put((kind, name, value)))
+    return received
+
+
+def test_workers_share_the_pins(server, workers):
+    first, second = workers
+    first.output(24, 1)
+    assert second.input(24) == 1
+    assert server.backend.levels[24] == 1
+    timestamp, levels = second.snapshot()
+    assert levels == {23:1, 24:1}
+
+
+def test_edges_are_sent_to_subscribed_workers(server, workers):
+    first, second = workers
+    edges = queue.Queue()
+    first.add_event_detect(23, backends.BOTH, lambda bcm: edges.put(('first', first.input(bcm))))
+    second.add_event_detect(23, backends.FALLING, lambda bcm: edges.put(('second', second.input(bcm))))
+    server.backend.set_input(23, 0)
+    server.backend.set_input(23, 1)
+    received = [edges.get(timeout=2) for count in range(3)]
+    assert sorted(received) == [('first', 0), ('first', 1), ('second', 0)]
+
+
+def test_a_published_change_is_sent_to_every_watching_worker(server, workers):
+    published = []
+    server.on_publish = lambda kind, name, value: (published.append((kind, name, value)),
+                                                   server.notify(kind, name, value))
+    first, second = workers
+    first_received = _watch(first)
+    second_received = _watch(second)
+    first.publish('output', 'output01', True)
+    assert published == [('output', 'output01', True)]
+    assert second_received.get(timeout=2) == ('output', 'output01', True)
+    assert first_received.get(timeout=2) == ('output', 'output01', True)
+    # a change made in the broker process
+    server.notify('output', 'output01', False)
+    assert second_received.get(timeout=2) == ('output', 'output01', False)
+    assert server.stats()['watchers'] == 2
+
+
+def test_workers_learn_of_outputs_set_elsewhere(server, workers, monkeypatch):
+    "As pi02_broker.py connects the broker process event broker to the server"
+    broker_events = events.EventBroker()
+    server.on_publish = broker_events.publish
+    broker_events.add_listener(lambda event: server.notify(event.kind, event.name, event.value))
+    first, second = workers
+    worker_events = events.EventBroker()
+    subscription = worker_events.subscribe()
+    second.watch(lambda kind, name, value: worker_events.publish(kind, name, value))
+    # the first worker sets the output, as events.publish_output does with the pins owned by the broker
+    monkeypatch.setattr(events, 'broker', events.EventBroker())
+    monkeypatch.setattr(events, '_remote', first)
+    events.publish_output('output01', True)
+    event = subscription.get(2)
+    assert (event.kind, event.name, event.value) == ('output', 'output01', True)
+    assert worker_events.version('output') == event.id
+    # set by the scheduler, rules or timing in the broker process
+    broker_events.publish('output', 'output01', False)
+    event = subscription.get(2)
+    assert (event.kind, event.name, event.value) == ('output', 'output01', False)
+
+
+def test_watch_is_made_again_after_the_broker_restarts(server, workers):
+    first, second = workers
+    received = _watch(first)
+    server.stop()
+    with pytest.raises(broker.BrokerError):
+        first.publish('output', 'output01', True)
+    restarted = broker.BrokerServer(server.backend, server.path)
+    restarted.on_publish = restarted.notify
+    restarted.start()
+    try:
+        # the worker connects again on its next call, as its sampler would make
+        first.input(24)
+        second.publish('output', 'output01', True)
+        assert received.get(timeout=2) == ('output', 'output01', True)
+    finally:
+        restarted.stop()
@@ -0,0 +1,134 @@
+#######################################################
+#
+# test_conditional.py
+# ETags and 304 Not Modified responses of the refresh
+# paths, versioned by the published input and output
+# changes, and by the refresh interval for the server
+# time
+#
+#######################################################
+
+
+from types import SimpleNamespace
+
+import pytest
+
+from picode import events, routes
+
+
+def _application(environ, start_response):
+    "Stands in for the skipole application, serving the page data"
+    start_response('200 OK', [('Content-Type', 'application/json'), ('Cache-Control', 'no-store')])
+    return [b'{}']
+
+
+# the time of the requests, at the start of a refresh interval
+_now = [0.0]
+
+
+@pytest.fixture
+def dispatcher(monkeypatch):
+    "A dispatcher serving /sensors_refresh and /control_refresh to a logged in user, with a new event broker"
+    monkeypatch.setattr(events, 'broker', events.EventBroker())
+    monkeypatch.setattr(events, '_started', True)
+    monkeypatch.setattr(routes, 'time', SimpleNamespace(time=lambda: _now[0]))
+    _now[0] = 1800000000.0
+    result = routes.Dispatcher(_application, 'pi02')
+    monkeypatch.setattr(result, 'user', lambda environ: 'admin')
+    result.add_conditional('/sensors_refresh', events.input_version, 30)
+    result.add_conditional('/control_refresh', events.output_version, 60)
+    return result
+
+
+def _get(dispatcher, path, etag=None):
+    "Returns the status and headers of a GET of path"
+    environ = {'PATH_INFO':path, 'REQUEST_METHOD':'GET'}
+    if etag is not None:
+        environ['HTTP_IF_NONE_MATCH'] = etag
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = dict(headers)
+
+    b''.join(dispatcher(environ, start_response))
+    return response['status'], response['headers']
+
+
+def _sample(values):
+    "Publishes a snapshot of input values, as the input sampler does"
+    events._sample_listener(SimpleNamespace(values=values))
+
+
+def test_unchanged_inputs_are_not_modified(dispatcher):
+    _sample({'input01':True, 'input02':'Sun Oct 18 08:00:00 2026'})
+    status, headers = _get(dispatcher, '/sensors_refresh')
+    assert status == '200 OK'
+    etag = headers['ETag']
+    assert headers['Cache-Control'] == 'no-cache'
+    status, headers = _get(dispatcher, '/sensors_refresh', etag)
+    assert status == '304 Not Modified'
+    assert dispatcher.not_modified == 1
+
+
+def test_the_server_time_does_not_change_the_input_version(dispatcher):
+    _sample({'input01':True, 'input02':'Sun Oct 18 08:00:00 2026'})
+    etag = _get(dispatcher, '/sensors_refresh')[1]['ETag']
+    _sample({'input01':True, 'input02':'Sun Oct 18 08:00:01 2026'})
+    assert _get(dispatcher, '/sensors_refresh', etag)[0] == '304 Not Modified'
+    # though it is still sent to event stream subscribers
+    assert ('input', 'input02', 'Sun Oct 18 08:00:01 2026') in events.broker.current_values()
+
+
+def test_the_server_time_is_served_anew_each_refresh_interval(dispatcher):
+    _sample({'input01':True, 'input02':'Sun Oct 18 08:00:00 2026'})
+    etag = _get(dispatcher, '/sensors_refresh')[1]['ETag']
+    _sample({'input01':True, 'input02':'Sun Oct 18 08:00:29 2026'})
+    _now[0] += 29
+    assert _get(dispatcher, '/sensors_refresh', etag)[0] == '304 Not Modified'
+    _sample({'input01':True, 'input02':'Sun Oct 18 08:00:30 2026'})
+    _now[0] += 1
+    status, headers = _get(dispatcher, '/sensors_refresh', etag)
+    assert status == '200 OK'
+    assert headers['ETag'] != etag
+    # the control page, refreshed every minute, is still unchanged
+    etag = _get(dispatcher, '/control_refresh')[1]['ETag']
+    _now[0] += 29
+    assert _get(dispatcher, '/control_refresh', etag)[0] == '304 Not Modified'
+    _now[0] += 1
+    assert _get(dispatcher, '/control_refresh', etag)[0] == '200 OK'
+
+
+def test_a_tag_without_a_period_depends_on_the_version_alone(dispatcher):
+    dispatcher.add_conditional('/other_refresh', events.output_version)
+    events.publish_output('output01', False)
+    etag = _get(dispatcher, '/other_refresh')[1]['ETag']
+    _now[0] += 3600
+    assert _get(dispatcher, '/other_refresh', etag)[0] == '304 Not Modified'
+
+
+def test_a_changed_input_is_served_with_a_new_tag(dispatcher):
+    _sample({'input01':True, 'input02':'Sun Oct 18 08:00:00 2026'})
+    etag = _get(dispatcher, '/sensors_refresh')[1]['ETag']
+    _sample({'input01':False, 'input02':'Sun Oct 18 08:00:00 2026'})
+    status, headers = _get(dispatcher, '/sensors_refresh', etag)
+    assert status == '200 OK'
+    assert headers['ETag'] != etag
+
+
+def test_outputs_are_versioned_separately(dispatcher):
+    events.publish_output('output01', False)
+    etag = _get(dispatcher, '/control_refresh')[1]['ETag']
+    _sample({'input01':False})
+    assert _get(dispatcher, '/control_refresh', etag)[0] == '304 Not Modified'
+    events.publish_output('output01', True)
+    assert _get(dispatcher, '/control_refresh', etag)[0] == '200 OK'
+
+
+def test_a_user_not_logged_in_is_given_no_tag(dispatcher, monkeypatch):
+    _sample({'input01':True})
+    etag = _get(dispatcher, '/sensors_refresh')[1]['ETag']
+    monkeypatch.setattr(dispatcher, 'user', lambda environ: None)
+    status, headers = _get(dispatcher, '/sensors_refresh', etag)
+    assert status == '200 OK'
+    assert 'ETag' not in headers
@@ -0,0 +1,140 @@
+#######################################################
+#
+# test_history.py
+# recording of input readings, minute and hour rollups,
+# retention, the /api/history endpoint, and the store
+# kept in a working directory
+#
+#######################################################
+
+
+import json, os
+
+from types import SimpleNamespace
+
+import pytest
+
+from picode import database_ops, history
+
+
+# the start of an hour
+T0 = 1_800_000_000 - (1_800_000_000 % 3600)
+
+
+@pytest.fixture
+def store(tmp_path):
+    result = history.HistoryStore(str(tmp_path / 'history.db'))
+    yield result
+    result.stop()
+
+
+def _sample(store, timestamp, **values):
+    store.add_snapshot(SimpleNamespace(timestamp=timestamp, values=values))
+
+
+def _get(environ_query):
+    "Returns the status and decoded body of a GET of /api/history"
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+
+    body = b''.join(history.history_json({'QUERY_STRING':environ_query}, start_response))
+    return response['status'], json.loads(body.decode('utf-8'))
+
+
+def test_raw_readings_are_stored_on_change_or_heartbeat(store):
+    for offset in range(0, 150, 5):
+        _sample(store, T0 + offset, input01=True, input02="server time")
+    _sample(store, T0 + 150, input01=False)
+    result = store.query('input01', T0, T0 + 200, 'raw')
+    # the text input is not recorded, the unchanged level only once a minute
+    assert result['points'] == [[T0, 1.0], [T0 + 60, 1.0], [T0 + 120, 1.0], [T0 + 150, 0.0]]
+    store.flush()
+    assert store.query('input01', T0, T0 + 200, 'raw')['points'] == result['points']
+    assert store.query('input02', T0, T0 + 200, 'raw')['points'] == []
+
+
+def test_minute_and_hour_rollups(store):
+    values = [1.0, 3.0, 2.0, 2.0, 5.0, 4.0]
+    for index, value in enumerate(values):
+        # two minutes of readings, three in each
+        _sample(store, T0 + index * 20, temp=value)
+    store.flush()
+    minutes = store.query('temp', T0, T0 + 3600, 'minute')['points']
+    assert minutes == [[T0, 1.0, 3.0, 2.0, 2], [T0 + 60, 2.0, 5.0, pytest.approx(11 / 3), 2]]
+    hours = store.query('temp', T0, T0 + 3600, 'hour')['points']
+    assert hours == [[T0, 1.0, 5.0, pytest.approx(17 / 6), 4]]
+
+
+def test_the_current_bucket_is_replaced_as_it_fills(store):
+    _sample(store, T0, temp=1.0)
+    store.flush()
+    _sample(store, T0 + 30, temp=3.0)
+    store.flush()
+    assert store.query('temp', T0, T0 + 60, 'minute')['points'] == [[T0, 1.0, 3.0, 2.0, 1]]
+
+
+def test_resolution_is_chosen_from_the_span(store):
+    assert store.query('temp', T0, T0 + 3600)['resolution'] == 'raw'
+    assert store.query('temp', T0, T0 + 12*3600)['resolution'] == 'minute'
+    assert store.query('temp', T0, T0 + 30*24*3600)['resolution'] == 'hour'
+
+
+def test_old_rows_are_pruned(store):
+    _sample(store, T0, temp=1.0)
+    _sample(store, T0 + 3600, temp=2.0)
+    store.flush()
+    store.prune(now=T0 + 3600 + history._RETENTION['raw'] - 1)
+    assert store.query('temp', T0, T0 + 7200, 'raw')['points'] == [[T0 + 3600, 2.0]]
+    assert len(store.query('temp', T0, T0 + 7200, 'minute')['points']) == 2
+    store.prune(now=T0 + 3600 + history._RETENTION[history.MINUTE] - 1)
+    assert store.query('temp', T0, T0 + 7200, 'minute')['points'] == [[T0 + 3600, 2.0, 2.0, 2.0, 0]]
+    assert len(store.query('temp', T0, T0 + 7200, 'hour')['points']) == 2
+
+
+def test_history_endpoint(store, monkeypatch):
+    monkeypatch.setattr(history, '_store', store)
+    _sample(store, T0, input01=True)
+    _sample(store, T0 + 10, input01=False)
+    status, body = _get('name=input01&start=%s&end=%s' % (T0, T0 + 60))
+    assert status == '200 OK'
+    assert body == {'name':'input01', 'resolution':'raw', 'points':[[T0, 1.0], [T0 + 10, 0.0]]}
+    status, body = _get('name=input01&start=%s&end=%s&resolution=minute' % (T0, T0 + 60))
+    assert body['points'] == []
+    store.flush()
+    status, body = _get('name=input01&start=%s&end=%s&resolution=minute' % (T0, T0 + 60))
+    assert body['points'] == [[T0, 0.0, 1.0, 0.5, 1]]
+
+
+@pytest.mark.parametrize('query', ['name=unknown', 'name=input01&resolution=second', 'name=input01&start=yesterday'])
+def test_history_endpoint_refuses_invalid_requests(query):
+    assert _get(query)[0] == '400 Bad Request'
+
+
+def test_history_is_kept_beside_a_working_database_held_in_memory(tmp_path, monkeypatch):
+    working_dir = str(tmp_path / 'shm')
+    monkeypatch.setattr(database_ops, '_WORKING_DIR', working_dir)
+    monkeypatch.setattr(history, '_store', None)
+    monkeypatch.setattr(history, '_snapshotter', None)
+    database_ops.start_database('pi02', str(tmp_path / 'files'))
+    try:
+        setup_dir = database_ops.database_directory()
+        store = history.start(setup_dir)
+        assert store.path == os.path.join(working_dir, history._HISTORY_NAME)
+        _sample(store, T0, temp=1.0)
+        history.stop()
+    finally:
+        database_ops.stop_database()
+        database_ops._DATABASE_EXISTS = False
+        database_ops._POOL = None
+        database_ops._snapshotter = None
+    # the final snapshot is in the setup directory, and restores a lost working copy
+    snapshot = os.path.join(setup_dir, history._HISTORY_NAME)
+    restored = os.path.join(str(tmp_path), 'restored.db')
+    database_ops.start_snapshots(restored, snapshot).stop()
+    store = history.HistoryStore(restored)
+    try:
+        assert store.query('temp', T0, T0 + 60, 'raw')['points'] == [[T0, 1.0]]
+    finally:
+        store.stop()
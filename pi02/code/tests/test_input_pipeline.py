@@ -0,0 +1,71 @@
+#######################################################
+#
+# test_input_pipeline.py
+# the input filters and restarting of the input event
+# pipeline, with edges injected on the simulated pins
+#
+#######################################################
+
+
+import threading, time
+
+import pytest
+
+from picode import hardware
+
+
+BCM = hardware._INPUTS['input01'].BCM
+
+
+@pytest.fixture
+def pipeline(backend, monkeypatch):
+    "A new pipeline, input01 filtered only by a 50 millisecond glitch filter, and resting high"
+    monkeypatch.setitem(hardware._INPUT_FILTERS, 'input01', hardware.InputFilter(0, 0.05))
+    backend.set_input(BCM, 1)
+    result = hardware.InputPipeline(workers=1)
+    yield result
+    result.stop()
+
+
+def test_glitch_filter_does_not_block_the_dispatcher(backend, pipeline):
+    pipeline._accepted['input01'] = (True, None)
+    backend.set_input(BCM, 0)
+    pipeline._ring.append((BCM, 0, time.monotonic(), time.time()))
+    start = time.monotonic()
+    assert pipeline._process() == []
+    assert time.monotonic() - start < 0.04
+    assert 0 < pipeline._timeout() <= 0.05
+    time.sleep(0.06)
+    events = pipeline._process()
+    assert [(event.name, event.level) for event in events] == [('input01', False)]
+    assert pipeline._timeout() is None
+
+
+def test_glitch_is_rejected_once_its_time_ends(backend, pipeline):
+    pipeline._accepted['input01'] = (True, None)
+    backend.set_input(BCM, 0)
+    pipeline._ring.append((BCM, 0, time.monotonic(), time.time()))
+    assert pipeline._process() == []
+    backend.set_input(BCM, 1)
+    pipeline._ring.append((BCM, 1, time.monotonic(), time.time()))
+    time.sleep(0.06)
+    assert pipeline._process() == []
+    assert pipeline.glitches == 1
+    assert pipeline._accepted['input01'][0] is True
+
+
+def test_pipeline_delivers_events_after_a_restart(backend, pipeline):
+    received = []
+    delivered = threading.Event()
+
+    def callback(event):
+        received.append((event.name, event.level))
+        delivered.set()
+
+    pipeline.subscribe(callback)
+    pipeline.start()
+    pipeline.stop()
+    pipeline.start()
+    backend.set_input(BCM, 0)
+    assert delivered.wait(2)
+    assert received == [('input01', False)]
@@ -0,0 +1,150 @@
+#######################################################
+#
+# test_messages.py
+# batched writing of log messages, retried after a
+# failed commit, trimming of old messages, and
+# filtering by level, category and time
+#
+#######################################################
+
+
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from skipole import FailPage
+
+
+def _logged(database):
+    "Returns the messages of the 'test' category, oldest first"
+    rows = database.get_messages(limit=1000, category='test')
+    return [row[4] for row in reversed(rows)]
+
+
+def _failing_connection():
+    raise RuntimeError("database unavailable")
+
+
+def test_messages_are_written_in_order(database):
+    for number in range(5):
+        assert database.set_message("message %s" % (number,), category='test')
+    assert database.flush_messages()
+    assert _logged(database) == ["message %s" % (number,) for number in range(5)]
+
+
+def test_messages_of_a_failed_commit_are_kept_and_retried(database, monkeypatch):
+    writer = database._message_writer
+    database.set_message("first", category='test')
+    database.set_message("second", category='test')
+    with monkeypatch.context() as patch:
+        patch.setattr(database, 'get_connection', _failing_connection)
+        assert not database.flush_messages()
+        # queued after the failure, so written after the retried messages
+        database.set_message("third", category='test')
+    assert writer.stats()['failed'] >= 2
+    assert database.flush_messages()
+    assert _logged(database) == ["first", "second", "third"]
+
+
+def test_retried_messages_beyond_the_queue_size_are_dropped_and_reported(database, monkeypatch):
+    writer = database._message_writer
+    dropped = writer.dropped
+    monkeypatch.setattr(database, '_MESSAGE_QUEUE_SIZE', 3)
+    for number in range(3):
+        database.set_message("message %s" % (number,), category='test')
+
+    def queue_and_fail():
+        # a message queued while the commit is in progress
+        database.set_message("message 3", category='test')
+        _failing_connection()
+
+    with monkeypatch.context() as patch:
+        patch.setattr(database, 'get_connection', queue_and_fail)
+        assert not database.flush_messages()
+    # the oldest is dropped to make room for the message queued since
+    assert writer.dropped == dropped + 1
+    assert database.flush_messages()
+    assert _logged(database) == ["message 1", "message 2", "message 3"]
+    report = database.get_messages(limit=1, category='system')[0][4]
+    assert report == "1 log messages dropped, the log queue was full"
+
+
+def test_old_messages_are_trimmed(database, monkeypatch):
+    monkeypatch.setattr(database, '_MESSAGE_RETENTION', 10)
+    monkeypatch.setattr(database, '_MESSAGE_TRIM_EVERY', 5)
+    monkeypatch.setattr(database._message_writer, '_since_trim', 0)
+    for number in range(30):
+        database.set_message("message %s" % (number,), category='test')
+    assert database.flush_messages()
+    con = database.get_connection()
+    try:
+        # messages logged within a transaction are counted with those queued
+        for number in range(30, 35):
+            assert database.set_message("message %s" % (number,), con=con, category='test')
+        con.commit()
+    finally:
+        database.release_connection(con)
+    # trimmed as the fifth message was logged, keeping the newest ten
+    assert _logged(database) == ["message %s" % (number,) for number in range(25, 35)]
+
+
+def test_the_log_is_capped_at_the_retention(database, monkeypatch):
+    monkeypatch.setattr(database, '_MESSAGE_RETENTION', 20)
+    monkeypatch.setattr(database, '_MESSAGE_TRIM_EVERY', 10)
+    monkeypatch.setattr(database._message_writer, '_since_trim', 0)
+    for batch in range(5):
+        for number in range(10):
+            database.set_message("message %s" % (batch * 10 + number,), category='test')
+        assert database.flush_messages()
+        # never more than the retention, plus the messages logged since the last trim
+        assert len(database.get_messages(limit=1000)) <= 20 + 10
+    assert _logged(database) == ["message %s" % (number,) for number in range(30, 50)]
+
+
+def _log_levels(database):
+    "Logs a message at each level in two categories, returning their texts in order"
+    logged = []
+    for level in (database.DEBUG, database.INFO, database.WARNING, database.ERROR):
+        for category in ('test', 'other'):
+            text = "%s %s" % (database.LEVEL_NAMES[level], category)
+            database.set_message(text, level=level, category=category)
+            logged.append(text)
+    assert database.flush_messages()
+    return logged
+
+
+def test_messages_are_filtered_by_level_and_category(database):
+    _log_levels(database)
+    assert _logged(database) == ["DEBUG test", "INFO test", "WARNING test", "ERROR test"]
+    rows = database.get_messages(limit=1000, level=database.WARNING)
+    assert [row[4] for row in reversed(rows)] == ["WARNING test", "WARNING other", "ERROR test", "ERROR other"]
+    rows = database.get_messages(limit=1000, level=database.WARNING, category='other')
+    assert [(row[2], row[3], row[4]) for row in rows] == [(database.ERROR, 'other', "ERROR other"),
+                                                          (database.WARNING, 'other', "WARNING other")]
+    assert database.get_messages(limit=1000, category='none') == []
+
+
+def test_messages_are_paged_newest_first(database):
+    logged = _log_levels(database)
+    first = database.get_messages(limit=3, category='test')
+    assert [row[4] for row in first] == ["ERROR test", "WARNING test", "INFO test"]
+    second = database.get_messages(limit=3, category='test', before=first[-1][0])
+    assert [row[4] for row in second] == ["DEBUG test"]
+    # and within a time range
+    rows = database.get_messages(limit=1000, category='test', since=first[-1][1], until=first[0][1])
+    assert [row[4] for row in rows] == ["ERROR test", "WARNING test", "INFO test"]
+    assert database.get_messages(limit=1000, category='test', until=second[0][1] - timedelta(seconds=1)) == []
+
+
+def test_the_logs_page_filters_by_its_query_string(database):
+    from picode import login
+    _log_levels(database)
+    skicall = SimpleNamespace(environ={'QUERY_STRING':'level=warning&category=other&limit=1'}, page_data={})
+    login.display_logs(skicall)
+    text = skicall.page_data['messages', 'para_text']
+    assert "ERROR other" in text
+    assert "WARNING" not in text
+    skicall.environ['QUERY_STRING'] = 'before=x'
+    with pytest.raises(FailPage):
+        login.display_logs(skicall)
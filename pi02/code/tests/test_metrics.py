@@ -0,0 +1,111 @@
+#######################################################
+#
+# test_metrics.py
+# counters, histograms and gauges in the Prometheus
+# text format, and the recent rates and percentiles
+#
+#######################################################
+
+
+import json
+
+import pytest
+
+from picode import metrics
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    "Metrics registered by a test are kept from those of the application"
+    monkeypatch.setattr(metrics, '_metrics', {})
+    monkeypatch.setattr(metrics, 'enabled', True)
+
+
+def _lines(name):
+    return [line for line in metrics.text().splitlines() if name in line]
+
+
+def test_counter_text():
+    counter = metrics.Counter('test_edges_total', 'Edges captured', ('input',))
+    counter.inc('input01')
+    counter.inc('input01', amount=2)
+    counter.inc('in"put')
+    assert _lines('test_edges_total') == ['# HELP test_edges_total Edges captured',
+                                          '# TYPE test_edges_total counter',
+                                          'test_edges_total{input="input01"} 3',
+                                          'test_edges_total{input="in\\"put"} 1']
+
+
+def test_histogram_text():
+    histogram = metrics.Histogram('test_seconds', 'Latency', ('ident',))
+    histogram.observe(0.0002, 2003)
+    histogram.observe(0.003, 2003)
+    histogram.observe(10, 2003)
+    lines = _lines('test_seconds')
+    assert lines[:2] == ['# HELP test_seconds Latency', '# TYPE test_seconds histogram']
+    # cumulative counts in each bucket
+    assert 'test_seconds_bucket{ident="2003",le="0.0001"} 0' in lines
+    assert 'test_seconds_bucket{ident="2003",le="0.00025"} 1' in lines
+    assert 'test_seconds_bucket{ident="2003",le="0.0025"} 1' in lines
+    assert 'test_seconds_bucket{ident="2003",le="0.005"} 2' in lines
+    assert 'test_seconds_bucket{ident="2003",le="5.0"} 2' in lines
+    assert 'test_seconds_bucket{ident="2003",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{ident="2003"} 3' in lines
+    assert [line for line in lines if line.startswith('test_seconds_sum')] == ['test_seconds_sum{ident="2003"} %s' % (0.0002 + 0.003 + 10,)]
+
+
+def test_histogram_timer_and_recent_percentiles():
+    histogram = metrics.Histogram('test_seconds', 'Latency')
+    for milliseconds in range(1, 101):
+        histogram.observe(milliseconds / 1000)
+    with histogram.time():
+        pass
+    recent = metrics.recent()['test_seconds']
+    assert len(recent) == 1
+    assert recent[0]['count'] == 101
+    assert recent[0]['p50_ms'] == 50
+    assert recent[0]['p99_ms'] == 99
+    assert recent[0]['max_ms'] == 100
+
+
+def test_gauge_text():
+    metrics.Gauge('test_queue', 'Queue length', lambda: 4)
+    metrics.Gauge('test_levels', 'Levels', lambda: {'input01':1, ('input02',):0, 'input03':'text'}, ('input',))
+    metrics.Gauge('test_failing', 'Fails', lambda: 1/0)
+    metrics.Gauge('test_sql_total', 'Statements', lambda: 7, kind='counter')
+    text = metrics.text()
+    assert 'test_queue 4' in text.splitlines()
+    assert _lines('test_levels')[2:] == ['test_levels{input="input01"} 1', 'test_levels{input="input02"} 0']
+    # a gauge whose function fails is left out
+    assert 'test_failing' not in text
+    assert '# TYPE test_sql_total counter' in text
+
+
+def test_disabled_metrics_record_nothing(monkeypatch):
+    counter = metrics.Counter('test_total', 'Count')
+    histogram = metrics.Histogram('test_seconds', 'Latency')
+    monkeypatch.setattr(metrics, 'enabled', False)
+    counter.inc()
+    histogram.observe(0.1)
+    assert metrics.text() == '\n'
+
+
+def test_a_name_is_registered_once():
+    metrics.Counter('test_total', 'Count')
+    with pytest.raises(ValueError):
+        metrics.Histogram('test_total', 'Again')
+
+
+def test_metrics_endpoints():
+    metrics.Counter('test_total', 'Count', recent=True).inc()
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = dict(headers)
+
+    body = b''.join(metrics.metrics_text({}, start_response)).decode('utf-8')
+    assert response['headers']['Content-Type'].startswith('text/plain; version=0.0.4')
+    assert 'test_total 1' in body.splitlines()
+    body = json.loads(b''.join(metrics.metrics_recent({}, start_response)).decode('utf-8'))
+    assert body['metrics']['test_total'][0]['count'] == 1
@@ -0,0 +1,123 @@
+#######################################################
+#
+# test_migrations.py
+# upgrading a setup.db made by the original code, with
+# an output table for each type, the original message
+# log, a SHA-512 password, and no schema version
+#
+#######################################################
+
+
+import hashlib, os, sqlite3
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from picode import database_ops, passwords
+from picode.login import check_password
+
+
+def _original_database(path):
+    "Creates the database as the original start_database did, with further rows as a device in use would have"
+    os.makedirs(os.path.dirname(path))
+    con = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    con.execute("create table users (username TEXT PRIMARY KEY, seed TEXT, password BLOB, cookie TEXT, last_connect TIMESTAMP)")
+    con.execute("create table text_outputs (outputname TEXT PRIMARY KEY, value TEXT, default_on_pwr TEXT, onpower INTEGER)")
+    con.execute("create table integer_outputs (outputname TEXT PRIMARY KEY, value INTEGER, default_on_pwr INTEGER, onpower INTEGER)")
+    con.execute("create table boolean_outputs (outputname TEXT PRIMARY KEY, value INTEGER, default_on_pwr INTEGER, onpower INTEGER)")
+    con.execute("create table messages (mess_id integer primary key autoincrement, message TEXT, time timestamp)")
+    con.execute("""CREATE TRIGGER n_messages_only AFTER INSERT ON messages
+   BEGIN
+     DELETE FROM messages WHERE mess_id <= (SELECT mess_id FROM messages ORDER BY mess_id DESC LIMIT 1 OFFSET 50);
+   END;""")
+    now = datetime.utcnow()
+    seed = "1234567"
+    hashed_password = hashlib.sha512((seed + "secret").encode('utf-8')).digest()
+    con.execute("insert into users (username, seed, password, cookie, last_connect) values (?, ?, ?, ?, ?)",
+                ("admin", seed, hashed_password, "oldcookie", now))
+    # output01 set on, and powering up at its last value
+    con.execute("insert into boolean_outputs (outputname, value, default_on_pwr, onpower) values ('output01', 1, 0, 0)")
+    con.execute("insert into text_outputs (outputname, value, default_on_pwr, onpower) values ('display', 'hello', 'ready', 1)")
+    con.execute("insert into integer_outputs (outputname, value, default_on_pwr, onpower) values ('dimmer', 7, 3, 1)")
+    for number in range(60):
+        con.execute("insert into messages (message, time) values (?, ?)",
+                    ("original message %s" % (number,), now - timedelta(minutes=60-number)))
+    con.commit()
+    con.close()
+
+
+@pytest.fixture
+def upgraded(tmp_path, monkeypatch):
+    "Starts database_ops on an original database, returning its path"
+    monkeypatch.setattr(database_ops, '_WORKING_DIR', '')
+    # a low cost, so the rehash at login is quick
+    monkeypatch.setitem(passwords._COST, 'pbkdf2_sha256', {'iterations':1000})
+    path = os.path.join(str(tmp_path), 'pi02', database_ops._DATABASE_DIR_NAME, database_ops._DATABASE_NAME)
+    _original_database(path)
+    database_ops.start_database('pi02', str(tmp_path))
+    yield path
+    database_ops.stop_database()
+    database_ops._DATABASE_EXISTS = False
+    database_ops._POOL = None
+    database_ops._snapshotter = None
+
+
+def _query(path, sql, args=()):
+    con = sqlite3.connect(path)
+    try:
+        return con.execute(sql, args).fetchall()
+    finally:
+        con.close()
+
+
+def test_every_migration_is_applied(upgraded):
+    assert _query(upgraded, "PRAGMA user_version") == [(len(database_ops._MIGRATIONS),)]
+    assert _query(upgraded, "PRAGMA journal_mode") == [('wal',)]
+    tables = {row[0] for row in _query(upgraded, "select name from sqlite_master where type = 'table'")}
+    assert not tables & {'text_outputs', 'integer_outputs', 'boolean_outputs'}
+    assert {'outputs', 'schedules', 'sessions', 'rules'} <= tables
+
+
+def test_outputs_and_power_up_values_are_kept(upgraded):
+    assert database_ops.get_output('output01') is True
+    assert database_ops.get_power_values('output01') == (False, False)
+    assert database_ops.power_up_values()['output01'] is True
+    rows = _query(upgraded, "select outputname, outputtype, value, default_on_pwr, onpower from outputs order by outputname")
+    assert rows == [('dimmer', 'integer', 7, 3, 1), ('display', 'text', 'hello', 'ready', 1), ('output01', 'boolean', 1, 0, 0)]
+
+
+def test_messages_are_kept_with_a_level_and_category_and_no_longer_capped_at_fifty(upgraded):
+    messages = database_ops.get_messages(limit=1000)
+    original = [row for row in messages if row[4].startswith("original message")]
+    # the trigger had kept the newest 50
+    assert len(original) == 50
+    assert {(row[2], row[3]) for row in original} == {(database_ops.INFO, 'general')}
+    assert not _query(upgraded, "select name from sqlite_master where type = 'trigger'")
+    for number in range(60):
+        database_ops.set_message("new message %s" % (number,), category='test')
+    assert database_ops.flush_messages()
+    assert len(database_ops.get_messages(limit=1000, category='test')) == 60
+    assert len(database_ops.get_messages(limit=1000, category='general')) == 50
+
+
+def test_the_original_password_logs_in_and_is_rehashed(upgraded):
+    assert database_ops.get_password('admin')[2] == ''
+    assert not check_password('wrong')
+    assert check_password('secret')
+    hashed_password, salt, kdf = database_ops.get_password('admin')
+    assert kdf == passwords.current_kdf()
+    assert salt != "1234567"
+    passwords.clear_cache()
+    assert check_password('secret')
+    assert not check_password('wrong')
+
+
+def test_an_upgraded_database_is_not_migrated_again(upgraded):
+    con = database_ops.get_connection()
+    try:
+        database_ops.migrate_database(con)
+    finally:
+        database_ops.release_connection(con)
+    assert _query(upgraded, "PRAGMA user_version") == [(len(database_ops._MIGRATIONS),)]
+    assert database_ops.get_output('output01') is True
@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+
+
+def test_batched_values_are_committed_by_flush(database):
+    database.set_output_durability('batched')
+    database.set_output('output01', True)
+    # a queued value is the current one before it is committed
+    assert database.get_output('output01') is True
+    assert database._output_writer.pending() == {'output01':True}
+    assert database.flush_outputs()
+    assert database._output_writer.pending() == {}
+    assert database.get_output('output01') is True
+
+
+def test_only_the_latest_queued_value_is_committed(database):
+    database.set_output_durability('batched')
+    for value in (True, False, True, False):
+        database.set_output('output01', value)
+    commits = database._output_writer.commits
+    assert database.flush_outputs()
+    assert database._output_writer.commits == commits + 1
+    assert database.get_output('output01') is False
+
+
+def test_direct_write_replaces_a_queued_value(database):
+    database.set_output_durability('batched')
+    database.set_output('output01', True)
+    assert database.set_outputs({'output01':False})
+    assert database.flush_outputs()
+    assert database.get_output('output01') is False
+
+
+@pytest.mark.parametrize('flush_fails', [False, True])
+def test_direct_write_during_flush_is_not_overwritten(database, monkeypatch, flush_fails):
+    """A direct write made while a flush is committing an older value of the same output
+       is committed after it, whether the flush succeeds or fails and is retried"""
+    database.set_output_durability('batched')
+    database.set_output('output01', True)
+    original = database.set_outputs
+    writers = []
+
+    def flushing(output_dict, con=None):
+        if (con is not None) and not writers:
+            # the flush has taken the queued values, and is about to commit them
+            writer = threading.Thread(target=original, args=({'output01':False},))
+            writer.start()
+            writers.append(writer)
+            # the direct write waits for the flush, rather than completing now
+            writer.join(0.2)
+            if flush_fails:
+                return False
+        return original(output_dict, con)
+
+    monkeypatch.setattr(database, 'set_outputs', flushing)
+    assert database.flush_outputs() is not flush_fails
+    writers[0].join()
+    monkeypatch.setattr(database, 'set_outputs', original)
+    assert database.flush_outputs()
+    assert database.get_output('output01') is False
@@ -0,0 +1,103 @@
+#######################################################
+#
+# test_outputs_json.py
+# the /api/outputs bulk endpoint, setting all of the
+# outputs of a request or none of them, and the
+# /api/state endpoint
+#
+#######################################################
+
+
+import io, json
+
+import pytest
+
+from picode import hardware, control, events, database_ops
+
+
+@pytest.fixture
+def outputs(request, monkeypatch):
+    "output01, and an integer output 'dimmer' without a pin, stored in a new database with both at their defaults"
+    dimmer = hardware.Output('integer', 0, True, None, "Dimmer level")
+    monkeypatch.setitem(hardware._OUTPUTS, 'dimmer', dimmer)
+    monkeypatch.setitem(database_ops._OUTPUTS, 'dimmer', dimmer)
+    # the database is created after the output is added, so it has a row for it
+    database = request.getfixturevalue('database')
+    request.getfixturevalue('backend')
+    database.set_outputs({'output01':False, 'dimmer':0})
+    monkeypatch.setattr(events, 'broker', events.EventBroker())
+    published = []
+    events.broker.add_listener(lambda event: published.append((event.name, event.value)))
+    return published
+
+
+def _call(handler, data=None, method='POST', content_type='application/json'):
+    "Returns the status and decoded body of a request to the handler"
+    environ = {'REQUEST_METHOD':method}
+    if data is not None:
+        body = json.dumps(data).encode('utf-8')
+        environ.update({'CONTENT_TYPE':content_type, 'CONTENT_LENGTH':str(len(body)), 'wsgi.input':io.BytesIO(body)})
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+
+    body = b''.join(handler(environ, start_response))
+    return response['status'], json.loads(body.decode('utf-8'))
+
+
+def _stored(database):
+    return {name:value[0] for name, value in database.get_all_outputs().items()}
+
+
+def test_valid_outputs_are_all_set(outputs, database, backend):
+    status, body = _call(control.outputs_json, {'outputs':{'output01':'true', 'dimmer':'7'}})
+    assert status == '200 OK'
+    assert {name:state['value'] for name, state in body['outputs'].items()} == {'output01':True, 'dimmer':7}
+    assert _stored(database) == {'output01':True, 'dimmer':7}
+    assert backend.levels[hardware._OUTPUTS['output01'].BCM] == 1
+    assert sorted(outputs) == [('dimmer', 7), ('output01', True)]
+
+
+@pytest.mark.parametrize('values, invalid', [
+    ({'output01':True, 'output99':True}, {'output99':'Unknown output'}),
+    ({'output01':True, 'dimmer':'maybe'}, {'dimmer':'Invalid value'}),
+    ({'dimmer':5, 'output01':'maybe'}, {'output01':'Expected a boolean'}),
+    ({'output01':True, 'dimmer':True}, {'dimmer':'Expected an integer'}),
+    ({'output01':1, 'dimmer':[1]}, {'output01':'Expected a boolean', 'dimmer':'Expected an integer'}),
+    ])
+def test_a_rejected_item_sets_none_of_the_outputs(outputs, database, backend, values, invalid):
+    status, body = _call(control.outputs_json, {'outputs':values})
+    assert status == '400 Bad Request'
+    assert body == {'error':'Invalid outputs, none have been set', 'invalid':invalid}
+    # nothing written, driven, or published, before or after the rejected item
+    assert _stored(database) == {'output01':False, 'dimmer':0}
+    assert backend.levels[hardware._OUTPUTS['output01'].BCM] == 0
+    assert outputs == []
+
+
+@pytest.mark.parametrize('data, content_type', [
+    ({'outputs':{}}, 'application/json'),
+    ({'output01':True}, 'application/json'),
+    (['output01'], 'application/json'),
+    ({'outputs':{'output01':True}}, 'application/x-www-form-urlencoded'),
+    ])
+def test_malformed_requests_are_refused(outputs, database, data, content_type):
+    status, body = _call(control.outputs_json, data, content_type=content_type)
+    assert status in ('400 Bad Request', '415 Unsupported Media Type')
+    assert _stored(database) == {'output01':False, 'dimmer':0}
+    assert outputs == []
+
+
+def test_get_outputs_and_state(outputs, database, backend):
+    _call(control.outputs_json, {'outputs':{'dimmer':3}})
+    status, body = _call(control.outputs_json, method='GET')
+    assert status == '200 OK'
+    assert body['outputs']['dimmer']['value'] == 3
+    assert body['outputs']['output01']['value'] is False
+    assert body['outputs']['dimmer']['timestamp'] is not None
+    status, body = _call(control.state_json, method='GET')
+    assert set(body) == {'outputs', 'inputs', 'timestamp'}
+    assert body['outputs']['dimmer']['type'] == 'integer'
+    assert set(body['inputs']) == set(hardware.get_inputs())
+    assert body['inputs']['input01']['type'] == 'boolean'
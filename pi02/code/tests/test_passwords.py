@@ -0,0 +1,158 @@
+#######################################################
+#
+# test_passwords.py
+# hashing and verifying passwords, rehashing on login
+# when the stored scheme or cost is outdated, the
+# original SHA-512 hashes, and the verification cache
+#
+#######################################################
+
+
+import hashlib
+
+import pytest
+
+from picode import passwords
+from picode.login import check_password
+
+
+@pytest.fixture(autouse=True)
+def low_cost(monkeypatch):
+    "Low costs, so the tests hash quickly, and an empty verification cache"
+    monkeypatch.setattr(passwords, '_SCHEME', 'pbkdf2_sha256')
+    monkeypatch.setitem(passwords._COST, 'pbkdf2_sha256', {'iterations':1000})
+    monkeypatch.setitem(passwords._COST, 'scrypt', {'n':1024, 'r':8, 'p':1})
+    passwords.clear_cache()
+    yield
+    passwords.clear_cache()
+
+
+@pytest.fixture
+def derivations(monkeypatch):
+    "A list of the kdf of each key derived"
+    result = []
+    derive = passwords.derive
+
+    def counting(password, salt, kdf):
+        result.append(kdf)
+        return derive(password, salt, kdf)
+
+    monkeypatch.setattr(passwords, 'derive', counting)
+    return result
+
+
+def _stored(database, user):
+    con = database.get_connection()
+    try:
+        return database.get_password(user, con)
+    finally:
+        database.release_connection(con)
+
+
+@pytest.mark.parametrize('scheme', ['pbkdf2_sha256',
+                                    pytest.param('scrypt', marks=pytest.mark.skipif(not hasattr(hashlib, 'scrypt'),
+                                                                                    reason="scrypt is not available"))])
+def test_hash_and_verify(scheme):
+    passwords.configure(scheme)
+    hashed_password, salt, kdf = passwords.hash_password('secret')
+    assert kdf == passwords.current_kdf()
+    assert passwords.parse_kdf(kdf) == (scheme, passwords._COST[scheme])
+    assert len(hashed_password) == passwords._KEY_SIZE
+    assert passwords.verify('admin', 'secret', hashed_password, salt, kdf)
+    passwords.clear_cache()
+    assert not passwords.verify('admin', 'Secret', hashed_password, salt, kdf)
+    # the salt is different for each hash
+    assert passwords.hash_password('secret')[1] != salt
+
+
+def test_an_unknown_scheme_is_not_verified():
+    hashed_password, salt, kdf = passwords.hash_password('secret')
+    assert not passwords.verify('admin', 'secret', hashed_password, salt, 'md5:rounds=1')
+    with pytest.raises(ValueError):
+        passwords.configure('md5')
+
+
+def test_a_hash_with_an_outdated_cost_is_replaced_on_login(database, derivations):
+    assert database.add_user('operator', 'secret')
+    old = _stored(database, 'operator')
+    assert old[2] == 'pbkdf2_sha256:iterations=1000'
+    passwords.configure('pbkdf2_sha256', iterations=2000)
+    assert passwords.needs_rehash(old[2])
+    derivations.clear()
+    assert check_password('secret', 'operator')
+    new = _stored(database, 'operator')
+    assert new[2] == 'pbkdf2_sha256:iterations=2000'
+    assert new[1] != old[1]
+    # verified at the old cost, then hashed at the new one
+    assert derivations == [old[2], new[2]]
+    derivations.clear()
+    passwords.clear_cache()
+    assert check_password('secret', 'operator')
+    assert derivations == [new[2]]
+
+
+@pytest.mark.skipif(not hasattr(hashlib, 'scrypt'), reason="scrypt is not available")
+def test_a_hash_with_an_outdated_scheme_is_replaced_on_login(database):
+    assert database.add_user('operator', 'secret')
+    passwords.configure('scrypt')
+    assert check_password('secret', 'operator')
+    assert passwords.parse_kdf(_stored(database, 'operator')[2])[0] == 'scrypt'
+    passwords.clear_cache()
+    assert check_password('secret', 'operator')
+    assert not check_password('wrong', 'operator')
+
+
+def test_a_failed_login_is_not_rehashed(database):
+    assert database.add_user('operator', 'secret')
+    old = _stored(database, 'operator')
+    passwords.configure('pbkdf2_sha256', iterations=2000)
+    assert not check_password('wrong', 'operator')
+    assert _stored(database, 'operator') == old
+    assert database.get_messages(limit=1, category='login')[0][4] == "Invalid password submitted"
+
+
+def test_an_original_sha512_hash_is_upgraded_on_login(database):
+    seed = "1234567"
+    con = database.get_connection()
+    try:
+        # as stored by the original code, before the kdf was recorded
+        con.execute("update users set password = ?, seed = ?, kdf = '' where username = 'admin'",
+                    (hashlib.sha512((seed + 'letmein').encode('utf-8')).digest(), seed))
+        con.commit()
+    finally:
+        database.release_connection(con)
+    assert passwords.parse_kdf('') == ('sha512', {})
+    assert not check_password('wrong')
+    assert _stored(database, 'admin')[2] == ''
+    assert check_password('letmein')
+    hashed_password, salt, kdf = _stored(database, 'admin')
+    assert kdf == passwords.current_kdf()
+    assert salt != seed
+    passwords.clear_cache()
+    assert check_password('letmein')
+
+
+def test_a_verification_is_cached_until_the_password_changes(database, derivations):
+    assert database.add_user('operator', 'secret')
+    derivations.clear()
+    assert check_password('secret', 'operator')
+    assert check_password('secret', 'operator')
+    # the second check was answered from the cache
+    assert len(derivations) == 1
+    assert len(passwords._cache) == 1
+    assert database.set_password('operator', 'changed')
+    assert passwords._cache == {}
+    assert not check_password('secret', 'operator')
+    assert check_password('changed', 'operator')
+
+
+def test_a_cached_verification_does_not_match_another_stored_hash(derivations):
+    hashed_password, salt, kdf = passwords.hash_password('secret')
+    assert passwords.verify('admin', 'secret', hashed_password, salt, kdf)
+    # as if the password were changed by another process, whose cache clear is not seen here
+    other_hash, other_salt, kdf = passwords.hash_password('changed')
+    assert not passwords.verify('admin', 'secret', other_hash, other_salt, kdf)
+    # nor is it shared with another user
+    derivations.clear()
+    assert not passwords.verify('operator', 'secret', other_hash, other_salt, kdf)
+    assert len(derivations) == 1
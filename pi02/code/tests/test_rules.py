@@ -0,0 +1,177 @@
+#######################################################
+#
+# test_rules.py
+# dispatch of input changes to the rules triggered by
+# them, with edge, level and threshold triggers,
+# delays, conditions on the filtered input levels, and
+# the action table shared with the scheduler
+#
+#######################################################
+
+
+import time
+
+from types import SimpleNamespace
+
+import pytest
+
+from picode import hardware, rules, control, actions, scheduler
+
+
+@pytest.fixture
+def fired(monkeypatch):
+    "A list recording the arguments of each call of the 'record' action, with a float input 'temp'"
+    monkeypatch.setitem(hardware._INPUTS, 'temp', hardware.Input('float', None, None, "Temperature"))
+    result = []
+    monkeypatch.setitem(actions._ACTIONS, 'record', (lambda *args: result.append(args), False))
+    return result
+
+
+@pytest.fixture
+def engine():
+    "A running engine, fed changes directly rather than from the input pipeline and sampler"
+    result = rules.RulesEngine()
+    result._running = True
+    yield result
+    result.stop()
+
+
+def _feed(engine, name, values, edges=1):
+    "Evaluates each value of the input in turn, with increasing timestamps"
+    for value in values:
+        engine._evaluate([(name, value, time.time(), edges)])
+
+
+def test_threshold_fires_once_until_reset(engine, fired):
+    engine.add_rule(rules.Rule('hot', {'when':{'input':'temp', 'above':25, 'reset_below':23},
+                                       'then':[['record', 'hot']]}))
+    _feed(engine, 'temp', [20, 26, 24, 27, 22, 26])
+    assert fired == [('hot',), ('hot',)]
+    assert engine.rules()[0]['firings'] == 2
+
+
+def test_only_rules_of_the_changed_input_are_evaluated(engine, fired):
+    engine.add_rule(rules.Rule('hot', {'when':{'input':'temp', 'above':25}, 'then':[['record', 'hot']]}))
+    engine.add_rule(rules.Rule('rise', {'when':{'input':'input01', 'edge':'rising'}, 'then':[['record', 'rise']]}))
+    assert set(engine._by_input) == {'temp', 'input01'}
+    assert [rule.name for rule in engine._by_input['input01']] == ['rise']
+    _feed(engine, 'input01', [False, True])
+    assert fired == [('rise',)]
+    _feed(engine, 'temp', [30])
+    assert fired == [('rise',), ('hot',)]
+
+
+def test_disabled_and_removed_rules_are_not_dispatched(engine, fired):
+    engine.add_rule(rules.Rule('off', {'when':{'input':'input01', 'edge':'both'}, 'then':[['record', 'off']]},
+                               enabled=False))
+    engine.add_rule(rules.Rule('gone', {'when':{'input':'input01', 'edge':'both'}, 'then':[['record', 'gone']]}))
+    engine.remove_rule('gone')
+    assert engine._by_input == {}
+    _feed(engine, 'input01', [False, True])
+    assert fired == []
+
+
+def test_a_pulse_fires_the_rules_of_both_edges(engine, fired):
+    engine.add_rule(rules.Rule('rise', {'when':{'input':'input01', 'edge':'rising'}, 'then':[['record', 'rise']]}))
+    engine.add_rule(rules.Rule('fall', {'when':{'input':'input01', 'edge':'falling'}, 'then':[['record', 'fall']]}))
+    _feed(engine, 'input01', [True])
+    fired.clear()
+    # two edges coalesced by the input pipeline, returning to the same level
+    _feed(engine, 'input01', [True], edges=2)
+    assert sorted(fired) == [('fall',), ('rise',)]
+
+
+def test_a_change_delivered_out_of_order_is_ignored(engine, fired):
+    engine.add_rule(rules.Rule('fall', {'when':{'input':'input01', 'edge':'falling'}, 'then':[['record', 'fall']]}))
+    now = time.time()
+    engine._evaluate([('input01', True, now, 1)])
+    engine._evaluate([('input01', False, now - 1, 1)])
+    assert fired == []
+
+
+def test_a_delayed_firing_is_cancelled_if_the_trigger_ends(engine, fired):
+    engine.add_rule(rules.Rule('cold', {'when':{'input':'temp', 'below':5}, 'delay':0.1,
+                                        'then':[['record', 'cold']]}))
+    _feed(engine, 'temp', [10, 4, 6])
+    time.sleep(0.2)
+    assert fired == []
+    _feed(engine, 'temp', [4])
+    assert fired == []
+    time.sleep(0.2)
+    assert fired == [('cold',)]
+
+
+def test_conditions_and_output_actions(database, backend, engine, fired):
+    engine.add_rule(rules.Rule('lamp', {'when':{'input':'input01', 'level':False},
+                                        'if':[{'input':'temp', 'below':10}],
+                                        'then':[['set_output', 'output01', True]]}))
+    _feed(engine, 'temp', [20])
+    _feed(engine, 'input01', [True, False])
+    assert engine.rules()[0]['skipped'] == 1
+    assert control._get_output('output01') is False
+    _feed(engine, 'input01', [True])
+    _feed(engine, 'temp', [5])
+    _feed(engine, 'input01', [False])
+    assert control._get_output('output01') is True
+    assert backend.levels[hardware._OUTPUTS['output01'].BCM] == 1
+
+
+@pytest.fixture
+def pipeline(backend, monkeypatch):
+    "A running input pipeline, input01 resting high and debounced for ten seconds after an edge"
+    monkeypatch.setitem(hardware._INPUT_FILTERS, 'input01', hardware.InputFilter(10, 0))
+    bcm = hardware._INPUTS['input01'].BCM
+    backend.set_input(bcm, 1)
+    result = hardware.InputPipeline(workers=1)
+    monkeypatch.setattr(hardware, 'input_pipeline', result)
+    result.start()
+    yield result
+    result.stop()
+
+
+def test_conditions_and_samples_use_the_filtered_level(engine, fired, pipeline, backend):
+    bcm = hardware._INPUTS['input01'].BCM
+    engine.add_rule(rules.Rule('hot', {'when':{'input':'temp', 'above':25}, 'if':[{'input':'input01', 'equals':False}],
+                                       'then':[['record', 'hot']]}))
+    engine.add_rule(rules.Rule('high', {'when':{'input':'input01', 'level':True}, 'then':[['record', 'high']]}))
+    backend.set_input(bcm, 0)
+    end = time.monotonic() + 2
+    while pipeline.level('input01') is not False:
+        assert time.monotonic() < end
+        time.sleep(0.01)
+    engine._evaluate([('input01', False, time.time(), 1)])
+    # a bounce back to high, within the debounce time, is not accepted
+    backend.set_input(bcm, 1)
+    time.sleep(0.05)
+    assert pipeline.level('input01') is False
+    engine.snapshot(SimpleNamespace(values={'input01':True}, timestamp=time.time()))
+    assert fired == []
+    # the condition holds at the filtered level, though the input now reads high
+    _feed(engine, 'temp', [30])
+    assert fired == [('hot',)]
+
+
+def test_the_rules_and_the_scheduler_share_one_action_table(database, engine, fired, monkeypatch):
+    monkeypatch.setattr(actions, '_ACTIONS', dict(actions._ACTIONS))
+    calls = []
+    scheduler.register_action('shared', lambda *args: calls.append(args))
+    engine.add_rule(rules.Rule('shared', {'when':{'input':'temp', 'above':25}, 'then':[['shared', 1], ['message', 'too hot']]}))
+    _feed(engine, 'temp', [30])
+    assert calls == [(1,)]
+    # each engine logs with its own category
+    assert database.get_messages(limit=1, category='rules')[0][4] == 'too hot'
+    actions.run('message', ['scheduled'], 'scheduler')
+    assert database.get_messages(limit=1, category='scheduler')[0][4] == 'scheduled'
+
+
+@pytest.mark.parametrize('definition', [
+    {'when':{'input':'temp', 'above':5, 'reset_below':6}, 'then':[['record']]},
+    {'when':{'input':'nope', 'level':True}, 'then':[['record']]},
+    {'when':{'input':'temp', 'edge':'rising'}, 'then':[['record']]},
+    {'when':{'input':'input01', 'level':True}, 'then':[['unknown']]},
+    {'when':{'input':'input01', 'level':True}, 'then':[['record']], 'delay':'x'},
+    {'when':{'input':'input01', 'level':True}, 'if':[{'output':'output01'}], 'then':[['record']]},
+    ])
+def test_invalid_rules_are_refused(fired, definition):
+    with pytest.raises(ValueError):
+        rules.Rule('invalid', definition)
@@ -0,0 +1,117 @@
+#######################################################
+#
+# test_scheduler.py
+# misfire policies, and handling of changes to the
+# wall clock, of the scheduler
+#
+#######################################################
+
+
+import time
+
+import pytest
+
+from picode import scheduler, actions
+
+
+@pytest.fixture
+def runs(monkeypatch):
+    "A list recording the arguments of each run of the 'record' action"
+    result = []
+    monkeypatch.setitem(actions._ACTIONS, 'record', (lambda *args: result.append(args), False))
+    return result
+
+
+@pytest.fixture
+def engine():
+    result = scheduler.Scheduler()
+    yield result
+    result.stop()
+    result._executor.shutdown()
+
+
+def _job(engine, misfire, due):
+    "Adds a job running every ten seconds, first due at due"
+    job = scheduler.Job('test', 'every 10', 'record', ['test'], misfire)
+    engine.add_job(job, due - 10)
+    assert job.next_run == pytest.approx(due)
+    return job
+
+
+def _run_due(engine, job, due, now):
+    "Runs the job as the scheduler thread would, and waits for the worker pool to finish"
+    with engine._condition:
+        engine._due(job, due, now)
+    engine._executor.shutdown(wait=True)
+
+
+def test_a_run_on_time_is_made_and_the_next_follows_the_due_time(engine, runs):
+    now = time.time()
+    job = _job(engine, 'once', now)
+    _run_due(engine, job, job.next_run, now + 5)
+    assert runs == [('test',)]
+    assert job.misfires == 0
+    assert job.next_run == pytest.approx(now + 10)
+
+
+@pytest.mark.parametrize('misfire, expected', [('skip', 0), ('once', 1), ('all', 10)])
+def test_misfire_policies(engine, runs, misfire, expected):
+    now = time.time()
+    due = now - 95
+    job = _job(engine, misfire, due)
+    _run_due(engine, job, job.next_run, now)
+    assert len(runs) == expected
+    assert job.misfires == 1
+    assert job.skipped == (1 if misfire == 'skip' else 0)
+    # the next run is due after now, not after the missed time
+    assert job.next_run == now + 10
+
+
+def test_catch_up_runs_are_limited(engine, runs, monkeypatch):
+    monkeypatch.setattr(scheduler, '_MAX_CATCH_UP', 3)
+    now = time.time()
+    due = now - 95
+    job = _job(engine, 'all', due)
+    _run_due(engine, job, job.next_run, now)
+    assert len(runs) == 3
+
+
+def _clock(monkeypatch):
+    "Patches the wall clock, returning a dictionary with the offset added to it"
+    clock = {'offset':0}
+    real_time = time.time
+    monkeypatch.setattr(scheduler.time, 'time', lambda: real_time() + clock['offset'])
+    return clock
+
+
+def _wait(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end
+        time.sleep(0.05)
+
+
+def test_clock_moved_back_reschedules_from_now(database, engine, runs, monkeypatch):
+    clock = _clock(monkeypatch)
+    job = scheduler.Job('test', 'every 600', 'record', ['test'])
+    engine.add_job(job)
+    engine.start()
+    clock['offset'] = -3600
+    _wait(lambda: engine.clock_jumps == 1)
+    with engine._condition:
+        next_run = job.next_run
+    # due ten minutes after the changed clock, not seventy minutes
+    assert 0 < next_run - time.time() <= 600
+    assert runs == []
+
+
+def test_clock_moved_forward_misfires(database, engine, runs, monkeypatch):
+    clock = _clock(monkeypatch)
+    job = scheduler.Job('test', 'every 600', 'record', ['test'], 'once')
+    engine.add_job(job)
+    engine.start()
+    clock['offset'] = 3600
+    _wait(lambda: job.runs == 1)
+    assert engine.clock_jumps == 1
+    assert job.misfires == 1
+    assert runs == [('test',)]
@@ -0,0 +1,145 @@
+#######################################################
+#
+# test_sessions.py
+# sessions held in memory, several logins of one user,
+# logging out, expiry, revalidation against the
+# database, and batched last seen times
+#
+#######################################################
+
+
+import time
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from picode import sessions
+
+
+@pytest.fixture
+def cache(database, monkeypatch):
+    "An empty session cache, with a new database, returning the database module"
+    monkeypatch.setattr(sessions, '_sessions', {})
+    monkeypatch.setattr(sessions, '_seen', {})
+    assert database.add_user('operator', 'secret')
+    yield database
+    sessions.stop()
+
+
+def _wait(condition, timeout=2):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end
+        time.sleep(0.01)
+
+
+def test_two_logins_of_one_user_coexist(cache):
+    first = sessions.create_session('admin')
+    second = sessions.create_session('admin')
+    assert first != second
+    assert sessions.check_token(first) == 'admin'
+    assert sessions.check_token(second) == 'admin'
+    assert sessions.active_sessions() == 2
+    assert sessions.check_token('unknown') is None
+    assert sessions.check_token("000") is None
+
+
+def test_end_session_ends_only_that_session(cache):
+    first = sessions.create_session('admin')
+    second = sessions.create_session('admin')
+    assert sessions.end_session(first)
+    assert sessions.check_token(first) is None
+    assert sessions.check_token(second) == 'admin'
+    assert cache.get_session(sessions.token_hash(first)) is None
+
+
+def test_end_user_sessions_ends_every_session_of_the_user(cache):
+    tokens = [sessions.create_session('admin'), sessions.create_session('admin')]
+    other = sessions.create_session('operator')
+    assert sessions.end_user_sessions('admin')
+    assert [sessions.check_token(token) for token in tokens] == [None, None]
+    assert sessions.check_token(other) == 'operator'
+    # and from the database, so not reloaded after a restart
+    sessions._sessions.clear()
+    assert sessions.check_token(tokens[0]) is None
+    assert sessions.check_token(other) == 'operator'
+
+
+def test_a_session_is_loaded_from_the_database_after_a_restart(cache):
+    token = sessions.create_session('admin')
+    sessions._sessions.clear()
+    assert sessions.check_token(token) == 'admin'
+    assert sessions.token_hash(token) in sessions._sessions
+
+
+def test_an_expired_session_is_refused_and_removed(cache, monkeypatch):
+    monkeypatch.setattr(sessions, '_SESSION_LIFETIME', timedelta(seconds=-1))
+    expired = sessions.create_session('admin')
+    monkeypatch.setattr(sessions, '_SESSION_LIFETIME', timedelta(hours=12))
+    current = sessions.create_session('admin')
+    assert sessions.check_token(expired) is None
+    assert sessions.active_sessions() == 1
+    assert sessions.expire() == 1
+    assert sessions.token_hash(expired) not in sessions._sessions
+    assert cache.get_session(sessions.token_hash(expired)) is None
+    assert sessions.check_token(current) == 'admin'
+
+
+def test_revalidate_drops_a_session_logged_out_in_another_worker(cache):
+    token = sessions.create_session('admin')
+    other = sessions.create_session('admin')
+    assert sessions.check_token(token) == 'admin'
+    # as another worker process logging out, which cannot clear this process's cache
+    assert cache.delete_session(sessions.token_hash(token))
+    assert sessions.check_token(token) == 'admin'
+    sessions.revalidate()
+    assert sessions.check_token(token) is None
+    assert sessions.check_token(other) == 'admin'
+
+
+def test_the_session_thread_revalidates_at_the_short_interval(cache, monkeypatch):
+    monkeypatch.setattr(sessions, '_REVALIDATE_INTERVAL', 0.02)
+    token = sessions.create_session('admin')
+    sessions.start()
+    assert cache.delete_session(sessions.token_hash(token))
+    _wait(lambda: sessions.check_token(token) is None)
+
+
+def test_last_seen_times_are_written_in_one_batch(cache, monkeypatch):
+    tokens = [sessions.create_session('admin'), sessions.create_session('operator')]
+    before = datetime.utcnow()
+    for token in tokens * 3:
+        assert sessions.check_token(token)
+    batches = []
+    original = cache.set_sessions_last_seen
+
+    def recording(last_seen, con=None):
+        # the call without a connection calls again with one
+        if con is None:
+            batches.append(dict(last_seen))
+        return original(last_seen, con)
+
+    monkeypatch.setattr(cache, 'set_sessions_last_seen', recording)
+    sessions.flush()
+    assert len(batches) == 1
+    assert set(batches[0]) == {sessions.token_hash(token) for token in tokens}
+    for token in tokens:
+        assert cache.get_session(sessions.token_hash(token))[2] >= before
+    # nothing held, so nothing written
+    sessions.flush()
+    assert len(batches) == 1
+
+
+def test_last_seen_times_of_a_failed_flush_are_kept(cache, monkeypatch):
+    token = sessions.create_session('admin')
+    assert sessions.check_token(token)
+    key = sessions.token_hash(token)
+    seen = sessions._seen[key]
+    with monkeypatch.context() as patch:
+        patch.setattr(cache, 'set_sessions_last_seen', lambda last_seen, con=None: False)
+        sessions.flush()
+    assert sessions._seen == {key:seen}
+    sessions.flush()
+    assert sessions._seen == {}
+    assert cache.get_session(key)[2] == seen
@@ -0,0 +1,145 @@
+#######################################################
+#
+# test_snapshots.py
+# the working database held in a memory backed
+# directory, its snapshot in the setup directory, and
+# restoring the working database from the snapshot
+#
+#######################################################
+
+
+import os, sqlite3
+
+from datetime import datetime
+
+import pytest
+
+from picode import database_ops
+
+
+@pytest.fixture
+def paths(tmp_path, monkeypatch):
+    "Sets a working directory, returning (projectfiles, working path, snapshot path)"
+    working_dir = str(tmp_path / 'shm')
+    monkeypatch.setattr(database_ops, '_WORKING_DIR', working_dir)
+    projectfiles = str(tmp_path / 'files')
+    snapshot = os.path.join(projectfiles, 'pi02', database_ops._DATABASE_DIR_NAME, database_ops._DATABASE_NAME)
+    yield projectfiles, os.path.join(working_dir, database_ops._DATABASE_NAME), snapshot
+    _stop()
+
+
+def _start(projectfiles):
+    database_ops.start_database('pi02', projectfiles)
+
+
+def _stop():
+    if database_ops._DATABASE_EXISTS:
+        database_ops.stop_database()
+    database_ops._DATABASE_EXISTS = False
+    database_ops._POOL = None
+    database_ops._snapshotter = None
+
+
+def _query(path, sql, args=()):
+    "Returns the rows of a query of the database file at path"
+    con = sqlite3.connect(path)
+    try:
+        return con.execute(sql, args).fetchall()
+    finally:
+        con.close()
+
+
+def _users(path):
+    return [row[0] for row in _query(path, "select username from users order by username")]
+
+
+def _stored_output(path, name):
+    return bool(_query(path, "select value from outputs where outputname = ?", (name,))[0][0])
+
+
+def test_the_working_database_is_held_in_the_working_directory(paths):
+    projectfiles, working, snapshot = paths
+    _start(projectfiles)
+    assert database_ops._DATABASE_PATH == working
+    assert database_ops.database_directory() == os.path.dirname(snapshot)
+    # the new database is copied to the snapshot at start up
+    assert _users(snapshot) == ['admin']
+    assert database_ops.snapshot_stats()['snapshots'] == 1
+
+
+def test_a_critical_change_is_copied_to_the_snapshot_at_once(paths):
+    projectfiles, working, snapshot = paths
+    _start(projectfiles)
+    assert database_ops.add_user('operator', 'secret')
+    assert _users(snapshot) == ['admin', 'operator']
+    assert database_ops.snapshot_stats()['snapshots'] == 2
+
+
+def test_other_changes_wait_for_the_next_snapshot(paths):
+    projectfiles, working, snapshot = paths
+    _start(projectfiles)
+    database_ops.set_message("not critical", category='test')
+    assert database_ops.flush_messages()
+    assert not _query(snapshot, "select 1 from messages where category = 'test'")
+    assert database_ops.snapshot_stats()['snapshots'] == 1
+    # taken on stop
+    _stop()
+    assert _query(snapshot, "select message from messages where category = 'test'") == [("not critical",)]
+
+
+def test_an_output_powering_up_at_its_last_value_is_critical(paths):
+    projectfiles, working, snapshot = paths
+    _start(projectfiles)
+    database_ops.set_output_durability('sync')
+    try:
+        # powers up at its last value
+        assert database_ops.set_power_values('output01', False, False)
+        assert database_ops.set_outputs({'output01':True})
+        assert _stored_output(snapshot, 'output01') is True
+        # powers up at its default value, so its last value is not critical
+        assert database_ops.set_power_values('output01', False, True)
+        assert database_ops.set_outputs({'output01':False})
+        assert _stored_output(snapshot, 'output01') is True
+        assert _stored_output(working, 'output01') is False
+    finally:
+        database_ops.set_output_durability('batched')
+
+
+def test_an_unchanged_database_is_not_copied_again(paths):
+    projectfiles, working, snapshot = paths
+    _start(projectfiles)
+    snapshotter = database_ops._snapshotter
+    assert snapshotter.snapshot()
+    assert snapshotter.skipped == 1
+    assert snapshotter.snapshots == 1
+
+
+def test_start_up_restores_a_lost_working_database_from_the_snapshot(paths):
+    projectfiles, working, snapshot = paths
+    _start(projectfiles)
+    assert database_ops.add_user('operator', 'secret')
+    _stop()
+    # as after a reboot clears the memory backed filesystem
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(working + suffix):
+            os.remove(working + suffix)
+    _start(projectfiles)
+    assert os.path.exists(working)
+    assert database_ops.get_password('operator') is not None
+
+
+def test_start_up_keeps_a_working_database_newer_than_the_snapshot(paths):
+    projectfiles, working, snapshot = paths
+    _start(projectfiles)
+    _stop()
+    # changed after the last snapshot, as when the process is killed
+    con = sqlite3.connect(working)
+    con.execute("insert into messages (message, time, level, category) values (?, ?, ?, ?)",
+                ('after the snapshot', datetime.utcnow(), database_ops.INFO, 'test'))
+    con.commit()
+    con.close()
+    assert not _query(snapshot, "select 1 from messages where category = 'test'")
+    _start(projectfiles)
+    assert [row[4] for row in database_ops.get_messages(category='test')] == ['after the snapshot']
+    # and the snapshot taken at start up has it
+    assert _query(snapshot, "select message from messages where category = 'test'") == [("after the snapshot",)]
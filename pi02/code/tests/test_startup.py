@@ -0,0 +1,74 @@
+#######################################################
+#
+# test_startup.py
+# the startup timeline, its phases in order, and the
+# deferred work run in order after the application is
+# ready
+#
+#######################################################
+
+
+import json, threading
+
+from picode import startup
+
+
+def test_phases_are_recorded_in_order():
+    timeline = startup.Timeline()
+    with timeline.phase('database'):
+        pass
+    with timeline.phase('outputs'):
+        pass
+    timeline.mark_ready()
+    data = timeline.as_dict()
+    assert [phase['name'] for phase in data['phases']] == ['database', 'outputs']
+    assert data['phases'][0]['start_ms'] <= data['phases'][1]['start_ms']
+    assert not any(phase['deferred'] for phase in data['phases'])
+    assert data['ready_ms'] >= data['phases'][1]['start_ms']
+
+
+def test_deferred_work_runs_in_order_after_ready(monkeypatch, tmp_path):
+    report = tmp_path / 'startup.json'
+    monkeypatch.setenv(startup._REPORT_VARIABLE, str(report))
+    timeline = startup.Timeline()
+    ran = []
+    release = threading.Event()
+
+    def first():
+        release.wait(2)
+        ran.append('first')
+
+    def failing():
+        raise RuntimeError("fails")
+
+    timeline.defer('first', first)
+    timeline.defer('failing', failing)
+    timeline.defer('second', ran.append, 'second')
+    # nothing runs until run_deferred
+    assert ran == []
+    with timeline.phase('serve'):
+        pass
+    timeline.mark_ready()
+    timeline.run_deferred()
+    assert ran == []
+    release.set()
+    assert timeline.finished.wait(2)
+    # a failure does not stop the later work
+    assert ran == ['first', 'second']
+    phases = timeline.as_dict()['phases']
+    assert [(phase['name'], phase['deferred']) for phase in phases] == [('serve', False), ('first', True),
+                                                                         ('failing', True), ('second', True)]
+    assert phases[1]['start_ms'] >= timeline.as_dict()['ready_ms']
+    # the report is written when the deferred work is done
+    assert json.loads(report.read_text()) == timeline.as_dict()
+
+
+def test_text_report():
+    timeline = startup.Timeline()
+    with timeline.phase('database'):
+        pass
+    timeline.mark_ready()
+    lines = timeline.text().splitlines()
+    assert lines[0].split() == ['phase', 'start', 'ms', 'ms']
+    assert lines[1].startswith('database ')
+    assert lines[2].startswith('ready ')
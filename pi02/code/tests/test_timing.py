@@ -0,0 +1,119 @@
+#######################################################
+#
+# test_timing.py
+# timed pulses and software PWM on the simulated
+# output01, restoring the stored value, and publishing
+# each transition to the event stream
+#
+#######################################################
+
+
+import time
+
+import pytest
+
+from picode import hardware, timing, events, database_ops
+
+
+@pytest.fixture
+def engine(database, backend, monkeypatch):
+    "A new timing engine, and event broker, output01 stored and set off"
+    monkeypatch.setattr(events, 'broker', events.EventBroker())
+    database_ops.set_outputs({'output01':False})
+    result = timing.TimingEngine()
+    monkeypatch.setattr(timing, 'engine', result)
+    yield result
+    result.stop()
+
+
+@pytest.fixture
+def published(engine):
+    "A list of the output01 values published to the event stream"
+    result = []
+    events.broker.add_listener(lambda event: result.append(event.value) if event.name == 'output01' else None)
+    return result
+
+
+def _level(backend):
+    return backend.levels[hardware._OUTPUTS['output01'].BCM]
+
+
+def _wait(condition, timeout=2):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end
+        time.sleep(0.01)
+
+
+def test_a_pulse_restores_the_stored_value(engine, backend, published):
+    timing.pulse('output01', 0.05)
+    assert _level(backend) == 1
+    _wait(lambda: not engine.stats().get('output01', {}).get('program'))
+    assert _level(backend) == 0
+    assert published == [True, False]
+    assert database_ops.get_output('output01') is False
+    assert engine.stats()['output01']['transitions'] == 1
+
+
+def test_pwm_transitions_are_published(engine, backend, published):
+    timing.pwm('output01', 0.05, 0.5)
+    _wait(lambda: engine.stats()['output01']['program']['cycles'] >= 3)
+    assert timing.cancel('output01')
+    assert _level(backend) == 0
+    assert published[:6] == [True, False] * 3
+    assert published[-1] is False
+    # no transition follows the cancel
+    count = len(published)
+    time.sleep(0.1)
+    assert len(published) == count
+
+
+def test_a_cancel_restores_the_value_stored_when_the_program_started(engine, backend, published):
+    database_ops.set_outputs({'output01':True})
+    hardware.set_boolean_output('output01', True)
+    timing.pwm('output01', 1, 0.2)
+    time.sleep(0.3)
+    assert _level(backend) == 0
+    assert timing.cancel('output01')
+    assert _level(backend) == 1
+    assert published[-1] is True
+    assert not timing.cancel('output01')
+
+
+def test_a_new_program_replaces_the_running_one(engine, backend):
+    timing.pulse('output01', 0.05)
+    timing.pwm('output01', 1, 1)
+    time.sleep(0.1)
+    # the pulse end was discarded, the full duty PWM holds the output on
+    assert _level(backend) == 1
+    assert engine.stats()['output01']['program']['kind'] == 'pwm'
+
+
+def test_stop_sets_power_up_values(engine, backend, published, monkeypatch):
+    monkeypatch.setattr(database_ops, 'power_up_values', lambda: {'output01':False})
+    timing.pulse('output01', 10)
+    assert _level(backend) == 1
+    engine.stop()
+    assert _level(backend) == 0
+    assert published == [True, False]
+
+
+def test_the_thread_waits_without_polling_by_default(engine):
+    assert engine._spin == 0
+    timing.pulse('output01', 0.5)
+    start = time.process_time()
+    time.sleep(0.3)
+    # a thread polling the clock would use the processor for most of the wait
+    assert time.process_time() - start < 0.15
+
+
+@pytest.mark.parametrize('call', [
+    lambda: timing.pulse('output01', 0),
+    lambda: timing.pulse('output01', True),
+    lambda: timing.pwm('output01', 0.001, 0.5),
+    lambda: timing.pwm('output01', 1, 1.5),
+    lambda: timing.pulse('input01', 1),
+    ])
+def test_invalid_programs_are_refused(engine, call):
+    with pytest.raises(ValueError):
+        call()
@@ -0,0 +1,30 @@
+// Subscribes to the pi02 event stream, and refreshes the page fields as soon as
+// an output is set or a boolean input changes. The page refresh interval remains
+// as a slow fallback, and keeps text inputs, such as the server time, current.
+
+(function () {
+    if (typeof(EventSource) === "undefined") {
+        return;
+        }
+    var script = document.currentScript;
+    var target = script.getAttribute("data-refresh");
+    var source = new EventSource(script.getAttribute("data-events"));
+    var pending = false;
+    function refresh(e) {
+        var data = JSON.parse(e.data);
+        if (typeof(data.value) === "string") {
+            return;
+            }
+        if (pending) {
+            return;
+            }
+        // several changes arriving together result in a single refresh
+        pending = true;
+        setTimeout(function () {
+            pending = false;
+            SKIPOLE.refreshjson(target);
+            }, 50);
+        }
+    source.addEventListener("input", refresh);
+    source.addEventListener("output", refresh);
+}());